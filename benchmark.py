@@ -0,0 +1,285 @@
+import argparse
+import json
+import math
+import multiprocessing
+import os
+import platform
+import random
+import shutil
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+
+try:
+    import resource
+except ImportError:
+    resource = None
+
+from core.archive import ArchiveJob, ExtractJob
+from core.search import SearchQuery
+from core.size import get_size
+from core.transfer import TransferJob
+
+SIZE_DISTS = ("fixed", "uniform", "lognormal")
+POOL_BYTES = 1024 * 1024
+MAX_FILE_BYTES = 256 * 1024 * 1024
+
+
+def make_pool(rng):
+    # Half random, half repetitive text, so archive numbers sit somewhere
+    # between incompressible media and source trees.
+    noise = rng.randbytes(POOL_BYTES // 2)
+    words = b"lorem ipsum dolor sit amet consectetur adipiscing elit "
+    text = (words * (POOL_BYTES // 2 // len(words) + 1))[:POOL_BYTES // 2]
+    return noise + text
+
+
+def file_size(rng, dist, mean):
+    if dist == "fixed":
+        return mean
+    if dist == "uniform":
+        return rng.randint(0, 2 * mean)
+    sigma = 1.0
+    size = rng.lognormvariate(math.log(max(mean, 1)) - sigma * sigma / 2,
+                              sigma)
+    return min(int(size), MAX_FILE_BYTES)
+
+
+def write_file(path, size, pool, rng):
+    with open(path, "wb") as f:
+        offset = rng.randrange(len(pool))
+        while size > 0:
+            chunk = pool[offset:offset + size]
+            f.write(chunk)
+            size -= len(chunk)
+            offset = 0
+
+
+def make_tree(root, files=10000, depth=3, fanout=4, size_dist="lognormal",
+              mean_size=16 * 1024, symlinks=0.0, seed=0):
+    rng = random.Random(seed)
+    pool = make_pool(rng)
+    dirs = [root]
+    level = [root]
+    for d in range(depth):
+        level = [os.path.join(parent, f"d{d}_{i}")
+                 for parent in level for i in range(fanout)]
+        dirs.extend(level)
+    for d in dirs:
+        os.makedirs(d, exist_ok=True)
+    paths = []
+    total = 0
+    for i in range(files):
+        path = os.path.join(dirs[i % len(dirs)], f"f{i}.dat")
+        size = file_size(rng, size_dist, mean_size)
+        write_file(path, size, pool, rng)
+        paths.append(path)
+        total += size
+    links = 0
+    for i in range(int(files * symlinks)):
+        target = rng.choice(paths)
+        link = os.path.join(rng.choice(dirs), f"l{i}.lnk")
+        try:
+            os.symlink(os.path.relpath(target, os.path.dirname(link)), link)
+        except (OSError, NotImplementedError):
+            break
+        links += 1
+    return {"files": files, "dirs": len(dirs), "symlinks": links,
+            "bytes": total}
+
+
+def run_job(job):
+    job.run()
+    if job.state != "done":
+        raise RuntimeError(f"{type(job).__name__} {job.state}: {job.error}")
+
+
+def bench_size(root, work):
+    get_size(root)
+
+
+def bench_search(root, work):
+    query = SearchQuery.parse("*7*")
+    for _ in query.walk(root):
+        pass
+
+
+def bench_copy(root, work):
+    run_job(TransferJob(root, os.path.join(work, "copy")))
+
+
+def bench_archive(root, work):
+    run_job(ArchiveJob([root], os.path.join(work, "archive.zip")))
+
+
+def bench_unpack(root, work):
+    run_job(ExtractJob(os.path.join(work, "unpack.zip"),
+                       os.path.join(work, "unpacked")))
+
+
+def setup_unpack(root, work):
+    run_job(ArchiveJob([root], os.path.join(work, "unpack.zip")))
+
+
+# name: (function, setup or None, whether the bytes of the tree are read)
+BENCHMARKS = {
+    "get_size": (bench_size, None, False),
+    "search_walk": (bench_search, None, False),
+    "copy": (bench_copy, None, True),
+    "archive": (bench_archive, None, True),
+    "unpack": (bench_unpack, setup_unpack, True),
+}
+
+
+def peak_rss():
+    # ru_maxrss is in KiB on Linux and in bytes on macOS.
+    if resource is None:
+        return None, None
+    scale = 1 if sys.platform == "darwin" else 1024
+    own = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * scale
+    children = resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss * scale
+    return own, children
+
+
+def _child(name, root, work, conn):
+    try:
+        started = time.perf_counter()
+        BENCHMARKS[name][0](root, work)
+        elapsed = time.perf_counter() - started
+        conn.send(("ok", elapsed, peak_rss()))
+    except Exception as e:
+        conn.send(("error", f"{type(e).__name__}: {e}", None))
+    finally:
+        conn.close()
+
+
+def run_once(name, root, work):
+    # A fresh process per run, so in-memory caches start cold and the peak
+    # RSS belongs to this benchmark alone. The OS page cache stays warm.
+    ctx = multiprocessing.get_context("spawn")
+    recv, send = ctx.Pipe(duplex=False)
+    proc = ctx.Process(target=_child, args=(name, root, work, send))
+    proc.start()
+    send.close()
+    try:
+        status, value, rss = recv.recv()
+    except EOFError:
+        status, value, rss = "error", "benchmark process died", None
+    proc.join()
+    if status != "ok":
+        raise RuntimeError(f"{name}: {value}")
+    return value, rss
+
+
+def run(names, tree, root, work, repeat=3):
+    results = {}
+    entries = tree["files"] + tree["dirs"] + tree["symlinks"]
+    for name in names:
+        function, setup, reads = BENCHMARKS[name]
+        bench_dir = os.path.join(work, name)
+        times = []
+        peaks = []
+        for _ in range(repeat):
+            shutil.rmtree(bench_dir, ignore_errors=True)
+            os.makedirs(bench_dir)
+            if setup is not None:
+                setup(root, bench_dir)
+            seconds, rss = run_once(name, root, bench_dir)
+            times.append(seconds)
+            peaks.append(rss)
+        shutil.rmtree(bench_dir, ignore_errors=True)
+        best = min(times)
+        result = {
+            "seconds": times,
+            "best": best,
+            "median": statistics.median(times),
+            "files_per_s": entries / best if best else None,
+            "mb_per_s": (tree["bytes"] / 2 ** 20 / best
+                         if reads and best else None),
+            "peak_rss_bytes": max((p[0] for p in peaks if p[0]),
+                                  default=None),
+            "peak_child_rss_bytes": max((p[1] for p in peaks if p[1]),
+                                        default=None),
+        }
+        results[name] = result
+        print(f"{name}: {best:.3f}s best of {repeat}", file=sys.stderr)
+    return results
+
+
+def revision():
+    try:
+        return subprocess.run(
+            ["git", "rev-parse", "HEAD"], capture_output=True, text=True,
+            cwd=os.path.dirname(os.path.abspath(__file__)),
+            check=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(
+        description="Time the file manager's crawl, size, search, copy and "
+                    "archive paths on a synthetic tree and print JSON.")
+    parser.add_argument("--files", type=int, default=10000)
+    parser.add_argument("--depth", type=int, default=3)
+    parser.add_argument("--fanout", type=int, default=4)
+    parser.add_argument("--size-dist", choices=SIZE_DISTS,
+                        default="lognormal")
+    parser.add_argument("--mean-size", type=int, default=16 * 1024,
+                        help="mean file size in bytes")
+    parser.add_argument("--symlinks", type=float, default=0.0,
+                        help="symlinks to create, as a fraction of files")
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--repeat", type=int, default=3)
+    parser.add_argument("--only", default=",".join(BENCHMARKS),
+                        help="comma separated subset of "
+                             + ", ".join(BENCHMARKS))
+    parser.add_argument("--workdir",
+                        help="where to build the tree, a temporary "
+                             "directory by default")
+    parser.add_argument("--output", help="write the JSON here, not stdout")
+    args = parser.parse_args(argv)
+    args.only = [name.strip() for name in args.only.split(",")
+                 if name.strip()]
+    unknown = [name for name in args.only if name not in BENCHMARKS]
+    if unknown:
+        parser.error(f"unknown benchmark: {', '.join(unknown)}")
+    return args
+
+
+def benchmark(argv=None):
+    args = parse_args(argv)
+    work = tempfile.mkdtemp(prefix="fm-bench-", dir=args.workdir)
+    try:
+        root = os.path.join(work, "tree")
+        started = time.perf_counter()
+        tree = make_tree(root, args.files, args.depth, args.fanout,
+                         args.size_dist, args.mean_size, args.symlinks,
+                         args.seed)
+        print(f"tree: {tree['files']} files, {tree['dirs']} dirs, "
+              f"{tree['bytes'] / 2 ** 20:.1f} MiB in "
+              f"{time.perf_counter() - started:.1f}s", file=sys.stderr)
+        report = {
+            "revision": revision(),
+            "python": platform.python_version(),
+            "platform": platform.platform(),
+            "cpus": os.cpu_count(),
+            "tree": dict(tree, depth=args.depth, fanout=args.fanout,
+                         size_dist=args.size_dist, mean_size=args.mean_size,
+                         seed=args.seed),
+            "results": run(args.only, tree, root, work, args.repeat),
+        }
+    finally:
+        shutil.rmtree(work, ignore_errors=True)
+    text = json.dumps(report, indent=2)
+    if args.output:
+        with open(args.output, "w") as f:
+            f.write(text + "\n")
+    else:
+        print(text)
+
+
+if __name__ == "__main__":
+    benchmark()
@@ -0,0 +1,483 @@
+import os
+import shutil
+import time
+import hashlib
+import stat
+import threading
+import errno
+import collections
+import functools
+import multiprocessing
+import struct
+import zlib
+import zipfile
+import tempfile
+
+from concurrent.futures import Future, ProcessPoolExecutor, \
+    ThreadPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+
+from pathlib import Path
+
+from .size import SizeEngine
+from .transfer import TransferJob, COPY_CHUNK
+
+ARCHIVE_WORKERS = os.cpu_count() or 1
+ARCHIVE_CHUNK = 4 * 1024 * 1024
+ARCHIVE_INLINE = 64 * 1024
+EXTRACT_WORKERS = min(8, os.cpu_count() or 1)
+MEMBER_CACHE_DIR = Path(tempfile.gettempdir()) / "file_manager" / "members"
+MEMBER_CACHE_BYTES = 512 * 1024 * 1024
+ARCHIVE_LEVELS = {"Normal": 6, "Fast": 1, "Best": 9, "Store only": None}
+STORED_SUFFIXES = frozenset({
+    ".zip", ".gz", ".tgz", ".bz2", ".xz", ".7z", ".rar", ".zst", ".jar",
+    ".jpg", ".jpeg", ".png", ".gif", ".webp", ".mp3", ".mp4", ".mkv",
+    ".avi", ".mov", ".ogg", ".flac", ".docx", ".xlsx", ".pptx", ".pdf"})
+ZIP64_LIMIT = (1 << 31) - 1
+
+
+def _gf2_times(mat, vec):
+    total = 0
+    i = 0
+    while vec:
+        if vec & 1:
+            total ^= mat[i]
+        vec >>= 1
+        i += 1
+    return total
+
+
+def _gf2_square(mat):
+    return [_gf2_times(mat, mat[n]) for n in range(32)]
+
+
+@functools.lru_cache(maxsize=64)
+def _crc32_shift(length):
+    # The operator that feeds `length` zero bytes through a CRC-32
+    # register, built by squaring as in zlib's crc32_combine.
+    op = [1 << n for n in range(32)]
+    mat = [0xedb88320] + [1 << n for n in range(31)]
+    for _ in range(3):
+        mat = _gf2_square(mat)
+    while length:
+        if length & 1:
+            op = [_gf2_times(mat, v) for v in op]
+        length >>= 1
+        if length:
+            mat = _gf2_square(mat)
+    return tuple(op)
+
+
+def crc32_combine(crc1, crc2, len2):
+    return _gf2_times(_crc32_shift(len2), crc1) ^ crc2
+
+
+def pack_chunk(path, offset, length, level, last):
+    with open(path, "rb") as f:
+        f.seek(offset)
+        data = f.read(length)
+    crc = zlib.crc32(data)
+    if level is None:
+        return data, crc, len(data)
+    # Raw deflate chunks ending in a sync flush can be concatenated into a
+    # single member, the last one carries the final block.
+    comp = zlib.compressobj(level, zlib.DEFLATED, -15)
+    out = comp.compress(data) + \
+        comp.flush(zlib.Z_FINISH if last else zlib.Z_SYNC_FLUSH)
+    return out, crc, len(data)
+
+
+def iter_archive_members(sources):
+    for src in sources:
+        src = os.path.abspath(src)
+        base = os.path.dirname(src)
+        stack = [src]
+        while stack:
+            path = stack.pop()
+            try:
+                st = os.stat(path)
+            except OSError:
+                continue
+            arcname = os.path.relpath(path, base).replace(os.sep, "/")
+            if stat.S_ISDIR(st.st_mode):
+                yield path, arcname + "/", st
+                with os.scandir(path) as it:
+                    children = sorted(e.path for e in it
+                                      if not (e.is_symlink() and e.is_dir()))
+                stack.extend(reversed(children))
+            elif stat.S_ISREG(st.st_mode):
+                yield path, arcname, st
+
+
+class _ZipEntry:
+    __slots__ = ("name", "offset", "method", "dos_time", "dos_date",
+                 "crc", "csize", "usize", "mode", "zip64")
+
+    def __init__(self, name, offset, method, mtime, mode, zip64):
+        self.name = name.encode("utf-8")
+        self.offset = offset
+        self.method = method
+        year, month, day, hour, minute, second = \
+            time.localtime(max(mtime, 315532800))[:6]
+        self.dos_time = hour << 11 | minute << 5 | second // 2
+        self.dos_date = (year - 1980) << 9 | month << 5 | day
+        self.crc = 0
+        self.csize = 0
+        self.usize = 0
+        self.mode = mode
+        self.zip64 = zip64
+
+
+class ZipWriter:
+    # A minimal zip writer that accepts data which is already compressed,
+    # so members can be deflated elsewhere and only assembled here.
+
+    def __init__(self, fp):
+        self.fp = fp
+        self.entries = []
+        self.current = None
+
+    def begin(self, name, st, method):
+        is_dir = name.endswith("/")
+        zip64 = st.st_size * 1.05 > ZIP64_LIMIT
+        entry = _ZipEntry(name, self.fp.tell(), method, st.st_mtime,
+                          st.st_mode, zip64)
+        extra = b""
+        size = 0
+        if zip64:
+            extra = struct.pack("<HHQQ", 1, 16, 0, 0)
+            size = 0xFFFFFFFF
+        self.fp.write(struct.pack(
+            "<IHHHHHIIIHH", 0x04034b50, 45 if zip64 else 20, 0x800, method,
+            entry.dos_time, entry.dos_date, 0, size, size,
+            len(entry.name), len(extra)))
+        self.fp.write(entry.name)
+        self.fp.write(extra)
+        self.entries.append(entry)
+        if not is_dir:
+            self.current = entry
+        return entry
+
+    def write(self, data):
+        self.fp.write(data)
+        self.current.csize += len(data)
+
+    def end(self, crc, usize):
+        entry = self.current
+        entry.crc = crc
+        entry.usize = usize
+        if not entry.zip64 and max(entry.csize, usize) >= ZIP64_LIMIT:
+            raise OSError(errno.EFBIG, "Member grew past the zip64 limit",
+                          entry.name.decode("utf-8"))
+        end = self.fp.tell()
+        self.fp.seek(entry.offset + 14)
+        if entry.zip64:
+            self.fp.write(struct.pack("<I", crc))
+            self.fp.seek(entry.offset + 30 + len(entry.name) + 4)
+            self.fp.write(struct.pack("<QQ", usize, entry.csize))
+        else:
+            self.fp.write(struct.pack("<III", crc, entry.csize, usize))
+        self.fp.seek(end)
+        self.current = None
+
+    def close(self):
+        start = self.fp.tell()
+        for entry in self.entries:
+            fields = []
+            usize, csize, offset = entry.usize, entry.csize, entry.offset
+            if usize >= ZIP64_LIMIT:
+                fields.append(usize)
+                usize = 0xFFFFFFFF
+            if csize >= ZIP64_LIMIT:
+                fields.append(csize)
+                csize = 0xFFFFFFFF
+            if offset >= ZIP64_LIMIT:
+                fields.append(offset)
+                offset = 0xFFFFFFFF
+            extra = b""
+            if fields:
+                extra = struct.pack(f"<HH{len(fields)}Q", 1, 8 * len(fields),
+                                    *fields)
+            attr = (entry.mode & 0xFFFF) << 16
+            if entry.name.endswith(b"/"):
+                attr |= 0x10
+            version = 45 if fields or entry.zip64 else 20
+            self.fp.write(struct.pack(
+                "<IHHHHHHIIIHHHHHII", 0x02014b50, 3 << 8 | version, version,
+                0x800, entry.method, entry.dos_time, entry.dos_date,
+                entry.crc, csize, usize, len(entry.name), len(extra), 0, 0,
+                0, attr, offset))
+            self.fp.write(entry.name)
+            self.fp.write(extra)
+        end = self.fp.tell()
+        count, size = len(self.entries), end - start
+        if count >= 0xFFFF or size >= ZIP64_LIMIT or start >= ZIP64_LIMIT:
+            self.fp.write(struct.pack(
+                "<IQHHIIQQQQ", 0x06064b50, 44, 3 << 8 | 45, 45, 0, 0,
+                count, count, size, start))
+            self.fp.write(struct.pack("<IIQI", 0x07064b50, 0, end, 1))
+            count = min(count, 0xFFFF)
+            size = min(size, 0xFFFFFFFF)
+            start = min(start, 0xFFFFFFFF)
+        self.fp.write(struct.pack("<IHHHHIIH", 0x06054b50, 0, 0, count,
+                                  count, size, start, 0))
+
+
+class ArchiveJob(TransferJob):
+    def __init__(self, sources, dst, level=6, store_compressed=True):
+        super().__init__(sources[0], dst)
+        self.sources = [os.fspath(x) for x in sources]
+        self.kind = "archive"
+        self.level = level
+        self.store_compressed = store_compressed
+
+    def execute(self):
+        members = list(iter_archive_members(self.sources))
+        self.total = sum(st.st_size for path, name, st in members
+                         if not name.endswith("/"))
+        ctx = multiprocessing.get_context("spawn")
+        f = open(self.dst, "xb")
+        self.created = True
+        pool = ProcessPoolExecutor(ARCHIVE_WORKERS, mp_context=ctx)
+        try:
+            writer = ZipWriter(f)
+            pending = collections.deque()
+            for task in self.tasks(members, pool):
+                pending.append(task)
+                if len(pending) >= ARCHIVE_WORKERS * 2:
+                    self.assemble(writer, pending.popleft())
+            while pending:
+                self.assemble(writer, pending.popleft())
+            writer.close()
+            f.close()
+        except BrokenProcessPool as e:
+            f.close()
+            os.unlink(self.dst)
+            raise OSError(f"Compression worker failed: {e}") from e
+        except BaseException:
+            f.close()
+            os.unlink(self.dst)
+            raise
+        finally:
+            pool.shutdown(wait=True, cancel_futures=True)
+
+    def tasks(self, members, pool):
+        for path, name, st in members:
+            self.checkpoint()
+            if name.endswith("/"):
+                yield name, st, None, None
+                continue
+            level = self.level
+            if self.store_compressed and \
+                    os.path.splitext(name)[1].lower() in STORED_SUFFIXES:
+                level = None
+            offset = 0
+            while True:
+                last = offset + ARCHIVE_CHUNK >= st.st_size
+                # Stored data and small files are cheaper to pack here
+                # than to send through the pool and back.
+                if level is None or st.st_size <= ARCHIVE_INLINE:
+                    future = Future()
+                    future.set_result(pack_chunk(path, offset, ARCHIVE_CHUNK,
+                                                 level, last))
+                else:
+                    future = pool.submit(pack_chunk, path, offset,
+                                         ARCHIVE_CHUNK, level, last)
+                yield name, st, (offset == 0, last, level), future
+                if last:
+                    break
+                offset += ARCHIVE_CHUNK
+
+    def assemble(self, writer, task):
+        name, st, chunk, future = task
+        if chunk is None:
+            writer.begin(name, st, 0)
+            return
+        first, last, level = chunk
+        if first:
+            writer.begin(name, st, 0 if level is None else 8)
+            self.crc, self.usize = 0, 0
+        data, crc, size = future.result()
+        self.checkpoint()
+        writer.write(data)
+        # Only files spanning several chunks pay for combining CRCs.
+        self.crc = crc if first else crc32_combine(self.crc, crc, size)
+        self.usize += size
+        self.done += size
+        if last:
+            writer.end(self.crc, self.usize)
+            self.files += 1
+
+
+def member_path(dst, name):
+    # Same sanitizing as ZipFile.extract: no absolute paths, drive letters
+    # or parent references.
+    name = name.replace("\\", "/")
+    parts = [p for p in name.split("/") if p not in ("", ".", "..")]
+    if parts and len(parts[0]) == 2 and parts[0][1] == ":":
+        parts = parts[1:]
+    return os.path.join(dst, *parts)
+
+
+class ExtractJob(TransferJob):
+    def __init__(self, src, dst, members=None):
+        super().__init__(src, dst)
+        self.kind = "extract"
+        self.members = members
+        self.lock = threading.Lock()
+        self.local = threading.local()
+        self.handles = []
+
+    def selected(self, infos):
+        if not self.members:
+            return infos
+        names = set(self.members)
+        dirs = tuple(x for x in names if x.endswith("/"))
+        return [i for i in infos
+                if i.filename in names or i.filename.startswith(dirs)]
+
+    def execute(self):
+        with zipfile.ZipFile(self.src) as zf:
+            infos = self.selected(zf.infolist())
+        self.total = sum(i.file_size for i in infos)
+        os.makedirs(self.dst)
+        self.created = True
+        files = []
+        for info in infos:
+            path = member_path(self.dst, info.filename)
+            if info.is_dir():
+                os.makedirs(path, exist_ok=True)
+            else:
+                files.append((info, path))
+        files.sort(key=lambda x: x[0].file_size, reverse=True)
+        with ThreadPoolExecutor(EXTRACT_WORKERS) as pool:
+            futures = [pool.submit(self.extract, info, path)
+                       for info, path in files]
+            try:
+                for future in futures:
+                    future.result()
+            except BaseException:
+                self.cancel()
+                raise
+            finally:
+                pool.shutdown(wait=True)
+                for zf in self.handles:
+                    zf.close()
+
+    def archive(self):
+        zf = getattr(self.local, "zf", None)
+        if zf is None:
+            zf = self.local.zf = zipfile.ZipFile(self.src)
+            with self.lock:
+                self.handles.append(zf)
+        return zf
+
+    def extract(self, info, path):
+        self.checkpoint()
+        parent = os.path.dirname(path)
+        if parent:
+            os.makedirs(parent, exist_ok=True)
+        try:
+            with self.archive().open(info) as fsrc, open(path, "wb") as fdst:
+                while True:
+                    self.checkpoint()
+                    data = fsrc.read(COPY_CHUNK)
+                    if not data:
+                        break
+                    fdst.write(data)
+                    with self.lock:
+                        self.done += len(data)
+        except (zipfile.BadZipFile, RuntimeError, NotImplementedError) as e:
+            raise OSError(f"{info.filename}: {e}") from e
+        with self.lock:
+            self.files += 1
+
+
+class ZipIndex:
+    # Directory listing of an archive built from its central directory
+    # alone, with the implicit parent folders filled in.
+
+    def __init__(self, path):
+        self.path = os.fspath(path)
+        self.children = {"": {}}
+        with zipfile.ZipFile(self.path) as zf:
+            for info in zf.infolist():
+                parts = [p for p in info.filename.split("/")
+                         if p not in ("", ".", "..")]
+                if not parts:
+                    continue
+                parent = ""
+                for part in parts[:-1]:
+                    key = parent + part + "/"
+                    self.children[parent].setdefault(part, (True, None))
+                    self.children.setdefault(key, {})
+                    parent = key
+                if info.is_dir():
+                    self.children[parent][parts[-1]] = (True, info)
+                    self.children.setdefault(parent + parts[-1] + "/", {})
+                else:
+                    self.children[parent][parts[-1]] = (False, info)
+
+    def list(self, key):
+        entries = self.children.get(key, {})
+        return sorted(((name, is_dir, info)
+                       for name, (is_dir, info) in entries.items()),
+                      key=lambda x: (not x[1], x[0].lower()))
+
+
+@functools.lru_cache(maxsize=8)
+def _zip_index(path, mtime, size):
+    return ZipIndex(path)
+
+
+def zip_index(path):
+    st = os.stat(path)
+    return _zip_index(os.fspath(path), st.st_mtime_ns, st.st_size)
+
+
+class MemberCache:
+    # Single archive members extracted on demand. Each member lives in its
+    # own folder so it keeps its file name, the least recently used folders
+    # are removed once the cache grows past max_bytes.
+
+    def __init__(self, root=MEMBER_CACHE_DIR, max_bytes=MEMBER_CACHE_BYTES):
+        self.root = Path(root)
+        self.max_bytes = max_bytes
+        self.entries = collections.OrderedDict()
+        self.total = 0
+        self.lock = threading.Lock()
+        self.root.mkdir(parents=True, exist_ok=True)
+        existing = []
+        for entry in os.scandir(self.root):
+            if entry.is_dir(follow_symlinks=False):
+                size = SizeEngine().size(entry.path)
+                existing.append((entry.stat().st_mtime, entry.name, size))
+        for mtime, name, size in sorted(existing):
+            self.entries[name] = size
+            self.total += size
+
+    def get(self, archive, member):
+        archive = os.fspath(archive)
+        st = os.stat(archive)
+        key = hashlib.sha1(f"{archive}\0{st.st_mtime_ns}\0{member}"
+                           .encode("utf-8", "surrogatepass")).hexdigest()
+        target = self.root / key / Path(member).name
+        with self.lock:
+            if key in self.entries and target.exists():
+                self.entries.move_to_end(key)
+                os.utime(target.parent)
+                return target
+        target.parent.mkdir(exist_ok=True)
+        tmp = target.with_name(target.name + ".part")
+        with zipfile.ZipFile(archive) as zf, zf.open(member) as fsrc, \
+                open(tmp, "wb") as fdst:
+            shutil.copyfileobj(fsrc, fdst, COPY_CHUNK)
+        os.replace(tmp, target)
+        with self.lock:
+            self.total += target.stat().st_size - self.entries.pop(key, 0)
+            self.entries[key] = target.stat().st_size
+            while self.total > self.max_bytes and len(self.entries) > 1:
+                old, size = self.entries.popitem(last=False)
+                shutil.rmtree(self.root / old, ignore_errors=True)
+                self.total -= size
+        return target
@@ -0,0 +1,284 @@
+import argparse
+import os
+import stat
+import sys
+import threading
+
+from .archive import ArchiveJob, ExtractJob, ARCHIVE_LEVELS
+from .content import search_content
+from .metrics import metrics
+from .rename import RenameRule, RenamePlan, RenameJob
+from .search import SearchQuery, search_roots, SEARCH_PER_MOUNT
+from .size import SizeEngine, UsageTree, size_cache
+from .transfer import TransferJob, SyncJob
+from .util import format_size
+
+LEVELS = {name.split()[0].lower(): level
+          for name, level in ARCHIVE_LEVELS.items()}
+
+
+def run_job(job, quiet=False):
+    # Runs the job on a helper thread so Ctrl+C can cancel it cleanly and
+    # the partial output gets discarded like it does in the GUI.
+    thread = threading.Thread(target=job.run)
+    thread.start()
+    show = not quiet and sys.stderr.isatty()
+    try:
+        while thread.is_alive():
+            thread.join(0.5)
+            if show and job.total:
+                sys.stderr.write(f"\r{job.label()}  "
+                                 f"{100 * job.done // job.total}%  "
+                                 f"{job.rate()}\033[K")
+    except KeyboardInterrupt:
+        job.cancel()
+        thread.join()
+    if show:
+        sys.stderr.write("\r\033[K")
+    if job.state != "done":
+        reason = job.error if job.error is not None else job.state
+        print(f"{job.label()}: {reason}", file=sys.stderr)
+        return False
+    return True
+
+
+def cmd_search(args):
+    if args.content:
+        status = 0
+        count = 0
+        for root in args.roots:
+            try:
+                for path, line, offset, text in search_content(args.query,
+                                                               root):
+                    print(f"{path}:{line}:{offset}: {text}")
+                    count += 1
+                    if count == args.limit:
+                        return status
+            except OSError as e:
+                print(f"search: {root}: {e.strerror or e}", file=sys.stderr)
+                status = 1
+        return status
+    try:
+        query = SearchQuery.parse(args.query)
+    except ValueError as e:
+        print(f"search: {e}", file=sys.stderr)
+        return 2
+    errors = []
+    results = search_roots(query, args.roots, per_mount=args.per_mount,
+                           processes=args.processes, errors=errors)
+    if args.rank:
+        results = sorted(query.rank(path, root) for root, path in results)
+        for _, _, path in results:
+            print(path)
+    else:
+        for root, path in results:
+            print(path)
+    for root, e in errors:
+        print(f"search: {root}: {getattr(e, 'strerror', None) or e}",
+              file=sys.stderr)
+    return 1 if errors else 0
+
+
+def cmd_du(args):
+    status = 0
+    for path in args.paths:
+        try:
+            st = os.lstat(path)
+            if not stat.S_ISDIR(st.st_mode):
+                rows = []
+                total = st.st_size
+            elif args.top:
+                tree = UsageTree.scan(path)
+                rows = [(tree.size[n], tree.path(n))
+                        for n in tree.children(0)[:args.top]]
+                total = tree.size[0]
+            else:
+                rows = []
+                total = SizeEngine(size_cache).size(path)
+        except OSError as e:
+            print(f"du: {path}: {e.strerror}", file=sys.stderr)
+            status = 1
+            continue
+        for size, name in rows:
+            print(f"{human(size, args.human)}\t{name}")
+        print(f"{human(total, args.human)}\t{path}")
+    return status
+
+
+def human(size, readable):
+    return format_size(size) if readable else str(size)
+
+
+def cmd_cp(args):
+    dst = args.dst
+    into = os.path.isdir(dst)
+    if len(args.src) > 1 and not into:
+        print(f"cp: {dst} is not a directory", file=sys.stderr)
+        return 2
+    ok = True
+    for src in args.src:
+        target = os.path.join(dst, os.path.basename(os.path.normpath(src))) \
+            if into else dst
+        if os.path.lexists(target):
+            print(f"cp: {target} already exists", file=sys.stderr)
+            ok = False
+            continue
+        ok &= run_job(TransferJob(src, target, move=args.move), args.quiet)
+    return 0 if ok else 1
+
+
+def cmd_sync(args):
+    if not os.path.isdir(args.src):
+        print(f"sync: {args.src} is not a directory", file=sys.stderr)
+        return 2
+    job = SyncJob(args.src, args.dst, checksum=args.checksum,
+                  delete=args.delete, move=args.move)
+    ok = run_job(job, args.quiet)
+    if not args.quiet:
+        print(f"{job.files} copied, {job.skipped} unchanged, "
+              f"{job.deleted} deleted", file=sys.stderr)
+    return 0 if ok else 1
+
+
+def cmd_rename(args):
+    try:
+        rule = RenameRule(args.template, args.find, args.replace, args.regex,
+                          args.start, args.step)
+        plan = RenamePlan.build(args.paths, rule)
+    except ValueError as e:
+        print(f"rename: {e}", file=sys.stderr)
+        return 2
+    ok = plan.check()
+    for i in range(len(plan)):
+        problem = plan.problems.get(i)
+        line = f"{plan.source(i)} -> {plan.new[i]}"
+        print(f"{line}  ({problem})" if problem else line,
+              file=sys.stderr if problem else sys.stdout)
+    if not ok:
+        print(f"rename: {len(plan.problems)} problems, nothing renamed",
+              file=sys.stderr)
+        return 1
+    if args.dry_run or not len(plan):
+        return 0
+    return 0 if run_job(RenameJob(plan), args.quiet) else 1
+
+
+def cmd_zip(args):
+    if os.path.lexists(args.archive):
+        print(f"zip: {args.archive} already exists", file=sys.stderr)
+        return 1
+    job = ArchiveJob(args.src, args.archive, LEVELS[args.level])
+    return 0 if run_job(job, args.quiet) else 1
+
+
+def cmd_unzip(args):
+    dst = args.dst or os.path.splitext(args.archive)[0]
+    if os.path.lexists(dst):
+        print(f"unzip: {dst} already exists", file=sys.stderr)
+        return 1
+    job = ExtractJob(args.archive, dst, args.members or None)
+    return 0 if run_job(job, args.quiet) else 1
+
+
+def parser():
+    p = argparse.ArgumentParser(
+        prog="python -m core",
+        description="File manager engines without the GUI.")
+    p.add_argument("--metrics-jsonl", metavar="PATH",
+                   help="append one JSON line per finished operation")
+    p.add_argument("--metrics-prom", metavar="PATH",
+                   help="write Prometheus text metrics here on exit")
+    sub = p.add_subparsers(dest="command", required=True)
+
+    s = sub.add_parser("search", help="find files by name or content")
+    s.add_argument("roots", nargs="+", metavar="root")
+    s.add_argument("query", help="name, glob or filters (re: size: "
+                                 "mtime: type: exclude: case: limit:)")
+    s.add_argument("-r", "--rank", action="store_true",
+                   help="print exact name matches and shallow paths first, "
+                        "once the search is done")
+    s.add_argument("--per-mount", type=int, default=SEARCH_PER_MOUNT,
+                   help="roots searched at once on the same mount")
+    s.add_argument("-c", "--content", action="store_true",
+                   help="search file contents for the query text")
+    s.add_argument("-p", "--processes", type=int, default=0,
+                   help="match names on a process pool of this size")
+    s.add_argument("--limit", type=int, default=-1,
+                   help="stop after this many content matches")
+    s.set_defaults(func=cmd_search)
+
+    s = sub.add_parser("du", help="disk usage")
+    s.add_argument("paths", nargs="+")
+    s.add_argument("-H", "--human", action="store_true")
+    s.add_argument("-t", "--top", type=int, default=0,
+                   help="also list the largest N entries of each path")
+    s.set_defaults(func=cmd_du)
+
+    s = sub.add_parser("cp", help="copy or move files and directories")
+    s.add_argument("src", nargs="+")
+    s.add_argument("dst")
+    s.add_argument("-m", "--move", action="store_true")
+    s.add_argument("-q", "--quiet", action="store_true")
+    s.set_defaults(func=cmd_cp)
+
+    s = sub.add_parser("sync", help="copy only what differs into an "
+                                    "existing directory")
+    s.add_argument("src")
+    s.add_argument("dst")
+    s.add_argument("-c", "--checksum", action="store_true",
+                   help="compare contents of files with equal size")
+    s.add_argument("--delete", action="store_true",
+                   help="remove files that exist only in dst")
+    s.add_argument("-m", "--move", action="store_true",
+                   help="remove the source once it is synced")
+    s.add_argument("-q", "--quiet", action="store_true")
+    s.set_defaults(func=cmd_sync)
+
+    s = sub.add_parser("rename", help="rename many entries by a template, "
+                                      "all or none")
+    s.add_argument("template", help="new name, with {name} {ext} {old} "
+                                    "{parent} {n} {n:WIDTH} {mtime:FORMAT}")
+    s.add_argument("paths", nargs="+")
+    s.add_argument("-f", "--find", default="",
+                   help="replace this in the old name before the template")
+    s.add_argument("-r", "--replace", default="")
+    s.add_argument("-e", "--regex", action="store_true",
+                   help="find is a regular expression")
+    s.add_argument("--start", type=int, default=1)
+    s.add_argument("--step", type=int, default=1)
+    s.add_argument("-n", "--dry-run", action="store_true",
+                   help="only print the plan")
+    s.add_argument("-q", "--quiet", action="store_true")
+    s.set_defaults(func=cmd_rename)
+
+    s = sub.add_parser("zip", help="create a zip archive")
+    s.add_argument("archive")
+    s.add_argument("src", nargs="+")
+    s.add_argument("-l", "--level", choices=LEVELS, default="normal")
+    s.add_argument("-q", "--quiet", action="store_true")
+    s.set_defaults(func=cmd_zip)
+
+    s = sub.add_parser("unzip", help="extract a zip archive")
+    s.add_argument("archive")
+    s.add_argument("members", nargs="*",
+                   help="only these members, directories include their "
+                        "contents")
+    s.add_argument("-d", "--dst", help="target directory, by default the "
+                                       "archive name without .zip")
+    s.add_argument("-q", "--quiet", action="store_true")
+    s.set_defaults(func=cmd_unzip)
+    return p
+
+
+def main(argv=None):
+    args = parser().parse_args(argv)
+    metrics.jsonl = args.metrics_jsonl
+    try:
+        return args.func(args)
+    except BrokenPipeError:
+        return 0
+    except KeyboardInterrupt:
+        return 130
+    finally:
+        if args.metrics_prom:
+            metrics.write_prometheus(args.metrics_prom)
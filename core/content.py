@@ -0,0 +1,268 @@
+import os
+import re
+import time
+import sqlite3
+import stat
+import collections
+import multiprocessing
+import threading
+import mmap
+
+from concurrent.futures import ProcessPoolExecutor
+
+from pathlib import Path
+
+from .crawl import Crawler
+from .metrics import metrics
+from .search import INDEX_DIR, RootIndex
+from .util import open_regular
+
+CONTENT_WORKERS = os.cpu_count() or 1
+CONTENT_CHUNK = 64
+CONTENT_WINDOW_BYTES = 16 * 1024 * 1024
+CONTENT_INDEX_VERSION = "2"
+CONTENT_SNIFF_BYTES = 8192
+CONTENT_QUERY_TRIGRAMS = 16
+CONTENT_FILE_MATCHES = 100
+CONTENT_LINE_CHARS = 200
+CONTENT_LIMIT = 100000
+
+
+def trigrams(data):
+    # Distinct byte trigrams packed into 24-bit ints. Zipping the shifted
+    # slices keeps the per-byte work in C; only distinct triples are packed.
+    return {a << 16 | b << 8 | c
+            for a, b, c in set(zip(data, data[1:], data[2:]))}
+
+
+def file_trigrams(path):
+    # Read in windows so large logs are indexed to the end without holding
+    # them in memory; consecutive windows overlap by two bytes so no
+    # trigram straddling a boundary is lost.
+    tris = set()
+    try:
+        f = open_regular(path)
+        if f is None:
+            return path, None
+        with f:
+            data = f.read(CONTENT_WINDOW_BYTES)
+            if b"\0" in data[:CONTENT_SNIFF_BYTES]:
+                return path, None
+            while data:
+                tris |= trigrams(data.lower())
+                more = f.read(CONTENT_WINDOW_BYTES)
+                data = data[-2:] + more if more else b""
+    except OSError:
+        return path, None
+    return path, tris
+
+
+def scan_file(path, needle, ignore_case):
+    # Matching lines of one file as (path, line, offset, text). Binary
+    # files are skipped the way grep does.
+    try:
+        f = open_regular(path)
+        if f is None:
+            return []
+        with f:
+            size = os.fstat(f.fileno()).st_size
+            if size == 0:
+                return []
+            mm = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+    except (OSError, ValueError):
+        return []
+    matches = []
+    with mm:
+        if b"\0" in mm[:CONTENT_SNIFF_BYTES]:
+            return []
+        regex = re.compile(re.escape(needle),
+                           re.IGNORECASE if ignore_case else 0)
+        line, counted, last_line = 1, 0, -1
+        for m in regex.finditer(mm):
+            start = mm.rfind(b"\n", 0, m.start()) + 1
+            if start == last_line:
+                continue
+            line += mm[counted:start].count(b"\n")
+            counted = last_line = start
+            end = mm.find(b"\n", m.end())
+            end = len(mm) if end < 0 else end
+            text = mm[start:min(end, start + CONTENT_LINE_CHARS)]
+            matches.append((path, line, m.start(),
+                            text.decode("utf-8", "replace").strip()))
+            if len(matches) == CONTENT_FILE_MATCHES:
+                break
+    return matches
+
+
+def scan_files(paths, needle, ignore_case):
+    matches = []
+    for path in paths:
+        matches.extend(scan_file(path, needle, ignore_case))
+    return matches
+
+
+class ContentIndex(RootIndex):
+    # Trigram inverted index over the text files below a root, kept next to
+    # the FileIndex database. A file is re-read only when its size or mtime
+    # changed since the last refresh. Lookups return candidate files that
+    # contain every trigram of the needle; they still have to be scanned.
+    suffix = ".content.sqlite"
+
+    def __init__(self, root, db_dir=INDEX_DIR):
+        self.root = os.path.normpath(root)
+        Path(db_dir).mkdir(parents=True, exist_ok=True)
+        self.db_path = self.db_file(root, db_dir)
+        self.con = sqlite3.connect(self.db_path, timeout=30)
+        self.con.execute("PRAGMA journal_mode=WAL")
+        self.con.execute("PRAGMA synchronous=NORMAL")
+        self.con.executescript("""
+            CREATE TABLE IF NOT EXISTS files (
+                id INTEGER PRIMARY KEY, path TEXT UNIQUE NOT NULL,
+                size INTEGER NOT NULL, mtime INTEGER NOT NULL);
+            CREATE TABLE IF NOT EXISTS postings (
+                tri INTEGER NOT NULL, file INTEGER NOT NULL,
+                PRIMARY KEY (tri, file)) WITHOUT ROWID;
+            CREATE INDEX IF NOT EXISTS postings_file ON postings (file);
+            CREATE TABLE IF NOT EXISTS meta (
+                key TEXT PRIMARY KEY, value TEXT);
+        """)
+        # Indexes from before whole files were read only cover the start
+        # of large files and are rebuilt from scratch.
+        row = self.con.execute(
+            "SELECT value FROM meta WHERE key = 'version'").fetchone()
+        if row is None or row[0] != CONTENT_INDEX_VERSION:
+            self.con.executescript("""
+                DELETE FROM postings; DELETE FROM files; DELETE FROM meta;
+            """)
+            self.con.execute("INSERT INTO meta VALUES ('version', ?)",
+                             (CONTENT_INDEX_VERSION,))
+            self.con.commit()
+
+    def close(self):
+        self.con.close()
+
+    def is_built(self):
+        row = self.con.execute(
+            "SELECT value FROM meta WHERE key = 'built'").fetchone()
+        return row is not None
+
+    def refresh(self, workers=CONTENT_WORKERS, cancelled=None):
+        con = self.con
+        known = {path: (fid, size, mtime) for fid, path, size, mtime
+                 in con.execute("SELECT id, path, size, mtime FROM files")}
+        crawler = Crawler(select=_is_regular, want_stat=True,
+                          cancelled=cancelled)
+        changed = []
+        seen = set()
+        for entry in crawler.entries([self.root]):
+            st = entry.stat()
+            seen.add(entry.path)
+            old = known.get(entry.path)
+            if old is not None and old[1:] == (st.st_size, st.st_mtime_ns):
+                continue
+            changed.append((entry.path, st.st_size, st.st_mtime_ns))
+        if crawler.cancelled.is_set():
+            return
+        gone = [known[path][0] for path in known if path not in seen]
+        for fid in gone:
+            con.execute("DELETE FROM postings WHERE file = ?", (fid,))
+            con.execute("DELETE FROM files WHERE id = ?", (fid,))
+        stats = {path: (size, mtime) for path, size, mtime in changed}
+        ctx = multiprocessing.get_context("spawn")
+        with ProcessPoolExecutor(workers, mp_context=ctx) as pool:
+            results = pool.map(file_trigrams, list(stats), chunksize=16)
+            for done, (path, tris) in enumerate(results, 1):
+                old = known.get(path)
+                if old is not None:
+                    con.execute("DELETE FROM postings WHERE file = ?",
+                                (old[0],))
+                size, mtime = stats[path]
+                fid = con.execute(
+                    "INSERT OR REPLACE INTO files (path, size, mtime) "
+                    "VALUES (?, ?, ?)", (path, size, mtime)).lastrowid
+                if tris:
+                    con.executemany("INSERT INTO postings VALUES (?, ?)",
+                                    ((tri, fid) for tri in tris))
+                if done % 500 == 0:
+                    con.commit()
+                    if crawler.cancelled.is_set():
+                        pool.shutdown(cancel_futures=True)
+                        return
+        con.execute("INSERT OR REPLACE INTO meta VALUES ('built', ?)",
+                    (str(time.time()),))
+        con.commit()
+
+    def candidates(self, needle):
+        # Any subset of the needle's trigrams is a valid filter, a handful
+        # is already selective and keeps the compound select small.
+        tris = sorted(trigrams(needle.lower()))[:CONTENT_QUERY_TRIGRAMS]
+        if not tris:
+            cur = self.con.execute("SELECT path FROM files")
+        else:
+            inner = " INTERSECT ".join(
+                ["SELECT file FROM postings WHERE tri = ?"] * len(tris))
+            cur = self.con.execute(
+                f"SELECT path FROM files WHERE id IN ({inner})", tris)
+        for path, in cur:
+            yield path
+
+
+def _is_regular(entry):
+    return entry.is_file() and stat.S_ISREG(entry.stat().st_mode)
+
+
+def search_content(text, root, index_dir=INDEX_DIR, workers=CONTENT_WORKERS,
+                   idle=None, cancelled=None):
+    # Grep over the files below root, yielding (path, line, offset, text).
+    # With a built ContentIndex only the candidate files are scanned,
+    # otherwise every regular file is; either way scanning runs on a
+    # process pool over mmapped files. Lower case text matches
+    # case-insensitively. idle is called between chunks so callers can
+    # flush what they have while nothing matches. Setting the cancelled
+    # event stops the search between chunks.
+    cancelled = cancelled or threading.Event()
+    needle = text.encode("utf-8")
+    ignore_case = text == text.lower()
+    os.scandir(root).close()
+    index = ContentIndex.existing(root, index_dir)
+    if index is not None and index.is_built():
+        paths = index.candidates(needle)
+    else:
+        crawler = Crawler(select=lambda entry: entry.is_file(),
+                          cancelled=cancelled)
+        paths = (entry.path for entry in crawler.entries([root]))
+    ctx = multiprocessing.get_context("spawn")
+    pool = ProcessPoolExecutor(workers, mp_context=ctx)
+    pending = collections.deque()
+    try:
+        with metrics.operation("content_search", root) as op:
+            chunk = []
+            for path in paths:
+                if cancelled.is_set():
+                    break
+                chunk.append(path)
+                if len(chunk) < CONTENT_CHUNK:
+                    continue
+                pending.append(pool.submit(scan_files, chunk, needle,
+                                           ignore_case))
+                op.files += len(chunk)
+                chunk = []
+                while pending and (len(pending) > workers * 2
+                                   or pending[0].done()):
+                    yield from pending.popleft().result()
+                if idle is not None:
+                    idle()
+            if cancelled.is_set():
+                op.status = "cancelled"
+                return
+            if chunk:
+                pending.append(pool.submit(scan_files, chunk, needle,
+                                           ignore_case))
+                op.files += len(chunk)
+            while pending:
+                yield from pending.popleft().result()
+    finally:
+        pool.shutdown(wait=False, cancel_futures=True)
+        paths.close()
+        if index is not None:
+            index.close()
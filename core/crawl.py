@@ -0,0 +1,229 @@
+import os
+import threading
+import collections
+import multiprocessing
+import queue
+import random
+import time
+
+from concurrent.futures import ProcessPoolExecutor
+
+from .metrics import metrics, mount_of
+
+CRAWL_WORKERS = min(32, (os.cpu_count() or 1) * 4)
+
+
+class CrawlEntry:
+    # Picklable stand-in for os.DirEntry. stat is filled in by the crawler
+    # when asked for, otherwise it is looked up on first use and booked to
+    # the crawl's mount.
+    __slots__ = ("path", "name", "dir", "symlink", "st", "descended",
+                 "mount")
+
+    def __init__(self, path, name, is_dir, is_symlink, st=None, mount=""):
+        self.path = path
+        self.name = name
+        self.dir = is_dir
+        self.symlink = is_symlink
+        self.st = st
+        self.descended = False
+        self.mount = mount
+
+    def __getstate__(self):
+        return (self.path, self.name, self.dir, self.symlink, self.st,
+                self.descended, self.mount)
+
+    def __setstate__(self, state):
+        (self.path, self.name, self.dir, self.symlink, self.st,
+         self.descended, self.mount) = state
+
+    def __repr__(self):
+        return f"<CrawlEntry {self.path!r}>"
+
+    def is_dir(self):
+        return self.dir
+
+    def is_file(self):
+        return not self.dir and not self.symlink
+
+    def is_symlink(self):
+        return self.symlink
+
+    def stat(self):
+        if self.st is None:
+            try:
+                self.st = os.lstat(self.path)
+            finally:
+                metrics.stated(self.mount)
+        return self.st
+
+
+def _select_batch(select, batch):
+    return [entry for entry in batch if select(entry)]
+
+
+class Crawler:
+    # Parallel scandir over one or more roots. Every worker thread keeps
+    # its own deque of directories, works on it depth first and steals
+    # from the other end of someone else's deque when it runs dry. The
+    # listing of each directory is handed to the consumer as one batch.
+    #
+    #   descend(entry)  decides whether a directory is entered
+    #   select(entry)   decides whether an entry is reported; with
+    #                   processes > 0 it runs on a process pool instead of
+    #                   the crawl threads and has to be picklable
+
+    def __init__(self, workers=CRAWL_WORKERS, descend=None, select=None,
+                 want_stat=False, processes=0, cancelled=None):
+        self.workers = max(1, workers)
+        self.descend = descend
+        self.select = select
+        self.want_stat = want_stat
+        self.processes = processes
+        self.cancelled = cancelled or threading.Event()
+        self.stopped = threading.Event()
+        self.cond = threading.Condition()
+        self.pending = 0
+        self.deques = []
+        self.output = None
+        self.mount = ""
+
+    def cancel(self):
+        self.cancelled.set()
+
+    def entries(self, roots):
+        for path, batch in self.batches(roots):
+            yield from batch
+
+    def batches(self, roots):
+        roots = [os.fspath(x) for x in roots]
+        self.deques = [collections.deque() for _ in range(self.workers)]
+        self.deques[0].extend(roots)
+        self.pending = len(roots)
+        self.output = queue.Queue(self.workers * 16)
+        if not roots:
+            return
+        # Scandir timings are booked to the mount of the first root; a
+        # crawl crossing into another mount is rare enough to live with.
+        self.mount = mount_of(roots[0])
+        metrics.track("crawl_dirs", self.depth)
+        metrics.track("crawl_batches", self.output.qsize)
+        threads = [threading.Thread(target=self._work, args=(own,),
+                                    daemon=True)
+                   for own in self.deques]
+        for thread in threads:
+            thread.start()
+        try:
+            if self.processes and self.select is not None:
+                yield from self._select_in_processes()
+            else:
+                yield from self._drain()
+        finally:
+            self.stopped.set()
+            for thread in threads:
+                thread.join()
+
+    def _drain(self):
+        while True:
+            try:
+                item = self.output.get(timeout=0.1)
+            except queue.Empty:
+                if self.halted():
+                    return
+                continue
+            if item is None:
+                return
+            yield item
+
+    def _select_in_processes(self):
+        ctx = multiprocessing.get_context("spawn")
+        with ProcessPoolExecutor(self.processes, mp_context=ctx) as pool:
+            pending = collections.deque()
+            for path, batch in self._drain():
+                pending.append(
+                    (path, pool.submit(_select_batch, self.select, batch)))
+                while pending and (pending[0][1].done() or
+                                   len(pending) > self.processes * 4):
+                    path, future = pending.popleft()
+                    yield path, future.result()
+            while pending:
+                path, future = pending.popleft()
+                yield path, future.result()
+
+    def _take(self, own):
+        try:
+            return own.pop()
+        except IndexError:
+            pass
+        for other in random.sample(self.deques, len(self.deques)):
+            try:
+                return other.popleft()
+            except IndexError:
+                continue
+        return None
+
+    def depth(self):
+        return self.pending
+
+    def halted(self):
+        return self.cancelled.is_set() or self.stopped.is_set()
+
+    def _work(self, own):
+        while not self.halted():
+            path = self._take(own)
+            if path is None:
+                with self.cond:
+                    if self.pending == 0:
+                        return
+                    self.cond.wait(0.05)
+                continue
+            batch, subdirs = self._scan(path)
+            if self.select is not None and not self.processes:
+                batch = [entry for entry in batch if self.select(entry)]
+            # A directory's batch is queued before its subdirectories can
+            # be picked up, so consumers always see parents first.
+            self._put((path, batch))
+            with self.cond:
+                if subdirs:
+                    self.pending += len(subdirs)
+                    own.extend(subdirs)
+                    self.cond.notify(len(subdirs))
+                self.pending -= 1
+                if self.pending == 0:
+                    self.cond.notify_all()
+                    self._put(None)
+
+    def _put(self, item):
+        while not self.halted():
+            try:
+                self.output.put(item, timeout=0.1)
+                return
+            except queue.Full:
+                continue
+
+    def _scan(self, path):
+        batch = []
+        subdirs = []
+        failed = False
+        started = time.perf_counter()
+        try:
+            with os.scandir(path) as it:
+                for e in it:
+                    try:
+                        is_dir = e.is_dir(follow_symlinks=False)
+                        entry = CrawlEntry(e.path, e.name, is_dir,
+                                           e.is_symlink(), mount=self.mount)
+                        if self.want_stat:
+                            entry.st = e.stat(follow_symlinks=False)
+                        if is_dir and (self.descend is None or
+                                       self.descend(entry)):
+                            entry.descended = True
+                            subdirs.append(e.path)
+                    except OSError:
+                        continue
+                    batch.append(entry)
+        except OSError:
+            failed = True
+        metrics.scanned(self.mount, time.perf_counter() - started, len(batch),
+                        len(batch) if self.want_stat else 0, failed)
+        return batch, subdirs
@@ -0,0 +1,194 @@
+import os
+import hashlib
+import sqlite3
+import stat
+import threading
+import collections
+import multiprocessing
+import mmap
+
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+
+from pathlib import Path
+
+from .archive import ARCHIVE_CHUNK, ARCHIVE_WORKERS
+from .crawl import Crawler, CRAWL_WORKERS
+
+HASH_DB = Path.home() / ".cache" / "file_manager" / "hashes.sqlite"
+PARTIAL_HASH_BYTES = 4096
+
+
+class HashCache:
+    # Content hashes keyed by (dev, inode, size, mtime) so files that did
+    # not change since the last run are never read again.
+
+    def __init__(self, db_path=HASH_DB):
+        Path(db_path).parent.mkdir(parents=True, exist_ok=True)
+        self.con = sqlite3.connect(db_path, timeout=30)
+        self.con.execute("PRAGMA journal_mode=WAL")
+        self.con.execute("""
+            CREATE TABLE IF NOT EXISTS hashes (
+                dev INTEGER, ino INTEGER, size INTEGER, mtime INTEGER,
+                kind TEXT, digest TEXT,
+                PRIMARY KEY (dev, ino, size, mtime, kind))""")
+
+    def close(self):
+        self.con.commit()
+        self.con.close()
+
+    def get(self, st, kind):
+        row = self.con.execute(
+            "SELECT digest FROM hashes WHERE dev = ? AND ino = ? AND "
+            "size = ? AND mtime = ? AND kind = ?",
+            (st.st_dev, st.st_ino, st.st_size, st.st_mtime_ns, kind)
+        ).fetchone()
+        return row[0] if row else None
+
+    def put(self, st, kind, digest):
+        self.con.execute(
+            "INSERT OR REPLACE INTO hashes VALUES (?, ?, ?, ?, ?, ?)",
+            (st.st_dev, st.st_ino, st.st_size, st.st_mtime_ns, kind, digest))
+
+
+def partial_hash(path, size):
+    h = hashlib.blake2b(digest_size=16)
+    try:
+        with open(path, "rb") as f:
+            h.update(f.read(PARTIAL_HASH_BYTES))
+            if size > 2 * PARTIAL_HASH_BYTES:
+                f.seek(-PARTIAL_HASH_BYTES, os.SEEK_END)
+            h.update(f.read(PARTIAL_HASH_BYTES))
+    except OSError:
+        return None
+    return h.hexdigest()
+
+
+def full_hash(path):
+    h = hashlib.blake2b(digest_size=32)
+    try:
+        with open(path, "rb") as f, \
+                mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as mm:
+            view = memoryview(mm)
+            for offset in range(0, len(mm), ARCHIVE_CHUNK):
+                h.update(view[offset:offset + ARCHIVE_CHUNK])
+            view.release()
+    except (OSError, ValueError):
+        return None
+    return h.hexdigest()
+
+
+class DuplicateFinder:
+    # size -> hash of the first and last few KB -> hash of everything.
+    # Each stage only looks at files that still have a twin, hard links to
+    # the same inode count as one file.
+
+    def __init__(self, workers=CRAWL_WORKERS, processes=ARCHIVE_WORKERS,
+                 hash_db=HASH_DB):
+        self.workers = workers
+        self.processes = processes
+        self.hash_db = hash_db
+        self.cancelled = threading.Event()
+        self.stage = ""
+        self.done = 0
+        self.total = 0
+
+    def cancel(self):
+        self.cancelled.set()
+
+    def find(self, paths, progress=None):
+        self.progress = progress
+        by_size = self.group_by_size(paths)
+        cache = HashCache(self.hash_db)
+        try:
+            groups = self.refine(by_size, "partial", cache,
+                                 lambda item: partial_hash(item[0],
+                                                           item[1].st_size))
+            small = [g for g in groups
+                     if g[0][1].st_size <= 2 * PARTIAL_HASH_BYTES]
+            large = [g for g in groups
+                     if g[0][1].st_size > 2 * PARTIAL_HASH_BYTES]
+            large = self.refine(large, "full", cache, None)
+        finally:
+            cache.close()
+        result = [(g[0][1].st_size, sorted(p for p, st in g))
+                  for g in small + large]
+        result.sort(key=lambda x: x[0] * (len(x[1]) - 1), reverse=True)
+        return result
+
+    def report(self, stage, done, total):
+        self.stage, self.done, self.total = stage, done, total
+        if self.progress is not None:
+            self.progress(stage, done, total)
+
+    def group_by_size(self, paths):
+        by_size = collections.defaultdict(list)
+        inodes = set()
+        roots = []
+        count = 0
+        for path in paths:
+            try:
+                st = os.stat(path)
+            except OSError:
+                continue
+            if stat.S_ISDIR(st.st_mode):
+                roots.append(path)
+            elif stat.S_ISREG(st.st_mode):
+                # Same filters as crawled files: a hardlink to a file
+                # already seen frees nothing when deleted.
+                if st.st_size == 0 or (st.st_dev, st.st_ino) in inodes:
+                    continue
+                inodes.add((st.st_dev, st.st_ino))
+                by_size[st.st_size].append((os.fspath(path), st))
+        crawler = Crawler(self.workers, select=lambda e: e.is_file(),
+                          want_stat=True, cancelled=self.cancelled)
+        for entry in crawler.entries(roots):
+            st = entry.st
+            if st.st_size == 0 or (st.st_dev, st.st_ino) in inodes:
+                continue
+            inodes.add((st.st_dev, st.st_ino))
+            by_size[st.st_size].append((entry.path, st))
+            count += 1
+            if count % 1000 == 0:
+                self.report("Scanning", count, 0)
+        return [g for g in by_size.values() if len(g) > 1]
+
+    def refine(self, groups, kind, cache, func):
+        items = [item for group in groups for item in group]
+        digests = {}
+        todo = []
+        for path, st in items:
+            digest = cache.get(st, kind)
+            if digest is None:
+                todo.append((path, st))
+            else:
+                digests[path] = digest
+        stage = "Comparing starts" if kind == "partial" else "Hashing"
+        self.report(stage, len(digests), len(items))
+        if func is None:
+            ctx = multiprocessing.get_context("spawn")
+            pool = ProcessPoolExecutor(self.processes, mp_context=ctx)
+            results = pool.map(full_hash, [p for p, st in todo],
+                               chunksize=4)
+        else:
+            pool = ThreadPoolExecutor(self.workers)
+            results = pool.map(func, todo)
+        try:
+            for (path, st), digest in zip(todo, results):
+                if self.cancelled.is_set():
+                    break
+                if digest is not None:
+                    digests[path] = digest
+                    cache.put(st, kind, digest)
+                self.report(stage, len(digests), len(items))
+        finally:
+            pool.shutdown(wait=True, cancel_futures=True)
+        if self.cancelled.is_set():
+            return []
+        refined = []
+        for group in groups:
+            by_digest = collections.defaultdict(list)
+            for path, st in group:
+                if path in digests:
+                    by_digest[digests[path]].append((path, st))
+            refined.extend(g for g in by_digest.values() if len(g) > 1)
+        return refined
@@ -0,0 +1,123 @@
+import os
+import time
+import threading
+import collections
+
+from concurrent.futures import Future, ThreadPoolExecutor
+
+from .metrics import metrics, mount_of
+
+STAT_WORKERS = 16
+STAT_TTL = 2.0
+STAT_CACHE_ITEMS = 20000
+
+
+class StatService:
+    # stat() on a thread pool, for callers that must not block on a slow
+    # mount. Answers younger than max_age come from a small cache and
+    # concurrent requests for one path share a single call, so a mount
+    # with 100ms round trips is asked once per path, not once per click.
+    # Failed lookups are cached too; pass max_age=0 where a stale answer
+    # could do harm, such as picking a free name for a paste.
+
+    def __init__(self, workers=STAT_WORKERS, ttl=STAT_TTL,
+                 max_items=STAT_CACHE_ITEMS):
+        self.pool = ThreadPoolExecutor(workers, thread_name_prefix="stat")
+        self.ttl = ttl
+        self.max_items = max_items
+        self.lock = threading.Lock()
+        self.cache = collections.OrderedDict()
+        self.inflight = {}
+
+    def stat(self, path, follow_symlinks=True, max_age=None):
+        key = (os.fspath(path), follow_symlinks)
+        max_age = self.ttl if max_age is None else max_age
+        with self.lock:
+            hit = self.cache.get(key)
+            if hit is not None and time.monotonic() - hit[0] < max_age:
+                self.cache.move_to_end(key)
+                return _resolved(hit[1], hit[2])
+            future = self.inflight.get(key)
+            if future is None:
+                future = self.inflight[key] = Future()
+                self.pool.submit(self._stat, key, future)
+        return future
+
+    def exists(self, path, max_age=None):
+        result = Future()
+
+        def done(future):
+            result.set_result(future.exception() is None)
+
+        self.stat(path, max_age=max_age).add_done_callback(done)
+        return result
+
+    def invalidate(self, path):
+        path = os.fspath(path)
+        with self.lock:
+            self.cache.pop((path, True), None)
+            self.cache.pop((path, False), None)
+
+    def apply_events(self, events):
+        # A change below a directory also changes the directory's mtime.
+        for event in events:
+            for path in (event.path, event.dest):
+                if path is not None:
+                    self.invalidate(path)
+                    self.invalidate(os.path.dirname(path))
+
+    def shutdown(self):
+        self.pool.shutdown(wait=False, cancel_futures=True)
+
+    def _stat(self, key, future):
+        st = error = None
+        try:
+            st = os.stat(key[0], follow_symlinks=key[1])
+        except OSError as e:
+            error = e
+        # Booked by folder: neighbours share a cached mount lookup.
+        metrics.stated(mount_of(os.path.dirname(key[0])))
+        with self.lock:
+            self.inflight.pop(key, None)
+            self.cache[key] = (time.monotonic(), st, error)
+            self.cache.move_to_end(key)
+            while len(self.cache) > self.max_items:
+                self.cache.popitem(last=False)
+        if error is not None:
+            future.set_exception(error)
+        else:
+            future.set_result(st)
+
+
+def _resolved(result, error=None):
+    future = Future()
+    if error is not None:
+        future.set_exception(error)
+    else:
+        future.set_result(result)
+    return future
+
+
+def when_all(futures):
+    # Future that completes once every one of futures has, with the list
+    # of them as its result. Failures are left for the caller to inspect.
+    futures = list(futures)
+    result = Future()
+    remaining = [len(futures)]
+    lock = threading.Lock()
+
+    def done(_):
+        with lock:
+            remaining[0] -= 1
+            last = remaining[0] == 0
+        if last:
+            result.set_result(futures)
+
+    if not futures:
+        result.set_result(futures)
+    for future in futures:
+        future.add_done_callback(done)
+    return result
+
+
+stat_service = StatService()
@@ -0,0 +1,253 @@
+import os
+import time
+import json
+import threading
+import collections
+import functools
+import weakref
+
+METRICS_JSONL = None
+METRICS_RECENT = 500
+LATENCY_BUCKETS = (0.01, 0.05, 0.1, 0.5, 1, 5, 10, 60, 300, 1800)
+
+
+@functools.lru_cache(maxsize=1024)
+def mount_of(path):
+    path = os.path.realpath(path)
+    while not os.path.ismount(path):
+        parent = os.path.dirname(path)
+        if parent == path:
+            break
+        path = parent
+    return path
+
+
+class Operation:
+    __slots__ = ("kind", "label", "started", "ended", "status", "bytes",
+                 "files", "wall")
+
+    def __init__(self, kind, label):
+        self.kind = kind
+        self.label = label
+        self.started = time.monotonic()
+        self.wall = time.time()
+        self.ended = None
+        self.status = "running"
+        self.bytes = 0
+        self.files = 0
+
+    def seconds(self):
+        return (self.ended or time.monotonic()) - self.started
+
+    def as_dict(self):
+        return {"kind": self.kind, "label": self.label, "time": self.wall,
+                "seconds": round(self.seconds(), 6), "status": self.status,
+                "bytes": self.bytes, "files": self.files}
+
+
+class Metrics:
+    # Process wide registry. Finished operations feed per-kind totals and a
+    # latency histogram and are kept in a short list for the activity
+    # panel. Scandir and stat work is counted per mount point, so a slow
+    # network mount stands out from the local disks. Queue depths are not
+    # pushed on every change; queues register a callable and are sampled
+    # when a snapshot is taken.
+
+    def __init__(self, jsonl=METRICS_JSONL):
+        self.lock = threading.Lock()
+        self.jsonl = jsonl
+        self.running = set()
+        self.recent = collections.deque(maxlen=METRICS_RECENT)
+        self.ops = collections.defaultdict(
+            lambda: {"count": 0, "seconds": 0.0, "bytes": 0, "files": 0,
+                     "buckets": [0] * (len(LATENCY_BUCKETS) + 1),
+                     "status": collections.Counter()})
+        self.mounts = collections.defaultdict(
+            lambda: {"scandir": 0, "seconds": 0.0, "entries": 0, "stat": 0,
+                     "errors": 0})
+        self.queues = []
+
+    def begin(self, kind, label=""):
+        op = Operation(kind, label)
+        with self.lock:
+            self.running.add(op)
+        return op
+
+    def end(self, op, status="done"):
+        op.ended = time.monotonic()
+        op.status = status
+        seconds = op.ended - op.started
+        with self.lock:
+            self.running.discard(op)
+            self.recent.append(op)
+            totals = self.ops[op.kind]
+            totals["count"] += 1
+            totals["seconds"] += seconds
+            totals["bytes"] += op.bytes
+            totals["files"] += op.files
+            totals["status"][status] += 1
+            for i, bound in enumerate(LATENCY_BUCKETS):
+                if seconds <= bound:
+                    break
+            else:
+                i = len(LATENCY_BUCKETS)
+            totals["buckets"][i] += 1
+            jsonl = self.jsonl
+        if jsonl:
+            self.write_jsonl(jsonl, op)
+
+    def operation(self, kind, label=""):
+        return _Tracked(self, kind, label)
+
+    def scanned(self, mount, seconds, entries, stats, error=False):
+        with self.lock:
+            m = self.mounts[mount]
+            m["scandir"] += 1
+            m["seconds"] += seconds
+            m["entries"] += entries
+            m["stat"] += stats
+            m["errors"] += error
+
+    def stated(self, mount, count=1):
+        with self.lock:
+            self.mounts[mount]["stat"] += count
+
+    def track(self, name, depth):
+        # depth is a bound method; the queue stops being sampled once its
+        # owner is gone. Dead entries are dropped here as well, so a process
+        # running many crawls without ever taking snapshots does not pile
+        # them up.
+        with self.lock:
+            self.queues = [(n, ref) for n, ref in self.queues
+                           if ref() is not None]
+            self.queues.append((name, weakref.WeakMethod(depth)))
+
+    def queue_depths(self):
+        depths = collections.Counter()
+        with self.lock:
+            alive = []
+            for name, ref in self.queues:
+                depth = ref()
+                if depth is None:
+                    continue
+                alive.append((name, ref))
+                depths[name] += 0
+            self.queues = alive
+        for name, ref in alive:
+            depth = ref()
+            if depth is not None:
+                depths[name] += depth()
+        return dict(depths)
+
+    def snapshot(self):
+        with self.lock:
+            running = sorted(self.running, key=lambda op: op.started)
+            recent = list(self.recent)
+            ops = {kind: dict(t, buckets=list(t["buckets"]),
+                              status=dict(t["status"]))
+                   for kind, t in self.ops.items()}
+            mounts = {m: dict(v) for m, v in self.mounts.items()}
+        return {"running": running, "recent": recent, "ops": ops,
+                "mounts": mounts, "queues": self.queue_depths()}
+
+    def write_jsonl(self, path, op):
+        line = json.dumps(op.as_dict()) + "\n"
+        try:
+            with open(path, "a", encoding="utf-8") as f:
+                f.write(line)
+        except OSError:
+            pass
+
+    def prometheus(self):
+        snap = self.snapshot()
+        out = []
+
+        def family(name, kind, help_text):
+            out.append(f"# HELP fm_{name} {help_text}")
+            out.append(f"# TYPE fm_{name} {kind}")
+
+        family("operations_total", "counter", "Finished operations.")
+        for kind, t in snap["ops"].items():
+            for status, count in t["status"].items():
+                out.append(f'fm_operations_total{{kind="{_esc(kind)}",'
+                           f'status="{_esc(status)}"}} {count}')
+        family("operation_seconds", "histogram", "Operation latency.")
+        for kind, t in snap["ops"].items():
+            cumulative = 0
+            for bound, count in zip(LATENCY_BUCKETS + ("+Inf",),
+                                    t["buckets"]):
+                cumulative += count
+                out.append(f'fm_operation_seconds_bucket{{kind="{_esc(kind)}"'
+                           f',le="{bound}"}} {cumulative}')
+            out.append(f'fm_operation_seconds_sum{{kind="{_esc(kind)}"}} '
+                       f'{t["seconds"]:.6f}')
+            out.append(f'fm_operation_seconds_count{{kind="{_esc(kind)}"}} '
+                       f'{t["count"]}')
+        family("operation_bytes_total", "counter", "Bytes processed.")
+        for kind, t in snap["ops"].items():
+            out.append(f'fm_operation_bytes_total{{kind="{_esc(kind)}"}} '
+                       f'{t["bytes"]}')
+        family("operation_files_total", "counter", "Files processed.")
+        for kind, t in snap["ops"].items():
+            out.append(f'fm_operation_files_total{{kind="{_esc(kind)}"}} '
+                       f'{t["files"]}')
+        for key, name, text in (
+                ("scandir", "scandir_total", "Directories listed."),
+                ("seconds", "scandir_seconds_total",
+                 "Time spent listing directories."),
+                ("entries", "scandir_entries_total",
+                 "Directory entries seen."),
+                ("stat", "stat_total", "stat calls."),
+                ("errors", "scandir_errors_total",
+                 "Directories that failed to list.")):
+            family(name, "counter", text)
+            for mount, m in snap["mounts"].items():
+                value = f"{m[key]:.6f}" if key == "seconds" else m[key]
+                out.append(f'fm_{name}{{mount="{_esc(mount)}"}} {value}')
+        family("running_operations", "gauge", "Operations in progress.")
+        running = collections.Counter(op.kind for op in snap["running"])
+        for kind, count in running.items():
+            out.append(f'fm_running_operations{{kind="{_esc(kind)}"}} '
+                       f'{count}')
+        family("queue_depth", "gauge", "Items waiting in work queues.")
+        for name, depth in snap["queues"].items():
+            out.append(f'fm_queue_depth{{queue="{_esc(name)}"}} {depth}')
+        return "\n".join(out) + "\n"
+
+    def write_prometheus(self, path):
+        # Written next to the target and renamed over it, so a textfile
+        # collector never reads half a file.
+        tmp = f"{path}.{os.getpid()}.tmp"
+        with open(tmp, "w", encoding="utf-8") as f:
+            f.write(self.prometheus())
+        os.replace(tmp, path)
+
+
+class _Tracked:
+    def __init__(self, registry, kind, label):
+        self.registry = registry
+        self.kind = kind
+        self.label = label
+        self.op = None
+
+    def __enter__(self):
+        self.op = self.registry.begin(self.kind, self.label)
+        return self.op
+
+    def __exit__(self, exc_type, exc, tb):
+        if exc_type is None or exc_type is GeneratorExit:
+            status = "done" if self.op.status == "running" else self.op.status
+        elif issubclass(exc_type, KeyboardInterrupt):
+            status = "cancelled"
+        else:
+            status = "failed"
+        self.registry.end(self.op, status)
+        return False
+
+
+def _esc(value):
+    return str(value).replace("\\", "\\\\").replace('"', '\\"') \
+        .replace("\n", "\\n")
+
+
+metrics = Metrics()
@@ -0,0 +1,310 @@
+import os
+import re
+import errno
+import datetime
+import array
+import itertools
+
+from .transfer import TransferJob, TransferCancelled
+
+INVALID_NAME = re.compile(r'[<>:"/\\|?*\x00]')
+TEMPLATE_FIELD = re.compile(r'\{\{|\}\}|\{(\w+)(?::([^}]*))?\}')
+TEMPLATE_FIELDS = ("name", "ext", "old", "n", "parent", "mtime")
+CASES = {"lower": str.lower, "upper": str.upper, "title": str.title}
+
+
+class RenameRule:
+    # How a batch rename turns old names into new ones. find/replace is
+    # applied to the whole old name first, as a regex when regex is set
+    # and as plain text otherwise. The result is then put through the
+    # template:
+    #   {name} {ext}     stem and extension (with its dot) of that result,
+    #                    {name:upper}, {name:lower}, {name:title} change case
+    #   {old}            the original name
+    #   {n} {n:3}        counter, optionally zero padded to a width
+    #   {parent}         name of the containing folder
+    #   {mtime} {mtime:%Y%m%d}  modification time, strftime format
+    # {{ and }} are literal braces.
+
+    def __init__(self, template="{name}{ext}", find="", replace="",
+                 regex=False, start=1, step=1):
+        self.template = template
+        self.start = start
+        self.step = step
+        self.replace = replace
+        self.parts = []
+        self.needs_stat = False
+        try:
+            self.find = re.compile(find if regex else re.escape(find)) \
+                if find else None
+            if self.find is not None and regex:
+                # Bad group references only show up on substitution.
+                self.find.sub(replace, "")
+        except (re.error, IndexError) as e:
+            raise ValueError(f"Invalid pattern: {e}") from None
+        if not regex:
+            self.replace = replace.replace("\\", "\\\\")
+        pos = 0
+        for match in TEMPLATE_FIELD.finditer(template):
+            self.parts.append(template[pos:match.start()])
+            pos = match.end()
+            token, field, spec = match.group(0), match.group(1), \
+                match.group(2)
+            if token in ("{{", "}}"):
+                self.parts.append(token[0])
+                continue
+            if field not in TEMPLATE_FIELDS:
+                raise ValueError(f"Unknown field: {{{field}}}")
+            if field in ("name", "ext", "old", "parent") and spec \
+                    and spec not in CASES:
+                raise ValueError(f"Unknown case: {spec}")
+            if field == "n" and spec and not spec.isdigit():
+                raise ValueError(f"Invalid counter width: {spec}")
+            self.needs_stat |= field == "mtime"
+            self.parts.append((field, spec))
+        if "{" in template[pos:] or "}" in template[pos:]:
+            raise ValueError("Unbalanced brace in template")
+        self.parts.append(template[pos:])
+
+    def apply(self, path, number, st=None):
+        old = os.path.basename(path)
+        base = old if self.find is None else self.find.sub(self.replace, old)
+        name, ext = os.path.splitext(base)
+        out = []
+        for part in self.parts:
+            if isinstance(part, str):
+                out.append(part)
+                continue
+            field, spec = part
+            if field == "n":
+                value = str(self.start + number * self.step)
+                out.append(value.zfill(int(spec)) if spec else value)
+            elif field == "mtime":
+                stamp = datetime.datetime.fromtimestamp(st.st_mtime)
+                out.append(stamp.strftime(spec or "%Y-%m-%d"))
+            else:
+                value = {"name": name, "ext": ext, "old": old,
+                         "parent": os.path.basename(os.path.dirname(path))
+                         }[field]
+                out.append(CASES[spec](value) if spec else value)
+        return "".join(out)
+
+
+class RenamePlan:
+    # The renames of one batch. Folders are stored once and each entry
+    # keeps a folder number next to its old and new name, so a plan for
+    # tens of thousands of files does not carry every full path twice.
+    # Entries whose name stays the same are left out.
+
+    def __init__(self):
+        self.dirs = []
+        self.dir_ids = {}
+        self.folder = array.array("I")
+        self.old = []
+        self.new = []
+        self.problems = {}
+
+    @classmethod
+    def build(cls, paths, rule, stats=None):
+        # Paths are numbered for {n} in the order given. stats, a dict of
+        # path -> lstat result, is filled and reused across calls so a
+        # live preview does not stat everything on every keystroke.
+        plan = cls()
+        stats = {} if stats is None else stats
+        for number, path in enumerate(paths):
+            path = os.path.normpath(os.fspath(path))
+            st = None
+            if rule.needs_stat:
+                st = stats.get(path)
+                if st is None:
+                    try:
+                        st = stats[path] = os.lstat(path)
+                    except OSError as e:
+                        raise ValueError(f"{path}: {e.strerror}") from None
+            plan.add(path, rule.apply(path, number, st))
+        return plan
+
+    def add(self, path, new):
+        parent, old = os.path.split(path)
+        parent = parent or os.curdir
+        if new == old:
+            return
+        folder = self.dir_ids.get(parent)
+        if folder is None:
+            folder = self.dir_ids[parent] = len(self.dirs)
+            self.dirs.append(parent)
+        self.folder.append(folder)
+        self.old.append(old)
+        self.new.append(new)
+
+    def __len__(self):
+        return len(self.old)
+
+    def source(self, i):
+        return os.path.join(self.dirs[self.folder[i]], self.old[i])
+
+    def target(self, i):
+        return os.path.join(self.dirs[self.folder[i]], self.new[i])
+
+    def check(self, listdir=os.listdir):
+        # Fills problems with index -> reason and returns whether there
+        # are none. One hash lookup per entry: targets are keyed by
+        # (folder, name), each folder is listed once to find names taken
+        # by files outside the batch.
+        self.problems = {}
+        sources = {(self.folder[i], _key(self.old[i])): i
+                   for i in range(len(self))}
+        targets = {}
+        for i, new in enumerate(self.new):
+            if new in ("", ".", "..") or INVALID_NAME.search(new):
+                self.problems[i] = "invalid name"
+                continue
+            key = (self.folder[i], _key(new))
+            other = targets.setdefault(key, i)
+            if other != i:
+                self.problems[i] = self.problems[other] = \
+                    "same name as another entry"
+        taken = {}
+        unreadable = {}
+        for folder in set(self.folder):
+            try:
+                taken[folder] = {_key(name)
+                                 for name in listdir(self.dirs[folder])}
+            except OSError as e:
+                taken[folder] = set()
+                unreadable[folder] = e.strerror
+        for i, new in enumerate(self.new):
+            key = (self.folder[i], _key(new))
+            if key[0] in unreadable:
+                self.problems.setdefault(i, unreadable[key[0]])
+            elif key[1] in taken[key[0]] and key not in sources and \
+                    _key(self.old[i]) != key[1]:
+                self.problems.setdefault(i, "already exists")
+        return not self.problems
+
+    def steps(self):
+        # (src, dst) renames in an order that never overwrites anything.
+        # A target that is another entry's old name makes that entry go
+        # first, so chains run from their free end backwards; a cycle
+        # such as a -> b, b -> a is broken by parking one entry under a
+        # temporary name. Folders are handled deepest first, chains and
+        # cycles of one depth before anything above it, so renaming a
+        # folder never moves an entry that is still to be renamed.
+        sources = {(self.folder[i], _key(self.old[i])): i
+                   for i in range(len(self))}
+        blocker = {}
+        for i, new in enumerate(self.new):
+            j = sources.get((self.folder[i], _key(new)))
+            if j is not None and j != i:
+                blocker[j] = i
+        blocked = set(blocker.values())
+        done = bytearray(len(self))
+        order = sorted(range(len(self)),
+                       key=lambda i: -self.dirs[self.folder[i]].count(os.sep))
+        steps = []
+        # Blockers share a folder, so a chain or cycle never spans depths.
+        for _, level in itertools.groupby(
+                order, key=lambda i: self.dirs[self.folder[i]].count(os.sep)):
+            level = list(level)
+            for i in level:
+                if done[i] or i in blocked:
+                    continue
+                # i's target is free; walk back along whoever wanted i's
+                # name.
+                while i is not None and not done[i]:
+                    done[i] = 1
+                    steps.append((self.source(i), self.target(i)))
+                    i = blocker.get(i)
+            for i in level:
+                if done[i]:
+                    continue
+                parked = _free_name(self.source(i))
+                steps.append((self.source(i), parked))
+                done[i] = 1
+                j = blocker.get(i)
+                while j is not None and not done[j]:
+                    done[j] = 1
+                    steps.append((self.source(j), self.target(j)))
+                    j = blocker.get(j)
+                steps.append((parked, self.target(i)))
+        return steps
+
+
+def _key(name):
+    return os.path.normcase(name)
+
+
+def _free_name(path):
+    parent, name = os.path.split(path)
+    n = 0
+    while True:
+        candidate = os.path.join(parent, f".{name}.{os.getpid()}.{n}.rename")
+        if not os.path.lexists(candidate):
+            return candidate
+        n += 1
+
+
+class RenameJob(TransferJob):
+    # Applies a checked RenamePlan. Renames that were done are undone in
+    # reverse when one fails or the job is cancelled, so the batch lands
+    # completely or not at all.
+
+    def __init__(self, plan):
+        super().__init__(plan.source(0) if len(plan) else "", "")
+        self.plan = plan
+        self.kind = "rename"
+        self.applied = []
+        self.rollback_errors = []
+
+    def label(self):
+        if len(self.plan) == 1:
+            return f"Rename {self.plan.source(0)} -> {self.plan.new[0]}"
+        return f"Rename {len(self.plan)} items"
+
+    def rate(self):
+        return f"{self.throughput():.0f} items/s"
+
+    def processed(self):
+        return 0, self.done
+
+    def touched(self):
+        return [path for i in range(len(self.plan))
+                for path in (self.plan.source(i), self.plan.target(i))]
+
+    def discard(self):
+        self.rollback()
+
+    def execute(self):
+        steps = self.plan.steps()
+        self.total = len(steps)
+        try:
+            for src, dst in steps:
+                self.checkpoint()
+                # os.rename silently replaces files on POSIX; only a case
+                # change of the same entry may find its target present.
+                if os.path.lexists(dst) and \
+                        not os.path.samestat(os.lstat(src), os.lstat(dst)):
+                    raise FileExistsError(errno.EEXIST, "File exists", dst)
+                os.rename(src, dst)
+                self.applied.append((src, dst))
+                self.done += 1
+                self.files = self.done
+        except TransferCancelled:
+            raise
+        except OSError as e:
+            self.rollback()
+            if self.rollback_errors:
+                path, error = self.rollback_errors[0]
+                raise OSError(f"{e}; {len(self.rollback_errors)} renames "
+                              f"could not be undone, first: {error}") \
+                    from None
+            raise
+
+    def rollback(self):
+        while self.applied:
+            src, dst = self.applied.pop()
+            try:
+                os.rename(dst, src)
+            except OSError as e:
+                self.rollback_errors.append((dst, e))
+        self.done = 0
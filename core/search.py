@@ -0,0 +1,604 @@
+import os
+import re
+import datetime
+import time
+import hashlib
+import sqlite3
+import stat
+import fnmatch
+import shlex
+import queue
+import threading
+
+from pathlib import Path
+
+from .crawl import Crawler, CRAWL_WORKERS
+from .metrics import metrics, mount_of
+
+INDEX_DIR = Path.home() / ".cache" / "file_manager" / "index"
+SEARCH_PROCESSES = 0
+SEARCH_PER_MOUNT = 2
+SEARCH_QUEUE = 4096
+SIZE_UNITS = {"": 1, "B": 1, "K": 1 << 10, "KB": 1 << 10, "M": 1 << 20,
+              "MB": 1 << 20, "G": 1 << 30, "GB": 1 << 30, "T": 1 << 40,
+              "TB": 1 << 40}
+AGE_UNITS = {"s": 1, "m": 60, "h": 3600, "d": 86400, "w": 604800}
+
+
+def parse_size(text):
+    match = re.fullmatch(r'(\d+(?:\.\d+)?)\s*([A-Za-z]*)', text.strip())
+    if match is None or match.group(2).upper() not in SIZE_UNITS:
+        raise ValueError(f"Invalid size: {text}")
+    return int(float(match.group(1)) * SIZE_UNITS[match.group(2).upper()])
+
+
+def parse_time(text, now):
+    match = re.fullmatch(r'(\d+(?:\.\d+)?)([smhdw])', text.strip())
+    if match is not None:
+        return now - float(match.group(1)) * AGE_UNITS[match.group(2)]
+    try:
+        return datetime.datetime.fromisoformat(text.strip()).timestamp()
+    except ValueError:
+        raise ValueError(f"Invalid time: {text}") from None
+
+
+def parse_mtime(text, now):
+    # Ages count back from now, so "mtime:<7d" (less than 7 days old) is a
+    # lower bound on the timestamp while "mtime:<2024-01-01" is an upper one.
+    low, high = parse_range(text, lambda x: x)
+    if low == high:
+        if re.fullmatch(r'[\d.]+[smhdw]', low):
+            return parse_time(low, now), None
+        start = parse_time(low, now)
+        return start, start + 86400
+    bounds = [parse_time(x, now) if x else None for x in (low, high)]
+    if any(x and re.fullmatch(r'[\d.]+[smhdw]', x) for x in (low, high)):
+        bounds.reverse()
+    return bounds
+
+
+def parse_range(text, convert):
+    # "<x", ">x", "a..b" or an exact "x"
+    if text.startswith("<"):
+        return None, convert(text[1:])
+    if text.startswith(">"):
+        return convert(text[1:]), None
+    if ".." in text:
+        low, high = text.split("..", 1)
+        return (convert(low) if low else None,
+                convert(high) if high else None)
+    value = convert(text)
+    return value, value
+
+
+def sqlite_glob(term):
+    # fnmatch pattern in SQLite GLOB syntax. They differ in brackets only:
+    # negation is [!x] in one and [^x] in the other, and an unclosed [ is
+    # literal for fnmatch. None when there is no equivalent, as for
+    # fnmatch's [^x], which matches ^ or x.
+    out = []
+    i = 0
+    while i < len(term):
+        c = term[i]
+        i += 1
+        if c != "[":
+            out.append(c)
+            continue
+        j = i
+        if j < len(term) and term[j] == "!":
+            j += 1
+        if j < len(term) and term[j] == "]":
+            j += 1
+        j = term.find("]", j)
+        if j < 0:
+            out.append("[[]")
+            continue
+        body = term[i:j]
+        i = j + 1
+        if body.startswith("^"):
+            return None
+        if body.startswith("!"):
+            body = "^" + body[1:]
+        out.append(f"[{body}]")
+    return "".join(out)
+
+
+class SearchQuery:
+    # Compiled form of a search string such as
+    #   "*.log size:>10M mtime:<7d exclude:node_modules,.git limit:100"
+    # Plain words match the start of the name, words with * ? [ are globs.
+    keys = ("re", "size", "mtime", "type", "exclude", "case", "limit")
+
+    def __init__(self, text=""):
+        self.text = text
+        self.terms = []
+        self.words = []
+        self.patterns = []
+        self.size_min = self.size_max = None
+        self.mtime_min = self.mtime_max = None
+        self.kind = None
+        self.excluded = []
+        self.limit = None
+        self.case = False
+
+    @classmethod
+    def parse(cls, text, now=None):
+        now = time.time() if now is None else now
+        query = cls(text)
+        regexes = []
+        excluded = []
+        lexer = shlex.shlex(text, posix=True)
+        lexer.whitespace_split = True
+        lexer.escape = ""
+        for token in lexer:
+            key, sep, value = token.partition(":")
+            if not sep or key not in cls.keys:
+                query.terms.append(token)
+            elif key == "re":
+                regexes.append(value)
+            elif key == "size":
+                query.size_min, query.size_max = \
+                    parse_range(value, parse_size)
+            elif key == "mtime":
+                query.mtime_min, query.mtime_max = parse_mtime(value, now)
+            elif key == "type":
+                if value not in ("f", "d", "l"):
+                    raise ValueError(f"Invalid type: {value}")
+                query.kind = value
+            elif key == "exclude":
+                excluded.extend(x for x in value.split(",") if x)
+            elif key == "case":
+                query.case = value.lower() in ("1", "yes", "true", "on")
+            elif key == "limit":
+                if not value.isdigit():
+                    raise ValueError(f"Invalid limit: {value}")
+                query.limit = int(value)
+        flags = 0 if query.case else re.IGNORECASE
+        try:
+            for term in query.terms:
+                if re.search(r'[*?\[]', term):
+                    query.patterns.append(
+                        re.compile(fnmatch.translate(term), flags).match)
+                else:
+                    query.patterns.append(
+                        re.compile(re.escape(term), flags).match)
+                    query.words.append(term if query.case else term.lower())
+            for regex in regexes:
+                query.patterns.append(re.compile(regex, flags).search)
+        except re.error as e:
+            raise ValueError(f"Invalid pattern: {e}") from None
+        query.excluded = [re.compile(fnmatch.translate(x), flags).match
+                          for x in excluded]
+        return query
+
+    def index_hint(self):
+        # The part of the query the filename index can answer by itself,
+        # everything else is checked on the rows it returns.
+        if len(self.terms) != 1:
+            return "prefix", ""
+        term = self.terms[0]
+        if not re.search(r'[*?\[]', term):
+            return "prefix", term
+        pattern = sqlite_glob(term)
+        if pattern is None:
+            return "prefix", ""
+        return ("glob", pattern) if self.case else ("iglob", pattern)
+
+    def needs_stat(self):
+        return self.kind == "l" or self.size_min is not None or \
+            self.size_max is not None or self.mtime_min is not None or \
+            self.mtime_max is not None
+
+    def is_excluded(self, name):
+        return any(match(name) for match in self.excluded)
+
+    def match(self, name, is_dir, get_stat):
+        for pattern in self.patterns:
+            if pattern(name) is None:
+                return False
+        if self.kind == "d" and not is_dir or \
+                self.kind == "f" and is_dir:
+            return False
+        if not self.needs_stat():
+            return True
+        st = get_stat()
+        if self.kind == "l" and not stat.S_ISLNK(st.st_mode):
+            return False
+        if self.size_min is not None or self.size_max is not None:
+            if is_dir:
+                return False
+            if self.size_min is not None and st.st_size < self.size_min:
+                return False
+            if self.size_max is not None and st.st_size > self.size_max:
+                return False
+        if self.mtime_min is not None and st.st_mtime < self.mtime_min:
+            return False
+        if self.mtime_max is not None and st.st_mtime > self.mtime_max:
+            return False
+        return True
+
+    def rank(self, path, root):
+        # Sort key for a hit: names equal to a search word first, then
+        # names whose stem is one, then the rest, shallow paths before
+        # deep ones within each group.
+        name = os.path.basename(path)
+        if not self.case:
+            name = name.lower()
+        if name in self.words:
+            tier = 0
+        elif os.path.splitext(name)[0] in self.words:
+            tier = 1
+        else:
+            tier = 2
+        return tier, path.count(os.sep) - root.count(os.sep), path
+
+    def descend(self, entry):
+        return not self.is_excluded(entry.name)
+
+    def accepts(self, entry):
+        if entry.is_dir() and self.is_excluded(entry.name):
+            return False
+        try:
+            return self.match(entry.name, entry.is_dir(), entry.stat)
+        except OSError:
+            return False
+
+    def walk(self, root, workers=CRAWL_WORKERS, processes=0, cancelled=None,
+             skip=()):
+        # Excluded directories are never entered and, unless the query
+        # filters on size or time, nothing is stat()ed. Directories in skip
+        # are listed but not entered.
+        if skip:
+            skip = frozenset(skip)
+
+            def descend(entry):
+                return entry.path not in skip and self.descend(entry)
+        else:
+            descend = self.descend
+        crawler = Crawler(workers, descend=descend, select=self.accepts,
+                          want_stat=processes > 0 and self.needs_stat(),
+                          processes=processes, cancelled=cancelled)
+        for entry in crawler.entries([root]):
+            yield entry.path
+
+
+class RootIndex:
+    # Per-root SQLite database below db_dir, named by a hash of the root.
+    suffix = ".sqlite"
+
+    @classmethod
+    def db_file(cls, root, db_dir=INDEX_DIR):
+        key = hashlib.sha1(os.path.normpath(root)
+                           .encode("utf-8", "surrogatepass"))
+        return Path(db_dir) / (key.hexdigest() + cls.suffix)
+
+    @classmethod
+    def existing(cls, root, db_dir=INDEX_DIR):
+        # The index of root if one was ever created, without leaving an
+        # empty database behind for roots that are only searched.
+        if not cls.db_file(root, db_dir).exists():
+            return None
+        return cls(root, db_dir)
+
+
+class FileIndex(RootIndex):
+    # One SQLite database per root. Directory mtimes are stored alongside
+    # the entries so refresh() only rescans directories that changed.
+
+    def __init__(self, root, db_dir=INDEX_DIR):
+        self.root = os.path.normpath(root)
+        Path(db_dir).mkdir(parents=True, exist_ok=True)
+        self.db_path = self.db_file(root, db_dir)
+        self.con = sqlite3.connect(self.db_path, timeout=30)
+        self.con.execute("PRAGMA journal_mode=WAL")
+        self.con.execute("PRAGMA synchronous=NORMAL")
+        self.con.executescript("""
+            CREATE TABLE IF NOT EXISTS dirs (
+                path TEXT PRIMARY KEY, mtime INTEGER NOT NULL);
+            CREATE TABLE IF NOT EXISTS entries (
+                name TEXT NOT NULL, lname TEXT NOT NULL,
+                parent TEXT NOT NULL, is_dir INTEGER NOT NULL);
+            CREATE INDEX IF NOT EXISTS entries_lname ON entries (lname);
+            CREATE INDEX IF NOT EXISTS entries_parent ON entries (parent);
+            CREATE TABLE IF NOT EXISTS meta (
+                key TEXT PRIMARY KEY, value TEXT);
+        """)
+
+    def close(self):
+        self.con.close()
+
+    def is_built(self):
+        row = self.con.execute(
+            "SELECT value FROM meta WHERE key = 'built'").fetchone()
+        return row is not None
+
+    def refresh(self, top=None):
+        con = self.con
+        if top is None or os.path.normpath(top) == self.root:
+            top = self.root
+            known = dict(con.execute("SELECT path, mtime FROM dirs"))
+        else:
+            top = os.path.normpath(top)
+            known = dict(con.execute(
+                "SELECT path, mtime FROM dirs WHERE path = ? "
+                "OR (path >= ? AND path < ?)",
+                (top, os.path.join(top, ""),
+                 os.path.join(top, "") + "\U0010ffff")))
+        seen = set()
+        stack = [top]
+        while stack:
+            d = stack.pop()
+            try:
+                mtime = os.stat(d).st_mtime_ns
+            except OSError:
+                continue
+            seen.add(d)
+            if known.get(d) == mtime:
+                stack.extend(os.path.join(d, name) for name, in con.execute(
+                    "SELECT name FROM entries WHERE parent = ? AND is_dir = 1",
+                    (d,)))
+                continue
+            rows = []
+            try:
+                with os.scandir(d) as it:
+                    for entry in it:
+                        try:
+                            is_dir = entry.is_dir(follow_symlinks=False)
+                        except OSError:
+                            is_dir = False
+                        rows.append((entry.name, entry.name.lower(), d,
+                                     int(is_dir)))
+                        if is_dir:
+                            stack.append(entry.path)
+            except OSError:
+                continue
+            con.execute("DELETE FROM entries WHERE parent = ?", (d,))
+            con.executemany("INSERT INTO entries VALUES (?, ?, ?, ?)", rows)
+            con.execute("INSERT OR REPLACE INTO dirs VALUES (?, ?)",
+                        (d, mtime))
+        gone = [(d,) for d in known if d not in seen]
+        con.executemany("DELETE FROM entries WHERE parent = ?", gone)
+        con.executemany("DELETE FROM dirs WHERE path = ?", gone)
+        if top == self.root:
+            con.execute("INSERT OR REPLACE INTO meta VALUES ('built', ?)",
+                        (str(time.time()),))
+        con.commit()
+
+    def apply(self, events):
+        # Watcher events for paths under this root. Only the touched rows
+        # are rewritten, new directories get a refresh of their own subtree.
+        touched = set()
+        created = []
+        for event in events:
+            if event.kind == "rescan":
+                self.refresh(event.path)
+            if event.kind in ("deleted", "renamed"):
+                self.remove(event.path, event.is_dir)
+                touched.add(os.path.dirname(event.path))
+            if event.kind == "created":
+                created.append(event.path)
+            elif event.kind == "renamed":
+                created.append(event.dest)
+        for path in created:
+            if not self.contains(path):
+                continue
+            touched.add(os.path.dirname(path))
+            try:
+                is_dir = stat.S_ISDIR(os.lstat(path).st_mode)
+            except OSError:
+                continue
+            parent, name = os.path.split(path)
+            self.con.execute(
+                "DELETE FROM entries WHERE parent = ? AND name = ?",
+                (parent, name))
+            self.con.execute("INSERT INTO entries VALUES (?, ?, ?, ?)",
+                             (name, name.lower(), parent, int(is_dir)))
+            if is_dir:
+                self.refresh(path)
+        for parent in touched:
+            try:
+                mtime = os.stat(parent).st_mtime_ns
+            except OSError:
+                continue
+            self.con.execute("UPDATE dirs SET mtime = ? WHERE path = ?",
+                             (mtime, parent))
+        self.con.commit()
+
+    def contains(self, path):
+        path = os.path.normpath(path)
+        return path == self.root or path.startswith(os.path.join(self.root,
+                                                                 ""))
+
+    def remove(self, path, is_dir):
+        parent, name = os.path.split(os.path.normpath(path))
+        self.con.execute("DELETE FROM entries WHERE parent = ? AND name = ?",
+                         (parent, name))
+        if is_dir:
+            prefix = os.path.join(path, "")
+            bounds = (path, prefix, prefix + "\U0010ffff")
+            self.con.execute(
+                "DELETE FROM entries WHERE parent = ? "
+                "OR (parent >= ? AND parent < ?)", bounds)
+            self.con.execute(
+                "DELETE FROM dirs WHERE path = ? "
+                "OR (path >= ? AND path < ?)", bounds)
+
+    def search(self, pattern, mode="prefix", limit=-1):
+        if mode == "prefix":
+            low = pattern.lower()
+            cur = self.con.execute(
+                "SELECT parent, name, is_dir FROM entries "
+                "WHERE lname >= ? AND lname < ? LIMIT ?",
+                (low, low + "\U0010ffff", limit))
+        elif mode == "substring":
+            cur = self.con.execute(
+                "SELECT parent, name, is_dir FROM entries "
+                "WHERE instr(lname, ?) > 0 LIMIT ?", (pattern.lower(), limit))
+        elif mode == "glob":
+            cur = self.con.execute(
+                "SELECT parent, name, is_dir FROM entries "
+                "WHERE name GLOB ? LIMIT ?", (pattern, limit))
+        elif mode == "iglob":
+            cur = self.con.execute(
+                "SELECT parent, name, is_dir FROM entries "
+                "WHERE lname GLOB ? LIMIT ?", (pattern.lower(), limit))
+        else:
+            raise ValueError(f"Unknown search mode: {mode}")
+        for parent, name, is_dir in cur:
+            yield parent, name, bool(is_dir)
+
+
+def search(query, root, index_dir=INDEX_DIR, processes=SEARCH_PROCESSES,
+           cancelled=None, skip=()):
+    # Paths below root matching query, answered from the FileIndex when one
+    # has been built for root and by crawling otherwise. Nothing below the
+    # directories in skip is reported. Setting the cancelled event ends
+    # the results early, even while nothing matches. A root that cannot
+    # be listed raises OSError.
+    cancelled = cancelled or threading.Event()
+    os.scandir(root).close()
+    index = FileIndex.existing(root, index_dir)
+    if index is not None and index.is_built():
+        results = _search_index(query, root, index, cancelled, skip)
+    else:
+        results = query.walk(root, processes=processes, cancelled=cancelled,
+                             skip=skip)
+    try:
+        with metrics.operation("search", root) as op:
+            for path in results:
+                op.files += 1
+                yield path
+                if op.files == query.limit:
+                    break
+            if cancelled.is_set():
+                op.status = "cancelled"
+    finally:
+        results.close()
+        if index is not None:
+            index.close()
+
+
+def search_roots(query, roots, cancelled=None, per_mount=SEARCH_PER_MOUNT,
+                 index_dir=INDEX_DIR, processes=SEARCH_PROCESSES, idle=None,
+                 errors=None):
+    # search() over several roots at once, yielding (root, path) in the
+    # order hits come in. No more than per_mount roots on one mount are
+    # crawled at a time, so searches on a single disk do not fight over
+    # its seeks while other disks still run in parallel. A root inside
+    # another one on the same mount is dropped; one on a different mount,
+    # say /home below /, gets a crawl of its own that the outer root
+    # leaves alone. query.limit counts over all roots. Setting cancelled,
+    # or closing the generator, stops every crawl. idle is called while
+    # no hits arrive, so callers can flush what they have. Roots that
+    # fail are appended to errors as (root, exception) and do not stop
+    # the others.
+    cancelled = cancelled or threading.Event()
+    stop = threading.Event()
+    results = queue.Queue(SEARCH_QUEUE)
+    skips = _plan_roots(roots)
+    roots = list(skips)
+    limits = {}
+    for root in roots:
+        if mount_of(root) not in limits:
+            limits[mount_of(root)] = threading.BoundedSemaphore(per_mount)
+
+    def put(item):
+        while not stop.is_set():
+            try:
+                results.put(item, timeout=0.1)
+                return True
+            except queue.Full:
+                continue
+        return False
+
+    def work(root, limit):
+        try:
+            while not limit.acquire(timeout=0.1):
+                if stop.is_set():
+                    return
+            try:
+                for path in search(query, root, index_dir, processes, stop,
+                                   skips[root]):
+                    if not put((root, path)):
+                        return
+            finally:
+                limit.release()
+        except (OSError, sqlite3.Error) as e:
+            if errors is not None:
+                errors.append((root, e))
+        finally:
+            put(None)
+
+    threads = [threading.Thread(target=work,
+                                args=(root, limits[mount_of(root)]),
+                                daemon=True)
+               for root in roots]
+    for thread in threads:
+        thread.start()
+    try:
+        running = len(threads)
+        count = 0
+        while running:
+            if cancelled.is_set():
+                return
+            try:
+                item = results.get(timeout=0.1)
+            except queue.Empty:
+                if idle is not None:
+                    idle()
+                continue
+            if item is None:
+                running -= 1
+                continue
+            yield item
+            count += 1
+            if count == query.limit:
+                return
+    finally:
+        stop.set()
+        for thread in threads:
+            thread.join()
+
+
+def _plan_roots(roots):
+    # {root: roots below it to skip} for search_roots.
+    kept = []
+    for root in sorted({os.path.normpath(r) for r in roots}):
+        outer = [k for k in kept if _below(root, k)]
+        if outer and mount_of(max(outer, key=len)) == mount_of(root):
+            continue
+        kept.append(root)
+    return {root: [k for k in kept if k != root and _below(k, root)]
+            for root in kept}
+
+
+def _lstat(path, mount):
+    try:
+        return os.lstat(path)
+    finally:
+        metrics.stated(mount)
+
+
+def _below(path, root):
+    return path.startswith(os.path.join(root, ""))
+
+
+def _search_index(query, root, index, cancelled, skip=()):
+    mode, pattern = query.index_hint()
+    mount = mount_of(root)
+    skip = [os.path.join(s, "") for s in skip]
+    for parent, name, is_dir in index.search(pattern, mode):
+        if cancelled.is_set():
+            return
+        if skip and os.path.join(parent, "").startswith(tuple(skip)):
+            continue
+        if query.excluded:
+            rel = os.path.relpath(parent, root)
+            if any(query.is_excluded(part) for part in rel.split(os.sep)):
+                continue
+        path = os.path.join(parent, name)
+        try:
+            if query.match(name, is_dir, lambda: _lstat(path, mount)):
+                yield path
+        except OSError:
+            continue
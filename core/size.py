@@ -0,0 +1,271 @@
+import os
+import stat
+import threading
+import time
+import array
+
+from .crawl import Crawler, CRAWL_WORKERS
+from .metrics import metrics
+
+
+def get_size(filepath, workers=CRAWL_WORKERS):
+    return SizeEngine(size_cache, workers).size(filepath)
+
+
+def size_key(st):
+    return st.st_dev, st.st_ino, st.st_mtime_ns
+
+
+class SizeCache:
+    # (bytes, files, dirs) of a subtree keyed by the (dev, inode, mtime)
+    # of its directory. A directory's mtime does not change when something
+    # deeper down does, so paths are remembered too and the watcher drops
+    # every ancestor of a changed path.
+
+    def __init__(self, max_entries=1000000):
+        self.max_entries = max_entries
+        self.data = {}
+        self.paths = {}
+        self.lock = threading.Lock()
+
+    def get(self, key):
+        with self.lock:
+            return self.data.get(key)
+
+    def put(self, key, totals, path=None):
+        with self.lock:
+            if len(self.data) >= self.max_entries:
+                self.data.clear()
+                self.paths.clear()
+            self.data[key] = totals
+            if path is not None:
+                self.paths[path] = key
+
+    def clear(self):
+        with self.lock:
+            self.data.clear()
+            self.paths.clear()
+
+    def invalidate(self, path, subtree=False):
+        path = os.path.normpath(path)
+        with self.lock:
+            current = path
+            while True:
+                self.data.pop(self.paths.pop(current, None), None)
+                parent = os.path.dirname(current)
+                if parent == current:
+                    break
+                current = parent
+            if subtree:
+                prefix = os.path.join(path, "")
+                for sub in [x for x in self.paths if x.startswith(prefix)]:
+                    self.data.pop(self.paths.pop(sub), None)
+
+    def apply_events(self, events):
+        for event in events:
+            gone = event.kind in ("deleted", "renamed", "rescan") and \
+                event.is_dir
+            self.invalidate(event.path, subtree=gone)
+            if event.dest is not None:
+                self.invalidate(event.dest)
+
+
+size_cache = SizeCache()
+
+
+class _SizeNode:
+    __slots__ = ("parent", "key", "path", "size", "files", "dirs",
+                 "pending")
+
+    def __init__(self, parent, key, path):
+        self.parent = parent
+        self.key = key
+        self.path = path
+        self.size = 0
+        self.files = 0
+        self.dirs = 0
+        self.pending = 1
+
+
+class SizeEngine:
+    # Sizes come from a Crawler listing. A directory node is complete once
+    # its own listing and all the subdirectories it descended into have
+    # come back, then its totals are cached and added to the parent.
+    # Directories already in the cache are not entered at all.
+
+    def __init__(self, cache=None, workers=CRAWL_WORKERS):
+        self.cache = cache if cache is not None else SizeCache()
+        self.workers = workers
+        self.lock = threading.Lock()
+        self.done = threading.Event()
+        self.cancelled = threading.Event()
+        self.bytes = 0
+        self.files = 0
+        self.dirs = 0
+        self.queued = 0
+        self.scanned = 0
+        self.started = 0.0
+
+    def cancel(self):
+        self.cancelled.set()
+
+    def snapshot(self):
+        with self.lock:
+            elapsed = time.monotonic() - self.started
+            eta = -1.0
+            if self.scanned and self.queued:
+                eta = self.queued * elapsed / self.scanned
+            elif self.done.is_set():
+                eta = 0.0
+            return self.bytes, self.files, self.dirs, eta
+
+    def descend(self, entry):
+        return self.cache.get(size_key(entry.stat())) is None
+
+    def size(self, path, progress=None, interval=0.2):
+        self.started = time.monotonic()
+        with metrics.operation("size", os.fspath(path)) as op:
+            st = os.stat(path)
+            if not stat.S_ISDIR(st.st_mode):
+                cached = st.st_size, 1, 0
+            else:
+                cached = self.cache.get(size_key(st))
+            if cached is None:
+                path = os.path.normpath(path)
+                self.crawl(path, _SizeNode(None, size_key(st), path),
+                           progress, interval)
+            else:
+                self.bytes, self.files, self.dirs = cached
+            op.bytes, op.files = self.bytes, self.files
+            if self.cancelled.is_set():
+                op.status = "cancelled"
+        self.done.set()
+        if progress is not None:
+            progress(*self.snapshot())
+        return self.bytes
+
+    def crawl(self, path, root, progress, interval):
+        nodes = {path: root}
+        reported = time.monotonic()
+        crawler = Crawler(self.workers, descend=self.descend,
+                          want_stat=True, cancelled=self.cancelled)
+        for dirpath, batch in crawler.batches([path]):
+            node = nodes.pop(dirpath)
+            size = files = dirs = 0
+            for entry in batch:
+                if entry.descended:
+                    nodes[entry.path] = _SizeNode(node, size_key(entry.st),
+                                                  entry.path)
+                    node.pending += 1
+                    dirs += 1
+                elif entry.is_dir():
+                    cached = self.cache.get(size_key(entry.st))
+                    if cached is not None:
+                        size += cached[0]
+                        files += cached[1]
+                        dirs += cached[2] + 1
+                elif entry.is_file():
+                    size += entry.st.st_size
+                    files += 1
+            node.size += size
+            node.files += files
+            node.dirs += dirs
+            with self.lock:
+                self.bytes += size
+                self.files += files
+                self.dirs += dirs
+                self.scanned += 1
+                self.queued = len(nodes)
+            self._finish(node)
+            if progress is not None and \
+                    time.monotonic() - reported >= interval:
+                reported = time.monotonic()
+                progress(*self.snapshot())
+
+    def _finish(self, node):
+        while node is not None:
+            node.pending -= 1
+            if node.pending:
+                return
+            self.cache.put(node.key, (node.size, node.files, node.dirs),
+                           node.path)
+            if node.parent is not None:
+                node.parent.size += node.size
+                node.parent.files += node.files
+                node.parent.dirs += node.dirs
+            node = node.parent
+
+
+class UsageTree:
+    # One node per entry, stored in parallel arrays instead of objects.
+    # Crawler batches arrive parent first, so every directory's children
+    # get one contiguous range of ids and parents always have smaller ids
+    # than their children. Names are kept encoded, back to back in one
+    # blob, and node n's name spans ends[n - 1]:ends[n]; a str per node
+    # would weigh more than all the other arrays together.
+
+    def __init__(self, root):
+        self.root = os.path.normpath(root)
+        self.blob = bytearray(os.fsencode(self.root))
+        self.ends = array.array("Q", [len(self.blob)])
+        self.parent = array.array("q", [-1])
+        self.size = array.array("q", [0])
+        self.files = array.array("q", [0])
+        self.first = array.array("q", [0])
+        self.count = array.array("l", [0])
+        self.is_dir = array.array("b", [1])
+
+    def __len__(self):
+        return len(self.ends)
+
+    def name(self, node):
+        start = self.ends[node - 1] if node else 0
+        return os.fsdecode(bytes(self.blob[start:self.ends[node]]))
+
+    @classmethod
+    def scan(cls, root, workers=CRAWL_WORKERS, cancelled=None,
+             progress=None, interval=0.2):
+        tree = cls(root)
+        pending = {tree.root: 0}
+        reported = time.monotonic()
+        crawler = Crawler(workers, want_stat=True, cancelled=cancelled)
+        for dirpath, batch in crawler.batches([tree.root]):
+            node = pending.pop(dirpath)
+            tree.first[node] = len(tree)
+            tree.count[node] = len(batch)
+            for entry in batch:
+                if entry.descended:
+                    pending[entry.path] = len(tree)
+                is_file = entry.is_file()
+                tree.blob += os.fsencode(entry.name)
+                tree.ends.append(len(tree.blob))
+                tree.parent.append(node)
+                tree.size.append(entry.st.st_size if is_file else 0)
+                tree.files.append(1 if is_file else 0)
+                tree.first.append(0)
+                tree.count.append(0)
+                tree.is_dir.append(1 if entry.is_dir() else 0)
+            if progress is not None and \
+                    time.monotonic() - reported >= interval:
+                reported = time.monotonic()
+                progress(len(tree))
+        tree.aggregate()
+        return tree
+
+    def aggregate(self):
+        parent, size, files = self.parent, self.size, self.files
+        for node in range(len(self) - 1, 0, -1):
+            size[parent[node]] += size[node]
+            files[parent[node]] += files[node]
+
+    def path(self, node):
+        parts = []
+        while node > 0:
+            parts.append(self.name(node))
+            node = self.parent[node]
+        return os.path.join(self.root, *reversed(parts))
+
+    def children(self, node):
+        start = self.first[node]
+        ids = range(start, start + self.count[node])
+        return sorted(ids, key=self.size.__getitem__, reverse=True)
@@ -0,0 +1,501 @@
+import os
+import shutil
+import time
+import stat
+import threading
+import errno
+import hashlib
+
+from concurrent.futures import ThreadPoolExecutor
+
+from send2trash import send2trash
+
+from pathlib import Path
+
+from .crawl import Crawler
+from .metrics import metrics
+from .size import SizeEngine, size_cache
+from .util import format_size
+
+TRANSFER_WORKERS = 2
+COPY_CHUNK = 8 * 1024 * 1024
+DELETE_WORKERS = 8
+
+
+class TransferCancelled(Exception):
+    pass
+
+
+class TransferJob:
+    def __init__(self, src, dst, move=False):
+        self.src = os.fspath(src)
+        self.dst = os.fspath(dst)
+        self.move = move
+        self.kind = "move" if move else "copy"
+        self.state = "queued"
+        self.error = None
+        self.total = 0
+        self.done = 0
+        self.files = 0
+        self.started = None
+        self.ended = None
+        # Set once dst is ours to remove again on cancel.
+        self.created = False
+        self.running = threading.Event()
+        self.running.set()
+        self.cancelled = threading.Event()
+
+    def pause(self):
+        if self.state in ("queued", "running"):
+            self.running.clear()
+
+    def resume(self):
+        self.running.set()
+
+    def cancel(self):
+        self.cancelled.set()
+        self.running.set()
+
+    def is_paused(self):
+        return not self.running.is_set()
+
+    def is_finished(self):
+        return self.state in ("done", "failed", "cancelled")
+
+    def checkpoint(self):
+        self.running.wait()
+        if self.cancelled.is_set():
+            raise TransferCancelled()
+
+    def throughput(self):
+        if self.started is None:
+            return 0.0
+        elapsed = (self.ended or time.monotonic()) - self.started
+        return self.done / elapsed if elapsed > 0 else 0.0
+
+    def label(self):
+        return f"{Path(self.src).name} -> {self.dst}"
+
+    def rate(self):
+        return f"{format_size(self.throughput())}/s"
+
+    def run(self):
+        if self.cancelled.is_set():
+            self.state = "cancelled"
+            return
+        self.running.wait()
+        self.state = "running"
+        self.started = time.monotonic()
+        op = metrics.begin(self.kind, self.label())
+        try:
+            self.execute()
+            self.state = "done"
+        except TransferCancelled:
+            self.discard()
+            self.state = "cancelled"
+        except OSError as e:
+            self.error = e
+            self.state = "failed"
+        except Exception as e:
+            # A bug must not leave the job showing "running" forever.
+            self.error = e
+            self.state = "failed"
+        finally:
+            self.ended = time.monotonic()
+            # Cached sizes are only dropped by the watcher for watched
+            # trees; whatever this job changed is dropped here.
+            for path in self.touched():
+                size_cache.invalidate(path, subtree=True)
+            op.bytes, op.files = self.processed()
+            metrics.end(op, self.state if self.is_finished() else "failed")
+
+    def processed(self):
+        return self.done, self.files
+
+    def touched(self):
+        return [self.src, self.dst] if self.move else [self.dst]
+
+    def execute(self):
+        # Copying a folder into itself would never run out of new
+        # subfolders to copy.
+        if os.path.isdir(self.src) and not os.path.islink(self.src) and \
+                inside(self.dst, self.src):
+            raise OSError(f"{self.dst} is inside {self.src}")
+        # dst is always a new name; an entry found there was not made by
+        # this job and must be neither overwritten nor discarded.
+        if os.path.lexists(self.dst):
+            raise FileExistsError(errno.EEXIST, "File exists", self.dst)
+        self.created = True
+        if self.move and same_filesystem(self.src, self.dst):
+            self.total = self.done = 1
+            os.rename(self.src, self.dst)
+            return
+        self.total = SizeEngine(size_cache).size(self.src)
+        if os.path.isdir(self.src) and not os.path.islink(self.src):
+            copy_tree(self.src, self.dst, self)
+        else:
+            copy_file(self.src, self.dst, self)
+        if self.move:
+            if os.path.isdir(self.src) and not os.path.islink(self.src):
+                shutil.rmtree(self.src)
+            else:
+                os.unlink(self.src)
+
+    def discard(self):
+        if not self.created:
+            return
+        if os.path.isdir(self.dst) and not os.path.islink(self.dst):
+            shutil.rmtree(self.dst, ignore_errors=True)
+        elif os.path.lexists(self.dst):
+            os.unlink(self.dst)
+
+
+class TransferQueue:
+    def __init__(self, workers=TRANSFER_WORKERS):
+        self.pool = ThreadPoolExecutor(workers)
+        self.jobs = []
+        metrics.track("transfers", self.depth)
+
+    def submit(self, job):
+        self.jobs.append(job)
+        self.pool.submit(job.run)
+        return job
+
+    def depth(self):
+        return sum(job.state == "queued" for job in self.jobs)
+
+    def active(self):
+        return [job for job in self.jobs if not job.is_finished()]
+
+    def shutdown(self):
+        for job in self.jobs:
+            job.cancel()
+        self.pool.shutdown(wait=True)
+
+
+def prune_nested(paths):
+    # Sorted by path components, so a directory comes before everything
+    # below it (plain string order would put "/a/b-old" between "/a/b"
+    # and "/a/b/x"), and a path is dropped when one of its ancestors was
+    # kept.
+    kept = []
+    seen = set()
+    for path in sorted(set(os.path.normpath(p) for p in paths),
+                       key=lambda p: Path(p).parts):
+        parents = Path(path).parents
+        if any(os.fspath(parent) in seen for parent in parents):
+            continue
+        seen.add(path)
+        kept.append(path)
+    return kept
+
+
+def inside(path, root):
+    # True when path is root itself or lies below it, symlinks resolved.
+    path = os.path.join(os.path.realpath(path), "")
+    return path.startswith(os.path.join(os.path.realpath(root), ""))
+
+
+def overlapping(a, b):
+    # True when a and b are the same entry or one lies inside the other.
+    return inside(a, b) or inside(b, a)
+
+
+class DeleteJob(TransferJob):
+    def __init__(self, paths, trash=False):
+        self.paths = prune_nested(paths)
+        super().__init__(self.paths[0] if self.paths else "", "")
+        self.trash = trash
+        self.kind = "trash" if trash else "delete"
+        self.failures = []
+        self.lock = threading.Lock()
+
+    def label(self):
+        action = "Move to bin" if self.trash else "Delete"
+        if len(self.paths) == 1:
+            return f"{action} {self.paths[0]}"
+        return f"{action} {len(self.paths)} items"
+
+    def rate(self):
+        return f"{self.throughput():.0f} items/s"
+
+    def processed(self):
+        return 0, self.done
+
+    def touched(self):
+        return self.paths
+
+    def discard(self):
+        pass
+
+    def execute(self):
+        if self.trash:
+            self.total = len(self.paths)
+            for path in self.paths:
+                self.checkpoint()
+                self.attempt(send2trash, path)
+        else:
+            files, dirs = self.collect()
+            self.total = len(files) + len(dirs)
+            with ThreadPoolExecutor(DELETE_WORKERS) as pool:
+                for _ in pool.map(lambda p: self.attempt(os.unlink, p),
+                                  files):
+                    pass
+            for path in reversed(dirs):
+                self.checkpoint()
+                self.attempt(os.rmdir, path)
+        if self.failures:
+            path, error = self.failures[0]
+            raise OSError(f"{len(self.failures)} of {self.total} items "
+                          f"could not be removed, first: {error}")
+
+    def collect(self):
+        # Crawl order lists parents before children, so rmdir in reverse
+        files = []
+        dirs = []
+        for path in self.paths:
+            try:
+                st = os.lstat(path)
+            except OSError as e:
+                self.failures.append((path, e))
+                continue
+            if not stat.S_ISDIR(st.st_mode):
+                files.append(path)
+                continue
+            dirs.append(path)
+            crawler = Crawler(cancelled=self.cancelled)
+            for entry in crawler.entries([path]):
+                (dirs if entry.is_dir() else files).append(entry.path)
+            self.checkpoint()
+        return files, dirs
+
+    def attempt(self, func, path):
+        self.checkpoint()
+        try:
+            func(path)
+        except OSError as e:
+            with self.lock:
+                self.failures.append((path, e))
+        with self.lock:
+            self.done += 1
+            self.files += 1
+
+
+class SyncJob(TransferJob):
+    # Brings an existing dst in line with src and only writes what
+    # differs. Files count as unchanged when size and whole-second mtime
+    # match, like rsync's default; with checksum, files of equal size are
+    # compared by content instead and only get their mtime fixed when the
+    # data matches. Changed files are written to a temporary name and
+    # renamed over the old one. With delete, whatever exists only in dst is
+    # removed after the copy, which makes dst a mirror of src.
+
+    def __init__(self, src, dst, checksum=False, delete=False, move=False):
+        super().__init__(src, dst, move)
+        self.kind = "sync"
+        self.checksum = checksum
+        self.delete = delete
+        self.skipped = 0
+        self.deleted = 0
+        self.partial = None
+
+    def label(self):
+        return f"Sync {Path(self.src).name} -> {self.dst}"
+
+    def discard(self):
+        # dst held data before the job started, so only the file that was
+        # being written goes away.
+        if self.partial is not None and os.path.lexists(self.partial):
+            os.unlink(self.partial)
+
+    def listing(self, root):
+        entries = {}
+        crawler = Crawler(want_stat=True, cancelled=self.cancelled)
+        for entry in crawler.entries([root]):
+            entries[os.path.relpath(entry.path, root)] = entry.stat()
+        self.checkpoint()
+        return entries
+
+    def execute(self):
+        # Syncing a tree onto itself copies nothing and, with move, would
+        # then remove the only copy.
+        if overlapping(self.src, self.dst):
+            raise OSError(f"{self.dst} overlaps {self.src}")
+        if not os.path.isdir(self.dst):
+            os.makedirs(self.dst)
+        src = self.listing(self.src)
+        dst = self.listing(self.dst)
+        copies = []
+        touched = {"."}
+        removed = set()
+        for rel in sorted(src):
+            self.checkpoint()
+            st = src[rel]
+            old = dst.get(rel)
+            target = os.path.join(self.dst, rel)
+            if stat.S_ISDIR(st.st_mode):
+                if old is not None and stat.S_ISDIR(old.st_mode):
+                    continue
+                if old is not None:
+                    self.remove(target, old)
+                    removed.add(rel)
+                os.mkdir(target)
+                touched.add(rel)
+            elif stat.S_ISLNK(st.st_mode):
+                link = os.readlink(os.path.join(self.src, rel))
+                if old is not None and stat.S_ISLNK(old.st_mode) and \
+                        os.readlink(target) == link:
+                    self.skipped += 1
+                    continue
+                if old is not None:
+                    self.remove(target, old)
+                    removed.add(rel)
+                os.symlink(link, target)
+                touched.add(os.path.dirname(rel) or ".")
+            elif old is not None and stat.S_ISREG(old.st_mode) and \
+                    self.unchanged(rel, st, old):
+                self.skipped += 1
+            else:
+                copies.append((rel, st, old))
+        self.total = sum(st.st_size for rel, st, old in copies)
+        for rel, st, old in copies:
+            target = os.path.join(self.dst, rel)
+            if old is not None and not stat.S_ISREG(old.st_mode):
+                self.remove(target, old)
+                removed.add(rel)
+            self.partial = os.path.join(
+                os.path.dirname(target),
+                f".{os.path.basename(target)}.{os.getpid()}.part")
+            copy_file(os.path.join(self.src, rel), self.partial, self)
+            os.replace(self.partial, target)
+            self.partial = None
+            touched.add(os.path.dirname(rel) or ".")
+        if self.delete:
+            for rel in sorted(dst):
+                if rel in src or _under(rel, removed):
+                    continue
+                self.checkpoint()
+                self.remove(os.path.join(self.dst, rel), dst[rel])
+                self.deleted += 1
+                removed.add(rel)
+                touched.add(os.path.dirname(rel) or ".")
+        for rel in sorted(touched, reverse=True):
+            if rel in src or rel == ".":
+                shutil.copystat(os.path.join(self.src, rel),
+                                os.path.join(self.dst, rel))
+        if self.move:
+            shutil.rmtree(self.src)
+
+    def unchanged(self, rel, st, old):
+        if st.st_size != old.st_size:
+            return False
+        if not self.checksum:
+            return st.st_mtime_ns // 10 ** 9 == old.st_mtime_ns // 10 ** 9
+        source = os.path.join(self.src, rel)
+        target = os.path.join(self.dst, rel)
+        if file_digest(source, self) != file_digest(target, self):
+            return False
+        if st.st_mtime_ns != old.st_mtime_ns:
+            shutil.copystat(source, target)
+        return True
+
+    @staticmethod
+    def remove(path, st):
+        if stat.S_ISDIR(st.st_mode):
+            shutil.rmtree(path)
+        else:
+            os.unlink(path)
+
+
+def _under(rel, removed):
+    parent = os.path.dirname(rel)
+    while parent:
+        if parent in removed:
+            return True
+        parent = os.path.dirname(parent)
+    return False
+
+
+def file_digest(path, job):
+    digest = hashlib.blake2b()
+    buf = bytearray(COPY_CHUNK)
+    view = memoryview(buf)
+    with open(path, "rb") as f:
+        while True:
+            job.checkpoint()
+            n = f.readinto(buf)
+            if not n:
+                break
+            digest.update(view[:n])
+    return digest.digest()
+
+
+def same_filesystem(src, dst):
+    try:
+        return os.lstat(src).st_dev == os.stat(os.path.dirname(dst)).st_dev
+    except OSError:
+        return False
+
+
+def copy_tree(src, dst, job):
+    os.makedirs(dst)
+    with os.scandir(src) as it:
+        entries = list(it)
+    for entry in entries:
+        job.checkpoint()
+        target = os.path.join(dst, entry.name)
+        if entry.is_symlink():
+            os.symlink(os.readlink(entry.path), target)
+        elif entry.is_dir():
+            copy_tree(entry.path, target, job)
+        else:
+            copy_file(entry.path, target, job)
+    shutil.copystat(src, dst)
+
+
+def copy_file(src, dst, job):
+    job.checkpoint()
+    with open(src, "rb") as fsrc, open(dst, "wb") as fdst:
+        if not _kernel_copy(fsrc.fileno(), fdst.fileno(), job):
+            buf = bytearray(COPY_CHUNK)
+            view = memoryview(buf)
+            while True:
+                job.checkpoint()
+                n = fsrc.readinto(buf)
+                if not n:
+                    break
+                fdst.write(view[:n])
+                job.done += n
+    shutil.copystat(src, dst)
+    job.files += 1
+
+
+_KERNEL_COPY_FALLBACK = {errno.ENOSYS, errno.EXDEV, errno.EINVAL,
+                         errno.EOPNOTSUPP, errno.ENOTSUP, errno.EBADF}
+
+
+def _kernel_copy(infd, outfd, job):
+    # copy_file_range/sendfile keep the data in the kernel. Either may be
+    # unsupported for a given pair of filesystems, which is only detectable
+    # by trying, so fall through to the next method as long as nothing has
+    # been written yet.
+    for name in ("copy_file_range", "sendfile"):
+        func = getattr(os, name, None)
+        if func is None:
+            continue
+        offset = 0
+        try:
+            while True:
+                job.checkpoint()
+                if name == "sendfile":
+                    n = func(outfd, infd, offset, COPY_CHUNK)
+                else:
+                    n = func(infd, outfd, COPY_CHUNK)
+                if not n:
+                    return True
+                offset += n
+                job.done += n
+        except OSError as e:
+            if offset or e.errno not in _KERNEL_COPY_FALLBACK:
+                raise
+    return False
@@ -0,0 +1,21 @@
+import os
+import stat
+
+
+def format_size(size):
+    if size < 1024:
+        return str(int(size)) + " B"
+    if size > 1048576:
+        return format(size / 1048576, '.2f') + " MB"
+    return format(size / 1024, '.2f') + " KB"
+
+
+def open_regular(path):
+    # Non-blocking open so fifos and devices met during a crawl are skipped
+    # rather than waited on.
+    fd = os.open(path, os.O_RDONLY | getattr(os, "O_NONBLOCK", 0)
+                 | getattr(os, "O_BINARY", 0))
+    if not stat.S_ISREG(os.fstat(fd).st_mode):
+        os.close(fd)
+        return None
+    return os.fdopen(fd, "rb")
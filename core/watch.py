@@ -0,0 +1,347 @@
+import sys
+import os
+import time
+import sqlite3
+import threading
+import errno
+import collections
+import struct
+import queue
+import select
+import ctypes
+import ctypes.util
+
+from .crawl import Crawler
+from .search import FileIndex
+
+WATCH_DELAY = 0.5
+POLL_INTERVAL = 30
+POLL_BUDGET = 0.05
+FsEvent = collections.namedtuple("FsEvent", "kind path is_dir dest",
+                                 defaults=(None,))
+IN_MODIFY = 0x2
+IN_CLOSE_WRITE = 0x8
+IN_MOVED_FROM = 0x40
+IN_MOVED_TO = 0x80
+IN_CREATE = 0x100
+IN_DELETE = 0x200
+IN_DELETE_SELF = 0x400
+IN_MOVE_SELF = 0x800
+IN_Q_OVERFLOW = 0x4000
+IN_IGNORED = 0x8000
+IN_ONLYDIR = 0x1000000
+IN_DONT_FOLLOW = 0x2000000
+IN_ISDIR = 0x40000000
+IN_WATCH_MASK = IN_MODIFY | IN_CLOSE_WRITE | IN_MOVED_FROM | IN_MOVED_TO | \
+    IN_CREATE | IN_DELETE | IN_DELETE_SELF | IN_MOVE_SELF | IN_ONLYDIR | \
+    IN_DONT_FOLLOW
+
+
+class WatchOverflow(Exception):
+    pass
+
+
+class InotifyWatcher:
+    # One inotify watch per directory, added for whole trees at once and
+    # for every directory created later on.
+
+    def __init__(self):
+        if not sys.platform.startswith("linux"):
+            raise OSError(errno.ENOSYS, "inotify is only available on Linux")
+        libc = ctypes.CDLL(ctypes.util.find_library("c"), use_errno=True)
+        self.add_watch = libc.inotify_add_watch
+        self.add_watch.argtypes = [ctypes.c_int, ctypes.c_char_p,
+                                   ctypes.c_uint32]
+        self.rm_watch = libc.inotify_rm_watch
+        self.rm_watch.argtypes = [ctypes.c_int, ctypes.c_int]
+        self.fd = libc.inotify_init1(os.O_NONBLOCK | os.O_CLOEXEC)
+        if self.fd < 0:
+            err = ctypes.get_errno()
+            raise OSError(err, os.strerror(err))
+        self.paths = {}
+        self.wds = {}
+        self.unwatched = []
+
+    def close(self):
+        os.close(self.fd)
+
+    def add_tree(self, root):
+        self.add(root)
+        crawler = Crawler(select=lambda entry: entry.is_dir())
+        try:
+            for entry in crawler.entries([root]):
+                self.add(entry.path)
+        except OSError:
+            self.remove_tree(root)
+            raise
+
+    def add_created(self, root):
+        # Directories appearing while we watch are usually small, and a
+        # burst of them (mkdir -p, an unpacked archive) must not start a
+        # crawler each, so this walks on the reading thread. Trees that
+        # cannot be watched, say because the inotify watch limit is
+        # reached, are left in unwatched for the caller to poll.
+        stack = [root]
+        try:
+            while stack:
+                path = stack.pop()
+                self.add(path)
+                with os.scandir(path) as it:
+                    stack.extend(e.path for e in it
+                                 if e.is_dir(follow_symlinks=False))
+        except FileNotFoundError:
+            pass
+        except OSError:
+            self.remove_tree(root)
+            self.unwatched.append(root)
+
+    def add(self, path):
+        wd = self.add_watch(self.fd, os.fsencode(path), IN_WATCH_MASK)
+        if wd < 0:
+            err = ctypes.get_errno()
+            if err in (errno.ENOENT, errno.ENOTDIR, errno.EACCES):
+                return
+            raise OSError(err, os.strerror(err), path)
+        self.paths[wd] = path
+        self.wds[path] = wd
+
+    def remove_tree(self, root):
+        prefix = os.path.join(root, "")
+        for path in [x for x in self.wds if x == root or x.startswith(prefix)]:
+            wd = self.wds.pop(path)
+            self.paths.pop(wd, None)
+            self.rm_watch(self.fd, wd)
+
+    def rename_tree(self, src, dst):
+        prefix = os.path.join(src, "")
+        for path in [x for x in self.wds if x == src or x.startswith(prefix)]:
+            wd = self.wds.pop(path)
+            new = dst + path[len(src):]
+            self.wds[new] = wd
+            self.paths[wd] = new
+
+    def read(self, timeout):
+        if not select.select([self.fd], [], [], timeout)[0]:
+            return []
+        try:
+            data = os.read(self.fd, 1 << 16)
+        except BlockingIOError:
+            return []
+        events = []
+        moves = {}
+        offset = 0
+        while offset < len(data):
+            wd, mask, cookie, length = struct.unpack_from("iIII", data, offset)
+            name = os.fsdecode(data[offset + 16:offset + 16 + length]
+                               .rstrip(b"\0"))
+            offset += 16 + length
+            if mask & IN_Q_OVERFLOW:
+                raise WatchOverflow()
+            if mask & IN_IGNORED:
+                path = self.paths.pop(wd, None)
+                if path is not None and self.wds.get(path) == wd:
+                    del self.wds[path]
+                continue
+            parent = self.paths.get(wd)
+            if parent is None or mask & (IN_DELETE_SELF | IN_MOVE_SELF):
+                continue
+            path = os.path.join(parent, name)
+            is_dir = bool(mask & IN_ISDIR)
+            if mask & IN_CREATE:
+                events.append(FsEvent("created", path, is_dir))
+                if is_dir:
+                    self.add_created(path)
+            elif mask & IN_DELETE:
+                events.append(FsEvent("deleted", path, is_dir))
+            elif mask & IN_MOVED_FROM:
+                moves[cookie] = len(events)
+                events.append(FsEvent("deleted", path, is_dir))
+            elif mask & IN_MOVED_TO:
+                index = moves.pop(cookie, None)
+                if index is None:
+                    events.append(FsEvent("created", path, is_dir))
+                    if is_dir:
+                        self.add_created(path)
+                else:
+                    src = events[index].path
+                    events[index] = FsEvent("renamed", src, is_dir, path)
+                    if is_dir:
+                        self.rename_tree(src, path)
+            elif mask & (IN_MODIFY | IN_CLOSE_WRITE):
+                events.append(FsEvent("modified", path, is_dir))
+        for index in moves.values():
+            if events[index].is_dir:
+                self.remove_tree(events[index].path)
+        return events
+
+
+class PollingWatcher:
+    # Fallback for trees inotify can't watch. Like FileIndex.refresh it
+    # keeps only directory mtimes: every interval each directory is
+    # stat'ed again and one whose mtime moved is reported as a rescan of
+    # that folder, new folders found in it are added. A round is spread
+    # over read() calls of at most `budget` seconds each so the watcher
+    # thread keeps serving inotify and dispatching meanwhile. Files
+    # rewritten in place leave their folder's mtime alone and go unseen.
+
+    def __init__(self, interval=POLL_INTERVAL, budget=POLL_BUDGET):
+        self.interval = interval
+        self.budget = budget
+        self.mtimes = {}
+        self.due = collections.deque()
+        self.polled = time.monotonic()
+
+    def close(self):
+        self.mtimes.clear()
+        self.due.clear()
+
+    def add_tree(self, root):
+        stack = [root]
+        while stack:
+            path = stack.pop()
+            try:
+                self.mtimes[path] = os.stat(path).st_mtime_ns
+                with os.scandir(path) as it:
+                    stack.extend(e.path for e in it
+                                 if e.is_dir(follow_symlinks=False))
+            except OSError:
+                continue
+
+    def remove_tree(self, root):
+        prefix = os.path.join(root, "")
+        for path in [x for x in self.mtimes
+                     if x == root or x.startswith(prefix)]:
+            del self.mtimes[path]
+
+    def read(self, timeout):
+        if not self.due:
+            if time.monotonic() - self.polled < self.interval:
+                time.sleep(timeout)
+                return []
+            self.polled = time.monotonic()
+            self.due.extend(self.mtimes)
+        events = []
+        end = time.monotonic() + self.budget
+        while self.due and time.monotonic() < end:
+            path = self.due.popleft()
+            if path not in self.mtimes:
+                continue
+            try:
+                mtime = os.stat(path).st_mtime_ns
+            except OSError:
+                # gone; its parent's mtime moved and reports it
+                del self.mtimes[path]
+                continue
+            if mtime == self.mtimes[path]:
+                continue
+            self.mtimes[path] = mtime
+            events.append(FsEvent("rescan", path, True))
+            try:
+                with os.scandir(path) as it:
+                    created = [e.path for e in it
+                               if e.is_dir(follow_symlinks=False)
+                               and e.path not in self.mtimes]
+            except OSError:
+                continue
+            for new in created:
+                self.add_tree(new)
+        return events
+
+
+class FsWatcher(threading.Thread):
+    # Watches roots with inotify where it can and polling where it can't,
+    # coalesces what it sees for `delay` seconds and hands the batch to
+    # every handler, on this thread.
+
+    def __init__(self, handlers=(), delay=WATCH_DELAY):
+        super().__init__(daemon=True)
+        self.handlers = list(handlers)
+        self.delay = delay
+        self.requests = queue.Queue()
+        self.stopped = threading.Event()
+        self.roots = set()
+        try:
+            self.inotify = InotifyWatcher()
+        except (OSError, AttributeError, TypeError):
+            self.inotify = None
+        self.poller = PollingWatcher()
+
+    def watch(self, root):
+        self.requests.put(os.path.normpath(root))
+
+    def stop(self):
+        self.stopped.set()
+
+    def add_root(self, root):
+        if root in self.roots:
+            return
+        self.roots.add(root)
+        if self.inotify is not None:
+            try:
+                self.inotify.add_tree(root)
+                return
+            except OSError:
+                pass
+        self.poller.add_tree(root)
+
+    def run(self):
+        pending = []
+        first = None
+        while not self.stopped.is_set():
+            while not self.requests.empty():
+                self.add_root(self.requests.get())
+            events = []
+            try:
+                if self.inotify is not None:
+                    events += self.inotify.read(0.2)
+                    while self.inotify.unwatched:
+                        self.poller.add_tree(self.inotify.unwatched.pop())
+                else:
+                    time.sleep(0.2)
+            except WatchOverflow:
+                # the kernel dropped events, nothing under the roots can
+                # be trusted any more
+                events += [FsEvent("rescan", root, True)
+                           for root in self.roots]
+            events += self.poller.read(0)
+            if events:
+                pending += events
+                first = first or time.monotonic()
+            if pending and time.monotonic() - first >= self.delay:
+                self.dispatch(pending)
+                pending, first = [], None
+        if self.inotify is not None:
+            self.inotify.close()
+        self.poller.close()
+
+    def dispatch(self, events):
+        for handler in self.handlers:
+            try:
+                handler(events)
+            except (OSError, sqlite3.Error):
+                continue
+
+
+class IndexUpdater:
+    # Watcher handler keeping the filename indexes of watched roots in
+    # step. The FileIndex connections belong to the watcher thread.
+
+    def __init__(self):
+        self.roots = set()
+        self.indexes = {}
+
+    def add(self, root):
+        self.roots.add(os.path.normpath(root))
+
+    def __call__(self, events):
+        for root in list(self.roots):
+            prefix = os.path.join(root, "")
+            mine = [e for e in events
+                    if e.path == root and e.kind == "rescan" or
+                    e.path.startswith(prefix) or
+                    e.dest is not None and e.dest.startswith(prefix)]
+            if not mine:
+                continue
+            if root not in self.indexes:
+                self.indexes[root] = FileIndex(root)
+            self.indexes[root].apply(mine)
@@ -1,49 +1,206 @@
 import sys
 import os
-import shutil
 import re
 import datetime
 import time
-
-from send2trash import send2trash
+import hashlib
+import sqlite3
+import threading
+import collections
+import functools
+import zipfile
+import heapq
+import stat
+
+from concurrent.futures import ThreadPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
 
 from pathlib import Path
 
 from PyQt5 import QtCore, QtWidgets, QtGui
 from PyQt5.QtWidgets import QApplication, QMainWindow, QMessageBox, \
                             QInputDialog, QTreeView, QWidget, QVBoxLayout, \
-                            QLabel, QLineEdit, QHBoxLayout, QListWidget
+                            QLabel, QLineEdit, QHBoxLayout, QListWidget, \
+                            QListView, QPushButton, QProgressBar
 from PyQt5.QtCore import QDir, Qt, QThread, pyqtSignal
 
+from core.archive import ArchiveJob, ExtractJob, MemberCache, zip_index, \
+    ARCHIVE_LEVELS
+from core.content import ContentIndex, search_content, CONTENT_LIMIT
+from core.duplicates import DuplicateFinder
+from core.metadata import stat_service, when_all
+from core.metrics import metrics, METRICS_RECENT
+from core.search import SearchQuery, FileIndex, search_roots
+from core.rename import RenameRule, RenamePlan, RenameJob
+from core.size import SizeEngine, UsageTree, size_cache
+from core.transfer import TransferJob, TransferQueue, DeleteJob, SyncJob, \
+    inside
+from core.util import format_size, open_regular
+from core.watch import FsWatcher, IndexUpdater
 from ui import main
 
+SEARCH_BATCH = 1000
+RENAME_PREVIEW_DELAY = 200
+PASTE_COPY_NAMES = 10
+SEARCH_FLUSH_INTERVAL = 0.1
+DISK_USAGE_ROWS = 200
+PREVIEW_CACHE_DIR = Path.home() / ".cache" / "file_manager" / "previews"
+PREVIEW_CACHE_BYTES = 256 * 1024 * 1024
+PREVIEW_WORKERS = min(4, os.cpu_count() or 1)
+PREVIEW_MEMORY_ITEMS = 2000
+PREVIEW_TEXT_BYTES = 16 * 1024
+PREVIEW_MEMBERS = 500
+PREVIEW_SIZE = 512
+THUMBNAIL_SIZE = 64
+
+
+class SearchResultsModel(QtCore.QAbstractListModel):
+    def __init__(self):
+        super().__init__()
+        self.paths = []
+        self.labels = []
+        self.keys = []
+
+    def rowCount(self, parent=QtCore.QModelIndex()):
+        return 0 if parent.isValid() else len(self.paths)
+
+    def data(self, index, role=Qt.DisplayRole):
+        if index.isValid() and role == Qt.DisplayRole:
+            return self.labels[index.row()]
+        return None
+
+    def add(self, items):
+        # Items are plain paths, or (path, label) pairs when the row shows
+        # more than the path, e.g. a matching line from a content search.
+        start = len(self.paths)
+        self.beginInsertRows(QtCore.QModelIndex(), start,
+                             start + len(items) - 1)
+        for item in items:
+            path, label = item if isinstance(item, tuple) else (item, item)
+            self.paths.append(path.replace('\\', '/'))
+            self.labels.append(label.replace('\\', '/'))
+        self.endInsertRows()
+
+    def clear(self):
+        self.beginResetModel()
+        self.paths = []
+        self.labels = []
+        self.keys = []
+        self.endResetModel()
+
+    def add_ranked(self, items):
+        # (key, path) pairs. They are appended as they stream in and put in
+        # key order once by sort_ranked(); keeping every row sorted while a
+        # big search runs costs a list insert per batch on the GUI thread.
+        start = len(self.paths)
+        self.beginInsertRows(QtCore.QModelIndex(), start,
+                             start + len(items) - 1)
+        for key, path in items:
+            path = path.replace('\\', '/')
+            self.keys.append(key)
+            self.paths.append(path)
+            self.labels.append(path)
+        self.endInsertRows()
+
+    def sort_ranked(self):
+        if not self.keys:
+            return
+        self.layoutAboutToBeChanged.emit()
+        order = sorted(range(len(self.keys)), key=self.keys.__getitem__)
+        self.keys = [self.keys[i] for i in order]
+        self.paths = [self.paths[i] for i in order]
+        self.labels = [self.labels[i] for i in order]
+        # Selection and current row follow their item to its new row.
+        moved = [0] * len(order)
+        for row, i in enumerate(order):
+            moved[i] = row
+        old = self.persistentIndexList()
+        self.changePersistentIndexList(
+            old, [self.index(moved[i.row()]) for i in old])
+        self.layoutChanged.emit()
+
 
 class SearchResults(QWidget):
     clicked = pyqtSignal(str)
 
-    def __init__(self, filename, rootpath):
+    def __init__(self, search_worker, stale=False):
         super().__init__()
 
-        self.list_view = QListWidget()
+        self.model = SearchResultsModel()
+        self.list_view = QListView()
+        self.list_view.setModel(self.model)
+        self.list_view.setUniformItemSizes(True)
+        self.list_view.setLayoutMode(QListView.Batched)
+        self.list_view.setBatchSize(1000)
+        self.list_view.setEditTriggers(QListView.NoEditTriggers)
+        self.count_label = QLabel("Searching...")
 
-        self.list_view.itemClicked.connect(self.selected)
+        self.list_view.clicked.connect(self.selected)
         self.setMinimumWidth(1000)
         vbox = QVBoxLayout()
         vbox.addWidget(self.list_view)
+        vbox.addWidget(self.count_label)
         self.setLayout(vbox)
 
-        self.search_worker = Searcher(filename, rootpath)
+        # Set while the results may come from an index that is still being
+        # refreshed; the search runs again here once the refresh is done.
+        self.stale = stale
+        self.search_worker = search_worker
+        self.search_worker.found.connect(self.add)
+        self.search_worker.finished.connect(self.finished)
+        self.search_worker.start()
+
+    def restart(self, search_worker):
+        self.search_worker.found.disconnect(self.add)
+        self.search_worker.finished.disconnect(self.finished)
+        self.stale = False
+        self.model.clear()
+        self.count_label.setText("Index refreshed, searching again...")
+        self.search_worker = search_worker
         self.search_worker.found.connect(self.add)
         self.search_worker.finished.connect(self.finished)
         self.search_worker.start()
 
-    def add(self, item):
-        self.list_view.addItem(item.replace('\\', '/'))
+    def drop_stale(self):
+        # A newer search took over; no second run will come.
+        self.stale = False
+        if self.search_worker.isFinished():
+            self.count_label.setText(
+                f"{len(self.model.paths)} found, index may be out of date")
 
-    def selected(self, item):
-        self.clicked.emit(item.text())
+    def add(self, items):
+        # Batches the previous worker queued before a restart are dropped.
+        if self.sender() is not self.search_worker:
+            return
+        if self.search_worker.ranked:
+            self.model.add_ranked(items)
+        else:
+            self.model.add(items)
+        self.count_label.setText(f"Searching... {len(self.model.paths)} found")
+
+    def selected(self, index):
+        self.clicked.emit(self.model.paths[index.row()])
 
     def finished(self):
+        if self.sender() is not self.search_worker:
+            return
+        if self.search_worker.ranked:
+            self.model.sort_ranked()
+        if self.search_worker.cancelled.is_set():
+            self.count_label.setText(
+                f"Cancelled, {len(self.model.paths)} found")
+            return
+        self.count_label.setText(f"{len(self.model.paths)} found")
+        if self.search_worker.errors:
+            self.count_label.setText(
+                f"{len(self.model.paths)} found, could not search "
+                + ", ".join(f"{root} ({getattr(e, 'strerror', None) or e})"
+                            for root, e in self.search_worker.errors))
+        if self.stale:
+            self.count_label.setText(
+                f"{len(self.model.paths)} found, index is being refreshed, "
+                "searching again when done...")
+            return
         info = QMessageBox(self)
         info.setIcon(QMessageBox.Information)
         info.setWindowTitle("Error")
@@ -51,108 +208,1199 @@ class SearchResults(QWidget):
         info.show()
 
     def closeEvent(self, a0: QtGui.QCloseEvent) -> None:
-        self.search_worker.terminate()
+        self.search_worker.cancel()
+
+
+def format_time(timestamp):
+    return datetime.datetime.fromtimestamp(timestamp) \
+        .strftime("%Y-%m-%d %H:%M:%S")
+
+
+class FutureDispatcher(QtCore.QObject):
+    # Runs callbacks for concurrent.futures on the GUI thread. The future
+    # completes on a pool thread, the queued signal brings the callback
+    # over to the thread this object lives in.
+    call = pyqtSignal(object, object)
+
+    def __init__(self):
+        super().__init__()
+        self.call.connect(self.invoke)
+
+    def then(self, future, callback):
+        future.add_done_callback(lambda f: self.call.emit(callback, f))
+
+    def invoke(self, callback, future):
+        callback(future)
 
 
 class AttributeWindow(QWidget):
-    def __init__(self, file, filesize):
+    cancelled = pyqtSignal()
+
+    def __init__(self, file, filesize=0):
         super().__init__()
         self.filename = file.name
         self.filepath = file
         self.filesize = filesize
-        self.init_vars()
         self.init_ui()
 
-    def init_vars(self):
-        stats = self.filepath.stat()
-        self.modification_date = stats.st_mtime
-        self.access_date = stats.st_atime
+    def set_stat(self, future):
+        # Filled in once the stat service answers, the window is shown
+        # straight away even on a slow mount.
+        try:
+            stats = future.result()
+        except OSError as e:
+            self.status.setText(f"Can't read attributes: {e.strerror}")
+            return
+        self.modification_value.setText(format_time(stats.st_mtime))
+        self.access_value.setText(format_time(stats.st_atime))
 
     def init_ui(self):
         self.layout = QVBoxLayout(self)
         self.setWindowTitle(self.filename)
         filesize_label = QLabel("Size:")
-        filesize_real = format(self.filesize / 1024, '.2f') + " KB"
-        if self.filesize > 1048576:
-            filesize_real = format(self.filesize / 1048576, '.2f') + " MB"
-        if self.filesize < 1024:
-            filesize_real = str(self.filesize) + " B"
-        filesize_value = QLineEdit(filesize_real)
-        filesize_value.setEnabled(False)
+        self.filesize_value = QLineEdit(format_size(self.filesize))
+        self.filesize_value.setEnabled(False)
         first_row = QHBoxLayout()
         first_row.addWidget(filesize_label)
-        first_row.addWidget(filesize_value)
+        first_row.addWidget(self.filesize_value)
         self.layout.addLayout(first_row)
 
-        modification_date_string = datetime.datetime. \
-            fromtimestamp(self.modification_date).strftime("%Y-%m-%d %H:%M:%S")
-        access_date_string = datetime.datetime. \
-            fromtimestamp(self.access_date).strftime("%Y-%m-%d %H:%M:%S")
+        contents_label = QLabel("Contains:")
+        self.contents_value = QLineEdit("")
+        self.contents_value.setEnabled(False)
+        contents_row = QHBoxLayout()
+        contents_row.addWidget(contents_label)
+        contents_row.addWidget(self.contents_value)
+        self.layout.addLayout(contents_row)
 
         modification_date_label = QLabel("Last Modified:")
-        modification_date_value = QLineEdit(modification_date_string)
-        modification_date_value.setEnabled(False)
+        self.modification_value = QLineEdit("...")
+        self.modification_value.setEnabled(False)
         second_row = QHBoxLayout()
         second_row.addWidget(modification_date_label)
-        second_row.addWidget(modification_date_value)
+        second_row.addWidget(self.modification_value)
         self.layout.addLayout(second_row)
 
         access_date_label = QLabel("Last Accessed:")
-        access_date_value = QLineEdit(access_date_string)
-        access_date_value.setEnabled(False)
+        self.access_value = QLineEdit("...")
+        self.access_value.setEnabled(False)
         third_row = QHBoxLayout()
         third_row.addWidget(access_date_label)
-        third_row.addWidget(access_date_value)
+        third_row.addWidget(self.access_value)
         self.layout.addLayout(third_row)
 
+        self.status = QLabel("Calculating size...")
+        self.stop_button = QPushButton("Stop")
+        self.stop_button.clicked.connect(self.stop)
+        status_row = QHBoxLayout()
+        status_row.addWidget(self.status)
+        status_row.addWidget(self.stop_button)
+        self.layout.addLayout(status_row)
+
+    def update_progress(self, size, files, dirs, eta):
+        self.filesize = size
+        self.filesize_value.setText(format_size(size))
+        self.contents_value.setText(f"{files} files, {dirs} folders")
+        if eta > 0:
+            self.status.setText(f"Calculating size... ~{eta:.0f} s left")
+
+    def set_size(self, size):
+        self.filesize = size
+        self.filesize_value.setText(format_size(size))
+        self.status.setText("Done")
+        self.stop_button.hide()
+
+    def stop(self):
+        self.cancelled.emit()
+        self.status.setText("Stopped, size is partial")
+        self.stop_button.hide()
+
+    def closeEvent(self, a0: QtGui.QCloseEvent) -> None:
+        self.cancelled.emit()
+
+
+class TransferRow(QWidget):
+    def __init__(self, job):
+        super().__init__()
+        self.job = job
+        self.label = QLabel(job.label())
+        self.progress = QProgressBar()
+        self.progress.setRange(0, 1000)
+        self.info = QLabel("")
+        self.pause_button = QPushButton("Pause")
+        self.pause_button.clicked.connect(self.toggle_pause)
+        self.cancel_button = QPushButton("Cancel")
+        self.cancel_button.clicked.connect(job.cancel)
+        row = QHBoxLayout()
+        row.addWidget(self.progress)
+        row.addWidget(self.info)
+        row.addWidget(self.pause_button)
+        row.addWidget(self.cancel_button)
+        vbox = QVBoxLayout()
+        vbox.addWidget(self.label)
+        vbox.addLayout(row)
+        self.setLayout(vbox)
+
+    def toggle_pause(self):
+        if self.job.is_paused():
+            self.job.resume()
+        else:
+            self.job.pause()
+
+    def refresh(self):
+        job = self.job
+        if job.total:
+            self.progress.setValue(int(min(job.done / job.total, 1) * 1000))
+        self.pause_button.setText("Resume" if job.is_paused() else "Pause")
+        if job.state == "running":
+            text = job.rate()
+            if job.is_paused():
+                text = "Paused"
+        elif job.state == "failed":
+            text = f"Failed: {job.error}"
+        else:
+            text = job.state.capitalize()
+        self.info.setText(text)
+        if job.is_finished():
+            if job.state == "done":
+                self.progress.setValue(1000)
+            self.pause_button.hide()
+            self.cancel_button.hide()
+
+
+class TransferWindow(QWidget):
+    def __init__(self, queue):
+        super().__init__()
+        self.queue = queue
+        self.rows = {}
+        self.setWindowTitle("Transfers")
+        self.setMinimumWidth(700)
+        self.vbox = QVBoxLayout()
+        self.vbox.addStretch()
+        self.setLayout(self.vbox)
+        self.timer = QtCore.QTimer(self)
+        self.timer.timeout.connect(self.refresh)
+        self.timer.start(200)
+
+    def refresh(self):
+        for job in self.queue.jobs:
+            if job not in self.rows:
+                self.rows[job] = TransferRow(job)
+                self.vbox.insertWidget(self.vbox.count() - 1, self.rows[job])
+            self.rows[job].refresh()
+
+
+class ActivityWindow(QWidget):
+    def __init__(self):
+        super().__init__()
+        self.setWindowTitle("Activity")
+        self.setMinimumSize(900, 500)
+        self.ops = QtWidgets.QTreeWidget()
+        self.ops.setHeaderLabels(["Operation", "Target", "Status", "Time",
+                                  "Files", "Size", "Rate"])
+        self.ops.setRootIsDecorated(False)
+        self.ops.setColumnWidth(1, 300)
+        self.mounts = QtWidgets.QTreeWidget()
+        self.mounts.setHeaderLabels(["Mount", "Listings", "Avg listing",
+                                     "Entries", "stat calls", "Errors"])
+        self.mounts.setRootIsDecorated(False)
+        self.queues = QLabel()
+        export = QPushButton("Export Prometheus...")
+        export.clicked.connect(self.export)
+        self.log_button = QPushButton()
+        self.log_button.clicked.connect(self.toggle_log)
+        buttons = QHBoxLayout()
+        buttons.addWidget(self.queues, 1)
+        buttons.addWidget(self.log_button)
+        buttons.addWidget(export)
+        vbox = QVBoxLayout()
+        vbox.addWidget(self.ops, 2)
+        vbox.addWidget(self.mounts, 1)
+        vbox.addLayout(buttons)
+        self.setLayout(vbox)
+        self.timer = QtCore.QTimer(self)
+        self.timer.timeout.connect(self.refresh)
+
+    def showEvent(self, a0: QtGui.QShowEvent) -> None:
+        self.refresh()
+        self.timer.start(500)
+
+    def hideEvent(self, a0: QtGui.QHideEvent) -> None:
+        self.timer.stop()
+
+    def refresh(self):
+        snap = metrics.snapshot()
+        ops = snap["running"] + snap["recent"][::-1]
+        self.ops.clear()
+        for op in ops[:METRICS_RECENT]:
+            seconds = op.seconds()
+            rate = op.bytes / seconds if seconds > 0 else 0
+            self.ops.addTopLevelItem(QtWidgets.QTreeWidgetItem([
+                op.kind, op.label, op.status, f"{seconds:.2f} s",
+                str(op.files), format_size(op.bytes),
+                f"{format_size(rate)}/s" if op.bytes else ""]))
+        self.mounts.clear()
+        for mount, m in sorted(snap["mounts"].items()):
+            avg = m["seconds"] / m["scandir"] * 1000 if m["scandir"] else 0
+            self.mounts.addTopLevelItem(QtWidgets.QTreeWidgetItem([
+                mount, str(m["scandir"]), f"{avg:.2f} ms", str(m["entries"]),
+                str(m["stat"]), str(m["errors"])]))
+        depths = ", ".join(f"{name}: {depth}" for name, depth
+                           in sorted(snap["queues"].items()))
+        self.queues.setText(f"Running: {len(snap['running'])}   "
+                            f"Queues: {depths or 'idle'}")
+        self.log_button.setText("Stop JSON log" if metrics.jsonl
+                                else "Log JSON lines...")
+
+    def export(self):
+        path, _ = QtWidgets.QFileDialog.getSaveFileName(
+            self, "Export metrics", "file_manager.prom",
+            "Prometheus text (*.prom)")
+        if path:
+            try:
+                metrics.write_prometheus(path)
+            except OSError as e:
+                QMessageBox.warning(self, "Error", str(e))
+
+    def toggle_log(self):
+        if metrics.jsonl:
+            metrics.jsonl = None
+        else:
+            path, _ = QtWidgets.QFileDialog.getSaveFileName(
+                self, "Log operations", "file_manager.jsonl",
+                "JSON lines (*.jsonl)")
+            metrics.jsonl = path or None
+        self.refresh()
+
+
+class ArchiveBrowser(QWidget):
+    extract = pyqtSignal(list)
+
+    def __init__(self, file):
+        super().__init__()
+        self.setWindowTitle(Path(file).name)
+        self.setMinimumWidth(700)
+        with zipfile.ZipFile(file) as zf:
+            self.names = zf.namelist()
+        self.filter_edit = QLineEdit()
+        self.filter_edit.setPlaceholderText("Filter")
+        self.filter_edit.textChanged.connect(self.apply_filter)
+        self.list_view = QListWidget()
+        self.list_view.setSelectionMode(QListWidget.ExtendedSelection)
+        self.list_view.addItems(self.names)
+        extract_selected = QPushButton("Extract selected")
+        extract_selected.clicked.connect(self.extract_selected)
+        extract_all = QPushButton("Extract all")
+        extract_all.clicked.connect(lambda: self.extract.emit([]))
+        buttons = QHBoxLayout()
+        buttons.addWidget(QLabel(f"{len(self.names)} entries"))
+        buttons.addWidget(extract_selected)
+        buttons.addWidget(extract_all)
+        vbox = QVBoxLayout()
+        vbox.addWidget(self.filter_edit)
+        vbox.addWidget(self.list_view)
+        vbox.addLayout(buttons)
+        self.setLayout(vbox)
+
+    def apply_filter(self, text):
+        text = text.lower()
+        for row in range(self.list_view.count()):
+            item = self.list_view.item(row)
+            item.setHidden(text not in item.text().lower())
+
+    def extract_selected(self):
+        names = [item.text() for item in self.list_view.selectedItems()]
+        if names:
+            self.extract.emit(names)
+
+
+class _ZipNode:
+    __slots__ = ("parent", "name", "key", "is_dir", "info", "row",
+                 "children")
+
+    def __init__(self, parent, name, key, is_dir, info, row):
+        self.parent = parent
+        self.name = name
+        self.key = key
+        self.is_dir = is_dir
+        self.info = info
+        self.row = row
+        self.children = None
+
+
+class ZipModel(QtCore.QAbstractItemModel):
+    headers = ("Name", "Size", "Type", "Date Modified")
+
+    def __init__(self, path):
+        super().__init__()
+        self.archive = os.fspath(path).replace("\\", "/")
+        self.zip_index = zip_index(path)
+        self.root = _ZipNode(None, "", "", True, None, 0)
+        self.icons = QtWidgets.QFileIconProvider()
+
+    def node(self, index):
+        if index.isValid():
+            return index.internalPointer()
+        return self.root
+
+    def children(self, node):
+        if node.children is None:
+            node.children = [
+                _ZipNode(node, name, node.key + name + ("/" if is_dir else ""),
+                         is_dir, info, row)
+                for row, (name, is_dir, info)
+                in enumerate(self.zip_index.list(node.key))]
+        return node.children
+
+    def index(self, row, column, parent=QtCore.QModelIndex()):
+        node = self.node(parent)
+        if not node.is_dir or not 0 <= column < len(self.headers):
+            return QtCore.QModelIndex()
+        children = self.children(node)
+        if not 0 <= row < len(children):
+            return QtCore.QModelIndex()
+        return self.createIndex(row, column, children[row])
+
+    def parent(self, index=None):
+        if index is None:
+            return super().parent()
+        if not index.isValid():
+            return QtCore.QModelIndex()
+        node = index.internalPointer().parent
+        if node is None or node is self.root:
+            return QtCore.QModelIndex()
+        return self.createIndex(node.row, 0, node)
+
+    def rowCount(self, parent=QtCore.QModelIndex()):
+        if parent.column() > 0:
+            return 0
+        node = self.node(parent)
+        return len(self.children(node)) if node.is_dir else 0
+
+    def columnCount(self, parent=QtCore.QModelIndex()):
+        return len(self.headers)
+
+    def hasChildren(self, parent=QtCore.QModelIndex()):
+        node = self.node(parent)
+        return node.is_dir and bool(self.zip_index.children.get(node.key))
+
+    def flags(self, index):
+        if not index.isValid():
+            return Qt.NoItemFlags
+        return Qt.ItemIsEnabled | Qt.ItemIsSelectable
+
+    def headerData(self, section, orientation, role=Qt.DisplayRole):
+        if orientation == Qt.Horizontal and role == Qt.DisplayRole:
+            return self.headers[section]
+        return None
+
+    def data(self, index, role=Qt.DisplayRole):
+        if not index.isValid():
+            return None
+        node = index.internalPointer()
+        column = index.column()
+        if role == Qt.DecorationRole and column == 0:
+            kind = QtWidgets.QFileIconProvider.Folder if node.is_dir \
+                else QtWidgets.QFileIconProvider.File
+            return self.icons.icon(kind)
+        if role != Qt.DisplayRole:
+            return None
+        if column == 0:
+            return node.name
+        if column == 1:
+            return "" if node.is_dir else format_size(node.info.file_size)
+        if column == 2:
+            if node.is_dir:
+                return "Folder"
+            suffix = Path(node.name).suffix
+            return suffix[1:] + " File" if suffix else "File"
+        if column == 3 and node.info is not None:
+            return datetime.datetime(*node.info.date_time) \
+                .strftime("%Y-%m-%d %H:%M:%S")
+        return None
+
+    def filePath(self, index):
+        key = self.node(index).key.rstrip("/")
+        return self.archive + "/" + key if key else self.archive
+
+    def member(self, index):
+        return self.node(index).key
+
+    def isDir(self, index):
+        return self.node(index).is_dir
+
+    def contains(self, path):
+        path = path.replace("\\", "/").rstrip("/")
+        return path == self.archive or path.startswith(self.archive + "/")
+
+    def path_index(self, path):
+        path = path.replace("\\", "/").rstrip("/")
+        index = QtCore.QModelIndex()
+        for name in path[len(self.archive):].split("/"):
+            if not name:
+                continue
+            for node in self.children(self.node(index)):
+                if node.name == name:
+                    index = self.createIndex(node.row, 0, node)
+                    break
+            else:
+                return QtCore.QModelIndex()
+        return index
+
+
+def open_path(path):
+    if hasattr(os, "startfile"):
+        os.startfile(path)
+    else:
+        QtGui.QDesktopServices.openUrl(QtCore.QUrl.fromLocalFile(str(path)))
+
+
+class DuplicateWorker(QThread):
+    progress = pyqtSignal(str, int, int)
+    finished = pyqtSignal(list)
+    failed = pyqtSignal(str)
+
+    def __init__(self, paths):
+        super(DuplicateWorker, self).__init__()
+        self.paths = paths
+        self.finder = DuplicateFinder()
+
+    def cancel(self):
+        self.finder.cancel()
+
+    def run(self) -> None:
+        try:
+            groups = self.finder.find(self.paths, self.progress.emit)
+        except (OSError, sqlite3.Error, BrokenProcessPool) as e:
+            # Not an empty result: "0 groups" would read as no duplicates.
+            if not self.finder.cancelled.is_set():
+                self.failed.emit(str(e) or type(e).__name__)
+            return
+        if not self.finder.cancelled.is_set():
+            self.finished.emit(groups)
+
+
+class DuplicatesWindow(QWidget):
+    clicked = pyqtSignal(str)
+
+    def __init__(self, paths):
+        super().__init__()
+        self.setWindowTitle("Duplicates")
+        self.setMinimumWidth(1000)
+        self.tree = QtWidgets.QTreeWidget()
+        self.tree.setHeaderLabels(["File", "Size"])
+        self.tree.setColumnWidth(0, 800)
+        self.tree.itemClicked.connect(self.selected)
+        self.status = QLabel("Scanning...")
+        vbox = QVBoxLayout()
+        vbox.addWidget(self.tree)
+        vbox.addWidget(self.status)
+        self.setLayout(vbox)
+
+        self.worker = DuplicateWorker(paths)
+        self.worker.progress.connect(self.update_progress)
+        self.worker.finished.connect(self.show_groups)
+        self.worker.failed.connect(
+            lambda error: self.status.setText(f"Scan failed: {error}"))
+        self.worker.start()
+
+    def update_progress(self, stage, done, total):
+        if total:
+            self.status.setText(f"{stage}... {done} / {total}")
+        else:
+            self.status.setText(f"{stage}... {done} files")
+
+    def show_groups(self, groups):
+        wasted = 0
+        for size, paths in groups:
+            wasted += size * (len(paths) - 1)
+            group = QtWidgets.QTreeWidgetItem(
+                [f"{len(paths)} copies", format_size(size)])
+            for path in paths:
+                group.addChild(QtWidgets.QTreeWidgetItem(
+                    [path.replace('\\', '/'), format_size(size)]))
+            self.tree.addTopLevelItem(group)
+        self.status.setText(f"{len(groups)} groups, "
+                            f"{format_size(wasted)} in extra copies")
+
+    def selected(self, item):
+        if item.parent() is not None:
+            self.clicked.emit(item.text(0))
+
+    def closeEvent(self, a0: QtGui.QCloseEvent) -> None:
+        self.worker.cancel()
+        self.worker.wait()
+
+
+class DiskUsageWorker(QThread):
+    progress = pyqtSignal(int)
+    finished = pyqtSignal(object)
+
+    def __init__(self, root):
+        super(DiskUsageWorker, self).__init__()
+        self.root = root
+        self.cancelled = threading.Event()
+
+    def cancel(self):
+        self.cancelled.set()
+
+    def run(self) -> None:
+        tree = UsageTree.scan(self.root, cancelled=self.cancelled,
+                              progress=self.progress.emit)
+        if not self.cancelled.is_set():
+            self.finished.emit(tree)
+
+
+class DiskUsageWindow(QWidget):
+    clicked = pyqtSignal(str)
+
+    def __init__(self, root):
+        super().__init__()
+        self.tree = None
+        self.setWindowTitle("Disk usage - " + root)
+        self.setMinimumSize(900, 600)
+        self.view = QtWidgets.QTreeWidget()
+        self.view.setHeaderLabels(["Name", "Size", "%", "Files"])
+        self.view.setColumnWidth(0, 500)
+        self.view.itemExpanded.connect(self.expand)
+        self.view.itemDoubleClicked.connect(self.selected)
+        self.status = QLabel("Scanning...")
+        vbox = QVBoxLayout()
+        vbox.addWidget(self.view)
+        vbox.addWidget(self.status)
+        self.setLayout(vbox)
+
+        self.worker = DiskUsageWorker(root)
+        self.worker.progress.connect(
+            lambda n: self.status.setText(f"Scanning... {n} entries"))
+        self.worker.finished.connect(self.show_tree)
+        self.worker.start()
+
+    def show_tree(self, tree):
+        self.tree = tree
+        self.status.setText(f"{len(tree)} entries, "
+                            f"{format_size(tree.size[0])}")
+        item = self.make_item(0, tree.size[0])
+        self.view.addTopLevelItem(item)
+        item.setExpanded(True)
+
+    def make_item(self, node, total):
+        tree = self.tree
+        share = tree.size[node] * 100 / total if total else 0
+        item = QtWidgets.QTreeWidgetItem([
+            tree.name(node), format_size(tree.size[node]),
+            format(share, '.1f'), str(tree.files[node])])
+        item.setData(0, Qt.UserRole, node)
+        if tree.count[node]:
+            item.setChildIndicatorPolicy(
+                QtWidgets.QTreeWidgetItem.ShowIndicator)
+        return item
+
+    def expand(self, item):
+        node = item.data(0, Qt.UserRole)
+        if node is None or item.childCount():
+            return
+        total = self.tree.size[node]
+        children = self.tree.children(node)
+        for child in children[:DISK_USAGE_ROWS]:
+            item.addChild(self.make_item(child, total))
+        rest = children[DISK_USAGE_ROWS:]
+        if rest:
+            size = sum(self.tree.size[x] for x in rest)
+            item.addChild(QtWidgets.QTreeWidgetItem(
+                [f"{len(rest)} more", format_size(size),
+                 format(size * 100 / total if total else 0, '.1f'), ""]))
+
+    def selected(self, item):
+        node = item.data(0, Qt.UserRole)
+        if node is not None:
+            self.clicked.emit(self.tree.path(node).replace('\\', '/'))
+
+    def closeEvent(self, a0: QtGui.QCloseEvent) -> None:
+        self.worker.cancel()
+        self.worker.wait()
+
+
+class RenamePreviewModel(QtCore.QAbstractTableModel):
+    headers = ("Name", "New name", "Problem")
+
+    def __init__(self):
+        super().__init__()
+        self.plan = RenamePlan()
+
+    def set_plan(self, plan):
+        self.beginResetModel()
+        self.plan = plan
+        self.endResetModel()
+
+    def rowCount(self, parent=QtCore.QModelIndex()):
+        return 0 if parent.isValid() else len(self.plan)
+
+    def columnCount(self, parent=QtCore.QModelIndex()):
+        return 0 if parent.isValid() else len(self.headers)
+
+    def headerData(self, section, orientation, role=Qt.DisplayRole):
+        if orientation == Qt.Horizontal and role == Qt.DisplayRole:
+            return self.headers[section]
+        return None
+
+    def data(self, index, role=Qt.DisplayRole):
+        if not index.isValid():
+            return None
+        row = index.row()
+        if role == Qt.DisplayRole:
+            if index.column() == 0:
+                return self.plan.old[row]
+            if index.column() == 1:
+                return self.plan.new[row]
+            return self.plan.problems.get(row, "")
+        if role == Qt.ForegroundRole and row in self.plan.problems:
+            return QtGui.QBrush(Qt.red)
+        if role == Qt.ToolTipRole and index.column() == 0:
+            return self.plan.source(row)
+        return None
+
+
+class BatchRenameDialog(QtWidgets.QDialog):
+    # The plan is rebuilt shortly after the user stops typing and shown
+    # in full; Rename stays disabled while any entry has a problem.
+
+    def __init__(self, paths, parent=None):
+        super().__init__(parent)
+        self.paths = paths
+        self.plan = None
+        self.stats = {}
+        self.setWindowTitle(f"Rename {len(paths)} items")
+        self.setMinimumSize(900, 600)
+        self.template = QLineEdit("{name}{ext}")
+        self.template.setToolTip(
+            "{name} {ext} {old} {parent} {n} {n:3} {mtime} {mtime:%Y%m%d}, "
+            "{name:upper} {name:lower} {name:title}")
+        self.find = QLineEdit()
+        self.replace = QLineEdit()
+        self.regex = QtWidgets.QCheckBox("Regular expression")
+        self.start = QtWidgets.QSpinBox()
+        self.start.setRange(0, 10 ** 9)
+        self.start.setValue(1)
+        form = QtWidgets.QFormLayout()
+        form.addRow("New name", self.template)
+        form.addRow("Find", self.find)
+        form.addRow("Replace with", self.replace)
+        form.addRow("", self.regex)
+        form.addRow("Counter starts at", self.start)
+        self.model = RenamePreviewModel()
+        self.view = QtWidgets.QTableView()
+        self.view.setModel(self.model)
+        self.view.verticalHeader().hide()
+        self.view.verticalHeader().setDefaultSectionSize(
+            self.view.fontMetrics().height() + 4)
+        self.view.horizontalHeader().setStretchLastSection(True)
+        self.view.setColumnWidth(0, 350)
+        self.view.setColumnWidth(1, 350)
+        self.status = QLabel()
+        self.buttons = QtWidgets.QDialogButtonBox(
+            QtWidgets.QDialogButtonBox.Cancel)
+        self.rename_button = self.buttons.addButton(
+            "Rename", QtWidgets.QDialogButtonBox.AcceptRole)
+        self.buttons.accepted.connect(self.accept)
+        self.buttons.rejected.connect(self.reject)
+        vbox = QVBoxLayout()
+        vbox.addLayout(form)
+        vbox.addWidget(self.view)
+        vbox.addWidget(self.status)
+        vbox.addWidget(self.buttons)
+        self.setLayout(vbox)
+        self.timer = QtCore.QTimer(self)
+        self.timer.setSingleShot(True)
+        self.timer.timeout.connect(self.update_plan)
+        for edit in (self.template, self.find, self.replace):
+            edit.textChanged.connect(self.schedule)
+        self.regex.toggled.connect(self.schedule)
+        self.start.valueChanged.connect(self.schedule)
+        self.update_plan()
+
+    def schedule(self):
+        self.timer.start(RENAME_PREVIEW_DELAY)
+
+    def update_plan(self):
+        try:
+            rule = RenameRule(self.template.text(), self.find.text(),
+                              self.replace.text(), self.regex.isChecked(),
+                              self.start.value())
+            plan = RenamePlan.build(self.paths, rule, self.stats)
+        except ValueError as e:
+            self.plan = None
+            self.model.set_plan(RenamePlan())
+            self.status.setText(str(e))
+            self.rename_button.setEnabled(False)
+            return
+        ok = plan.check()
+        self.plan = plan if ok and len(plan) else None
+        self.model.set_plan(plan)
+        if not ok:
+            text = f"{len(plan.problems)} of {len(plan)} names have a problem"
+        else:
+            text = f"{len(plan)} of {len(self.paths)} items get a new name"
+        self.status.setText(text)
+        self.rename_button.setEnabled(self.plan is not None)
+
+    def accept(self):
+        if self.timer.isActive():
+            self.timer.stop()
+            self.update_plan()
+        if self.plan is not None:
+            super().accept()
+
+
+class ThumbnailDelegate(QtWidgets.QStyledItemDelegate):
+    # Image rows get their thumbnail as icon. Only painted rows ask the
+    # loader for one, which is what keeps the work to the visible area.
+
+    def __init__(self, loader, parent=None):
+        super(ThumbnailDelegate, self).__init__(parent)
+        self.loader = loader
+        self.pixmaps = {}
+
+    def thumbnail_path(self, index):
+        model = index.model()
+        if index.column() != 0 or \
+                not isinstance(model, QtWidgets.QFileSystemModel):
+            return None
+        path = model.filePath(index)
+        if os.path.splitext(path)[1].lower() not in image_suffixes():
+            return None
+        return path
+
+    def paint(self, painter, option, index):
+        path = self.thumbnail_path(index)
+        if path is not None and not self.loader.lookup(path, "thumb")[0]:
+            self.loader.request(path, "thumb", option.rect.top())
+        super(ThumbnailDelegate, self).paint(painter, option, index)
+
+    def initStyleOption(self, option, index):
+        super(ThumbnailDelegate, self).initStyleOption(option, index)
+        path = self.thumbnail_path(index)
+        if path is None:
+            return
+        loaded, image = self.loader.lookup(path, "thumb")
+        if not loaded or image is None:
+            return
+        pixmap = self.pixmaps.get(path)
+        if pixmap is None or pixmap[0] is not image:
+            if len(self.pixmaps) > PREVIEW_MEMORY_ITEMS:
+                self.pixmaps.clear()
+            pixmap = self.pixmaps[path] = (image,
+                                           QtGui.QPixmap.fromImage(image))
+        option.icon = QtGui.QIcon(pixmap[1])
+
+
+class PreviewPane(QWidget):
+    def __init__(self, loader):
+        super().__init__()
+        self.loader = loader
+        self.path = None
+        self.title = QLabel()
+        self.title.setWordWrap(True)
+        self.image = QLabel()
+        self.image.setAlignment(Qt.AlignCenter)
+        self.text = QtWidgets.QPlainTextEdit()
+        self.text.setReadOnly(True)
+        self.text.setLineWrapMode(QtWidgets.QPlainTextEdit.NoWrap)
+        self.text.setFont(QtGui.QFontDatabase.systemFont(
+            QtGui.QFontDatabase.FixedFont))
+        vbox = QVBoxLayout()
+        vbox.addWidget(self.title)
+        vbox.addWidget(self.image, 1)
+        vbox.addWidget(self.text, 1)
+        self.setLayout(vbox)
+        self.loader.ready.connect(self.loaded)
+        self.show_path(None)
+
+    def show_path(self, path, is_dir=False):
+        # is_dir comes from the model; anything else that is not a regular
+        # file is left to the loader, nothing is stat'ed here.
+        self.path = path
+        self.title.setText(os.path.basename(path) if path else "")
+        self.image.hide()
+        self.text.hide()
+        if path is None or is_dir:
+            return
+        loaded, value = self.loader.lookup(path, "preview")
+        if loaded:
+            self.display(value)
+        else:
+            self.title.setText(os.path.basename(path) + " (loading...)")
+            self.loader.request(path, "preview", -1)
+
+    def loaded(self, path, kind):
+        if kind == "preview" and path == self.path:
+            self.title.setText(os.path.basename(path))
+            self.display(self.loader.lookup(path, kind)[1])
+
+    def display(self, value):
+        if isinstance(value, QtGui.QImage):
+            pixmap = QtGui.QPixmap.fromImage(value)
+            size = self.image.size()
+            if pixmap.width() > size.width() or \
+                    pixmap.height() > size.height():
+                pixmap = pixmap.scaled(size, Qt.KeepAspectRatio,
+                                       Qt.SmoothTransformation)
+            self.image.setPixmap(pixmap)
+            self.image.show()
+        elif value:
+            self.text.setPlainText(value)
+            self.text.show()
+
 
 class SizeWorker(QThread):
+    progress = pyqtSignal(float, int, int, float)
     finished = pyqtSignal(float)
 
     def __init__(self, file):
         super(SizeWorker, self).__init__()
         self.file = file
+        self.engine = SizeEngine(size_cache)
+
+    def cancel(self):
+        self.engine.cancel()
 
     def run(self) -> None:
         size = 0
-        if self.file.is_file():
-            size = self.file.stat().st_size
-        elif self.file.is_dir():
-            size = round(get_size(self.file), 3)
-        self.finished.emit(size)
+        try:
+            size = round(self.engine.size(self.file, self.progress.emit), 3)
+        except OSError:
+            pass
+        if not self.engine.cancelled.is_set():
+            self.finished.emit(size)
 
 
 class Searcher(QThread):
-    found = pyqtSignal(str)
+    found = pyqtSignal(list)
     finished = pyqtSignal()
+    ranked = True
 
-    def __init__(self, name, root):
+    def __init__(self, query, roots):
         super(Searcher, self).__init__()
-        self.name = name
+        self.query = query
+        self.roots = roots
+        self.cancelled = threading.Event()
+        self.errors = []
+        self.count = 0
+        self.batch = []
+        self.flushed = 0.0
+
+    def report(self, path):
+        self.batch.append(path)
+        self.count += 1
+        if len(self.batch) >= SEARCH_BATCH:
+            self.flush()
+
+    def tick(self):
+        if time.monotonic() - self.flushed >= SEARCH_FLUSH_INTERVAL:
+            self.flush()
+
+    def flush(self):
+        if self.batch:
+            self.found.emit(self.batch)
+            self.batch = []
+        self.flushed = time.monotonic()
+
+    def cancel(self):
+        self.cancelled.set()
+
+    def run(self) -> None:
+        self.flushed = time.monotonic()
+        results = search_roots(self.query, self.roots, self.cancelled,
+                               idle=self.tick, errors=self.errors)
+        try:
+            for root, path in results:
+                self.report((self.query.rank(path, root), path))
+                self.tick()
+        finally:
+            results.close()
+        self.flush()
+        self.finished.emit()
+
+
+class IndexWorker(QThread):
+    finished = pyqtSignal(str)
+
+    def __init__(self, root):
+        super(IndexWorker, self).__init__()
+        self.root = root
+
+    def run(self) -> None:
+        index = FileIndex(self.root)
+        try:
+            index.refresh()
+        except sqlite3.Error:
+            pass
+        finally:
+            index.close()
+        self.finished.emit(self.root)
+
+
+class ContentIndexWorker(QThread):
+    finished = pyqtSignal(str)
+
+    def __init__(self, root):
+        super(ContentIndexWorker, self).__init__()
+        self.root = root
+
+    def run(self) -> None:
+        index = ContentIndex(self.root)
+        try:
+            index.refresh()
+        except (sqlite3.Error, OSError):
+            pass
+        finally:
+            index.close()
+        self.finished.emit(self.root)
+
+
+class ContentSearcher(Searcher):
+    ranked = False
+
+    def __init__(self, text, root, limit=CONTENT_LIMIT):
+        super(ContentSearcher, self).__init__(text, [root])
         self.root = root
+        self.limit = limit
 
     def run(self) -> None:
-        for path, dirs, files in os.walk(self.root):
-            for d in dirs:
-                if self.name == d:
-                    self.found.emit(path)
-            for f in files:
-                if str(f).startswith(self.name):
-                    self.found.emit(path)
+        self.flushed = time.monotonic()
+        results = search_content(self.query, self.root, idle=self.tick,
+                                 cancelled=self.cancelled)
+        try:
+            for path, line, offset, text in results:
+                self.report((path, f"{path}:{line}:{offset}: {text}"))
+                self.tick()
+                if self.count == self.limit:
+                    break
+        except OSError as e:
+            self.errors.append((self.root, e))
+        finally:
+            results.close()
+        self.flush()
         self.finished.emit()
 
 
-def get_size(filepath):
-    total_size = 0
-    for dirpath, dirnames, filenames in os.walk(filepath):
-        for f in filenames:
-            fp = Path(dirpath) / Path(f)
-            if not fp.is_symlink():
+@functools.lru_cache(maxsize=1)
+def image_suffixes():
+    return frozenset("." + bytes(fmt).decode().lower()
+                     for fmt in QtGui.QImageReader.supportedImageFormats())
+
+
+def make_preview(path, kind):
+    # Runs on a loader thread, so only thread-safe Qt classes (QImage,
+    # QImageReader, QBuffer) are touched. Returns (suffix, data) for the
+    # disk cache, data is empty when the file has nothing to show.
+    path = os.fspath(path)
+    suffix = os.path.splitext(path)[1].lower()
+    if suffix in image_suffixes():
+        reader = QtGui.QImageReader(path)
+        reader.setAutoTransform(True)
+        side = THUMBNAIL_SIZE if kind == "thumb" else PREVIEW_SIZE
+        size = reader.size()
+        if size.isValid() and (size.width() > side or size.height() > side):
+            reader.setScaledSize(size.scaled(side, side, Qt.KeepAspectRatio))
+        image = reader.read()
+        if image.isNull():
+            return ".png", b""
+        data = QtCore.QByteArray()
+        buf = QtCore.QBuffer(data)
+        buf.open(QtCore.QIODevice.WriteOnly)
+        image.save(buf, "PNG")
+        buf.close()
+        return ".png", bytes(data)
+    if kind == "thumb":
+        return ".txt", b""
+    if suffix == ".zip":
+        lines = []
+        with zipfile.ZipFile(path) as zf:
+            infos = zf.infolist()
+            for info in infos[:PREVIEW_MEMBERS]:
+                lines.append(f"{format_size(info.file_size):>12}  "
+                             f"{info.filename}")
+            if len(infos) > PREVIEW_MEMBERS:
+                lines.append(f"... {len(infos) - PREVIEW_MEMBERS} more")
+        return ".txt", "\n".join(lines).encode("utf-8")
+    f = open_regular(path)
+    if f is None:
+        return ".txt", b""
+    with f:
+        data = f.read(PREVIEW_TEXT_BYTES)
+    if b"\0" in data:
+        return ".txt", b""
+    return ".txt", data.decode("utf-8", "replace").encode("utf-8")
+
+
+class PreviewCache:
+    # Generated previews on disk, one file per path, mtime, size and kind.
+    # A changed file gets a new key, the stale entry simply ages out of the
+    # LRU once the cache grows past max_bytes.
+
+    def __init__(self, root=PREVIEW_CACHE_DIR, max_bytes=PREVIEW_CACHE_BYTES):
+        self.root = Path(root)
+        self.max_bytes = max_bytes
+        self.entries = collections.OrderedDict()
+        self.total = 0
+        self.lock = threading.Lock()
+        self.root.mkdir(parents=True, exist_ok=True)
+        existing = []
+        for entry in os.scandir(self.root):
+            if entry.is_file(follow_symlinks=False) and \
+                    not entry.name.endswith(".part"):
+                st = entry.stat()
+                existing.append((st.st_mtime, entry.name, st.st_size))
+        for mtime, name, size in sorted(existing):
+            self.entries[name] = size
+            self.total += size
+
+    @staticmethod
+    def key(path, st, kind):
+        return hashlib.sha1(f"{path}\0{st.st_mtime_ns}\0{st.st_size}\0{kind}"
+                            .encode("utf-8", "surrogatepass")).hexdigest()
+
+    def get(self, key):
+        with self.lock:
+            for suffix in (".png", ".txt"):
+                name = key + suffix
+                if name in self.entries:
+                    self.entries.move_to_end(name)
+                    break
+            else:
+                return None
+        target = self.root / name
+        try:
+            os.utime(target)
+            return suffix, target.read_bytes()
+        except OSError:
+            with self.lock:
+                self.total -= self.entries.pop(name, 0)
+            return None
+
+    def put(self, key, suffix, data):
+        name = key + suffix
+        target = self.root / name
+        tmp = target.with_name(name + f".{threading.get_ident()}.part")
+        tmp.write_bytes(data)
+        os.replace(tmp, target)
+        with self.lock:
+            self.total += len(data) - self.entries.pop(name, 0)
+            self.entries[name] = len(data)
+            while self.total > self.max_bytes and len(self.entries) > 1:
+                old, size = self.entries.popitem(last=False)
                 try:
-                    total_size += fp.stat().st_size
-                except FileNotFoundError:
+                    os.unlink(self.root / old)
+                except OSError:
+                    pass
+                self.total -= size
+
+
+class PreviewLoader(QtCore.QObject):
+    # Priority queue of preview requests served by a few threads. Lower
+    # priorities go first: the preview pane asks with -1, row thumbnails
+    # with their y offset in the viewport, so the top of the visible area
+    # fills in first. Pending thumbnails are dropped on scroll and asked
+    # for again by the rows that actually get painted.
+    ready = pyqtSignal(str, str)
+
+    def __init__(self, cache=None, workers=PREVIEW_WORKERS):
+        super(PreviewLoader, self).__init__()
+        self.cache = cache or PreviewCache()
+        self.cond = threading.Condition()
+        self.heap = []
+        self.pending = {}
+        self.results = collections.OrderedDict()
+        self.stopped = False
+        self.counter = 0
+        self.threads = [threading.Thread(target=self._work, daemon=True)
+                        for _ in range(max(1, workers))]
+        for thread in self.threads:
+            thread.start()
+
+    def lookup(self, path, kind):
+        # (True, value) once loaded, value being a QImage, a str or None
+        # when there is nothing to show; (False, None) otherwise.
+        with self.cond:
+            try:
+                self.results.move_to_end((path, kind))
+            except KeyError:
+                return False, None
+            return True, self.results[(path, kind)]
+
+    def request(self, path, kind, priority=0):
+        with self.cond:
+            key = (path, kind)
+            if key in self.results:
+                return
+            if self.pending.get(key, (priority + 1,))[0] <= priority:
+                return
+            self.counter += 1
+            entry = (priority, self.counter, path, kind)
+            self.pending[key] = entry
+            heapq.heappush(self.heap, entry)
+            self.cond.notify()
+
+    def clear(self, kind):
+        with self.cond:
+            self.heap = [e for e in self.heap if e[3] != kind]
+            heapq.heapify(self.heap)
+            self.pending = {k: e for k, e in self.pending.items()
+                            if e[3] != kind}
+
+    def apply_events(self, events):
+        with self.cond:
+            for event in events:
+                for path in (event.path, event.dest):
+                    if path is not None:
+                        self.results.pop((path, "thumb"), None)
+                        self.results.pop((path, "preview"), None)
+
+    def shutdown(self):
+        with self.cond:
+            self.stopped = True
+            self.cond.notify_all()
+
+    def _work(self):
+        while True:
+            with self.cond:
+                while not self.stopped and not self.heap:
+                    self.cond.wait()
+                if self.stopped:
+                    return
+                entry = heapq.heappop(self.heap)
+                priority, _, path, kind = entry
+                if self.pending.get((path, kind)) is not entry:
                     continue
-    return total_size
+            value = self._load(path, kind)
+            with self.cond:
+                if self.pending.get((path, kind)) is entry:
+                    del self.pending[(path, kind)]
+                self.results[(path, kind)] = value
+                while len(self.results) > PREVIEW_MEMORY_ITEMS:
+                    self.results.popitem(last=False)
+            self.ready.emit(path, kind)
+
+    def _load(self, path, kind):
+        try:
+            st = os.stat(path)
+            if not stat.S_ISREG(st.st_mode):
+                return None
+            key = PreviewCache.key(path, st, kind)
+            cached = self.cache.get(key)
+            if cached is None:
+                cached = make_preview(path, kind)
+                self.cache.put(key, *cached)
+        except (OSError, zipfile.BadZipFile, RuntimeError):
+            return None
+        suffix, data = cached
+        if not data:
+            return None
+        if suffix == ".png":
+            image = QtGui.QImage()
+            return image if image.loadFromData(data, "PNG") else None
+        return data.decode("utf-8", "replace")
 
 
 class MyWidget(QMainWindow, main.Ui_MainWindow):
@@ -161,6 +1409,25 @@ class MyWidget(QMainWindow, main.Ui_MainWindow):
         super().__init__()
         self.cut_flag = False
         self.size_worker = None
+        self.index_workers = {}
+        self.content_workers = {}
+        self.searchers = set()
+        self.stale_search = None
+        self.fs_model = None
+        self.member_cache = None
+        self.member_pool = ThreadPoolExecutor(1, thread_name_prefix="member")
+        self.index_updater = IndexUpdater()
+        self.previews = PreviewLoader()
+        self.futures = FutureDispatcher()
+        self.goto_request = None
+        self.watcher = FsWatcher([size_cache.apply_events,
+                                  self.index_updater,
+                                  self.previews.apply_events,
+                                  stat_service.apply_events])
+        self.watcher.start()
+        self.transfers = TransferQueue()
+        self.transfer_win = TransferWindow(self.transfers)
+        self.activity_win = ActivityWindow()
         self.setupUi(self)
         self.hidden = False
         self.copy_this = set()
@@ -169,6 +1436,15 @@ class MyWidget(QMainWindow, main.Ui_MainWindow):
         self.actionHome.triggered.connect(self.home_dir)
         self.actionShowHidden.triggered.connect(self.show_hid)
         self.actionSearch.triggered.connect(self.file_search)
+        self.actionSearchAll = QtWidgets.QAction("Search all disks", self)
+        self.actionSearchAll.triggered.connect(self.search_all)
+        self.menuHome.addAction(self.actionSearchAll)
+        self.actionContentSearch = QtWidgets.QAction("Search in files", self)
+        self.actionContentSearch.triggered.connect(self.content_search)
+        self.menuHome.addAction(self.actionContentSearch)
+        self.actionActivity = QtWidgets.QAction("Activity", self)
+        self.actionActivity.triggered.connect(self.activity_win.show)
+        self.menuHome.addAction(self.actionActivity)
         self.lineEdit.returnPressed.connect(self.goto)
         self.treeView.setAcceptDrops(True)
         self.treeView.setDropIndicatorShown(True)
@@ -181,7 +1457,18 @@ class MyWidget(QMainWindow, main.Ui_MainWindow):
         self.treeView.customContextMenuRequested.connect(self.cont_menu)
         self.treeView.doubleClicked.connect(self.open_file)
         self.treeView.viewport().installEventFilter(self)
-        self.treeView.setModel(self.model)
+        self.attach_model(self.model)
+        self.treeView.setItemDelegate(
+            ThumbnailDelegate(self.previews, self.treeView))
+        self.treeView.setIconSize(QtCore.QSize(24, 24))
+        self.treeView.verticalScrollBar().valueChanged.connect(
+            lambda: self.previews.clear("thumb"))
+        self.previews.ready.connect(self.preview_ready)
+        self.preview_pane = PreviewPane(self.previews)
+        self.preview_dock = QtWidgets.QDockWidget("Preview", self)
+        self.preview_dock.setWidget(self.preview_pane)
+        self.addDockWidget(Qt.RightDockWidgetArea, self.preview_dock)
+        self.menuHome.addAction(self.preview_dock.toggleViewAction())
         self.treeView. \
             setEditTriggers(QtWidgets.QAbstractItemView.NoEditTriggers)
         self.treeView.setDragDropMode(QTreeView.InternalMove)
@@ -192,28 +1479,195 @@ class MyWidget(QMainWindow, main.Ui_MainWindow):
 
         self.comboBox.activated.connect(self.path_changer)
 
+    def attach_model(self, model):
+        self.treeView.setModel(model)
+        self.treeView.selectionModel().currentChanged.connect(
+            self.preview_current)
+        self.previews.clear("thumb")
+
+    def preview_current(self, current, previous):
+        if not self.preview_dock.isVisible():
+            return
+        if self.in_archive() or not current.isValid():
+            self.preview_pane.show_path(None)
+        else:
+            self.preview_pane.show_path(self.model.filePath(current),
+                                        self.model.isDir(current))
+
+    def preview_ready(self, path, kind):
+        if kind == "thumb":
+            self.treeView.viewport().update()
+
     def click(self, file):
-        self.treeView.setRootIndex(self.model.index(file))
-        self.lineEdit.setText(file)
-        self.set_path(file)
+        self.reveal(file)
         self.search_results.close()
 
+    def reveal(self, file):
+        self.futures.then(stat_service.stat(file),
+                          functools.partial(self.reveal_stat, file))
+
+    def reveal_stat(self, file, future):
+        try:
+            is_dir = stat.S_ISDIR(future.result().st_mode)
+        except OSError:
+            self.show_msg("Error", "File not exists!").show()
+            return
+        if is_dir:
+            self.treeView.setRootIndex(self.index_of(file))
+            self.lineEdit.setText(file)
+            self.set_path(file)
+        else:
+            parent = str(Path(file).parent).replace('\\', '/')
+            self.treeView.setRootIndex(self.index_of(parent))
+            self.lineEdit.setText(parent)
+            self.set_path(parent)
+            index = self.model.index(file)
+            self.treeView.setCurrentIndex(index)
+            self.treeView.scrollTo(index)
+
     def file_search(self):
+        if self.in_archive():
+            self.show_msg("Warning", "Can't search inside archive!").show()
+            return
+        # Several selected folders are searched together, otherwise the
+        # folder being shown.
+        roots = sorted({self.model.filePath(i)
+                        for i in self.treeView.selectedIndexes()
+                        if self.model.isDir(i)})
+        if len(roots) < 2:
+            roots = [self.model.filePath(self.treeView.rootIndex())]
+        if roots == [""]:
+            self.show_msg("Warning", "Choose disk to look for file!").show()
+            return
+        self.ask_search(roots)
+
+    def search_all(self):
+        # No index is built for these, that would mean indexing every disk.
+        roots = [volume.rootPath()
+                 for volume in QtCore.QStorageInfo.mountedVolumes()
+                 if volume.isValid() and volume.isReady()]
+        self.ask_search(roots, index=False)
+
+    def ask_search(self, roots, index=True):
+        s, search = QInputDialog.getText(
+            self, "Search", "Name, glob or filters (re: size: mtime: "
+                            "type: exclude: case: limit:)", text="")
+        if search:
+            try:
+                query = SearchQuery.parse(s)
+            except ValueError as e:
+                self.show_msg("Error", str(e)).show()
+                return
+            # An index not refreshed since startup answers from whatever was
+            # on disk last time; those results are marked and replaced.
+            stale = {("name", rootpath) for rootpath in roots if index
+                     and os.path.normpath(rootpath)
+                     not in self.index_updater.roots
+                     and FileIndex.db_file(rootpath).exists()}
+            self.start_search(Searcher(query, roots), stale=bool(stale))
+            self.search_results.setWindowTitle(
+                f"{s} in {', '.join(roots)}")
+            if stale:
+                self.stale_search = (self.search_results, functools.partial(
+                    Searcher, query, roots), stale)
+            for rootpath in roots if index else ():
+                self.update_index(rootpath)
+
+    def start_search(self, worker, stale=False, results=None):
+        # A new search makes the ones still running stale; they stop and
+        # keep what they found so far. Workers are held until their thread
+        # is done, the results window may be gone long before that.
+        for old in self.searchers:
+            old.cancel()
+        self.searchers.add(worker)
+        worker.finished.connect(functools.partial(self.search_done, worker))
+        if self.stale_search is not None and \
+                self.stale_search[0] is not results:
+            self.stale_search[0].drop_stale()
+        self.stale_search = None
+        if results is not None:
+            results.restart(worker)
+            return
+        self.search_results = SearchResults(worker, stale)
+        self.search_results.show()
+        self.search_results.clicked.connect(self.click)
+
+    def search_done(self, worker):
+        worker.wait()
+        self.searchers.discard(worker)
+
+    def content_search(self):
+        if self.in_archive():
+            self.show_msg("Warning", "Can't search inside archive!").show()
+            return
         index = self.treeView.rootIndex()
         rootpath = self.model.filePath(index)
         if rootpath == "":
             self.show_msg("Warning", "Choose disk to look for file!").show()
             return
-        s, search = QInputDialog.getText(self, "Search", "Input", text="")
-        if search:
-            self.search_results = SearchResults(s, rootpath)
-            self.search_results.show()
-            self.search_results.clicked.connect(self.click)
+        text, ok = QInputDialog.getText(
+            self, "Search in files", "Text (lower case ignores case)")
+        if ok and text:
+            # Nothing keeps the content index in step with the disk, so an
+            # existing one misses whatever changed since its last refresh.
+            stale = ContentIndex.db_file(rootpath).exists()
+            self.start_search(ContentSearcher(text, rootpath), stale=stale)
+            self.search_results.setWindowTitle(f"Files containing {text}")
+            if stale:
+                self.stale_search = (self.search_results, functools.partial(
+                    ContentSearcher, text, rootpath),
+                    {("content", rootpath)})
+            self.update_content_index(rootpath)
+
+    def update_content_index(self, rootpath):
+        if rootpath in self.content_workers:
+            return
+        worker = ContentIndexWorker(rootpath)
+        worker.finished.connect(self.content_index_updated)
+        self.content_workers[rootpath] = worker
+        worker.start()
+
+    def update_index(self, rootpath):
+        if rootpath in self.index_workers:
+            return
+        worker = IndexWorker(rootpath)
+        worker.finished.connect(self.index_updated)
+        self.index_workers[rootpath] = worker
+        worker.start()
+
+    def index_updated(self, rootpath):
+        self.index_workers.pop(rootpath, None)
+        self.index_updater.add(rootpath)
+        self.watcher.watch(rootpath)
+        self.index_refreshed("name", rootpath)
+
+    def content_index_updated(self, rootpath):
+        self.content_workers.pop(rootpath, None)
+        self.index_refreshed("content", rootpath)
+
+    def index_refreshed(self, kind, rootpath):
+        # Runs the stale search again once every index it read from has
+        # been refreshed, if its window is still open.
+        if self.stale_search is None:
+            return
+        results, make_worker, pending = self.stale_search
+        pending.discard((kind, rootpath))
+        if not pending:
+            self.stale_search = None
+            if results.isVisible():
+                self.start_search(make_worker(), results=results)
 
     def cont_menu(self):
         menu = QtWidgets.QMenu()
         index = self.treeView.selectedIndexes()
-        if len(index) == 0:
+        if self.in_archive():
+            if len(index) == 0:
+                return
+            _open = menu.addAction("Open")
+            extract = menu.addAction("Extract")
+            _open.triggered.connect(self.open_file)
+            extract.triggered.connect(self.extract_members)
+        elif len(index) == 0:
             new_dir = menu.addAction("New dir")
             new_file = menu.addAction("New file")
             paste = menu.addAction("Paste")
@@ -224,9 +1678,11 @@ class MyWidget(QMainWindow, main.Ui_MainWindow):
             change = menu.addAction("Change name")
             _open = menu.addAction("Open")
             attributes = menu.addAction("Attributes")
+            usage = menu.addAction("Disk usage")
             change.triggered.connect(self.change_name)
             _open.triggered.connect(self.open_file)
             attributes.triggered.connect(self.show_atts)
+            usage.triggered.connect(self.disk_usage)
         else:
             file = Path(self.model.filePath(index[0]))
             _open = menu.addAction("Open")
@@ -237,6 +1693,11 @@ class MyWidget(QMainWindow, main.Ui_MainWindow):
             cut = menu.addAction("Cut")
             attributes = menu.addAction("Attributes")
             arc = menu.addAction("Archive")
+            duplicates = menu.addAction("Find duplicates")
+            duplicates.triggered.connect(self.find_duplicates)
+            if self.model.isDir(index[0]):
+                usage = menu.addAction("Disk usage")
+                usage.triggered.connect(self.disk_usage)
             if file.suffix == ".zip":
                 unpack = menu.addAction("Unpack")
                 unpack.triggered.connect(self.unpack)
@@ -255,12 +1716,31 @@ class MyWidget(QMainWindow, main.Ui_MainWindow):
         index = self.treeView.selectedIndexes()
         file_path = self.model.filePath(index[0])
         self.treeView.clearSelection()
-        if Path(file_path).is_file():
-            os.startfile(file_path)
-        if Path(file_path).is_dir():
+        if self.in_archive():
+            self.open_member(index[0])
+            return
+        # The model already knows directories, so entering one costs no
+        # round trip; files are checked off the GUI thread before opening.
+        if self.model.isDir(index[0]):
             self.treeView.setRootIndex(index[0])
             self.lineEdit.setText(file_path)
             self.set_path(file_path)
+            return
+        self.futures.then(stat_service.stat(file_path),
+                          functools.partial(self.open_stat, file_path))
+
+    def open_stat(self, file_path, future):
+        try:
+            is_file = stat.S_ISREG(future.result().st_mode)
+        except OSError:
+            self.show_msg("Error", "File not exists!").show()
+            return
+        if not is_file:
+            return
+        if Path(file_path).suffix == ".zip":
+            self.open_archive(file_path)
+        else:
+            open_path(file_path)
 
     def set_path(self, path):
         self.treeView.clearSelection()
@@ -271,11 +1751,25 @@ class MyWidget(QMainWindow, main.Ui_MainWindow):
 
     def goto(self):
         path = self.lineEdit.text()
-        if Path(path).exists():
-            self.treeView.setRootIndex(self.model.index(path))
+        if self.in_archive() and self.model.contains(path):
+            self.treeView.setRootIndex(self.model.path_index(path))
             self.set_path(path)
         else:
+            self.goto_request = path
+            self.futures.then(stat_service.stat(path),
+                              functools.partial(self.goto_stat, path))
+
+    def goto_stat(self, path, future):
+        if path != self.goto_request:
+            return
+        self.goto_request = None
+        try:
+            future.result()
+        except OSError:
             self.show_msg("Error", "Wrong path!").show()
+            return
+        self.treeView.setRootIndex(self.index_of(path))
+        self.set_path(path)
 
     def path_changer(self):
         self.treeView.clearSelection()
@@ -283,30 +1777,115 @@ class MyWidget(QMainWindow, main.Ui_MainWindow):
                   for i in range(self.comboBox.currentIndex() + 1)]
         path = '/'.join(path_l)
         self.lineEdit.setText(path)
-        self.treeView.setRootIndex(self.model.index(path))
+        self.treeView.setRootIndex(self.index_of(path))
 
     def go_back(self):
         self.treeView.clearSelection()
+        if self.in_archive() and not self.treeView.rootIndex().isValid():
+            path = str(Path(self.model.archive).parent).replace('\\', '/')
+            self.close_archive()
+            self.treeView.setRootIndex(self.model.index(path))
+            self.lineEdit.setText(path)
+            self.set_path(path)
+            return
         index = self.model.parent(self.treeView.rootIndex())
         self.treeView.setRootIndex(index)
         self.lineEdit.setText(self.model.filePath(index))
         if self.comboBox.currentIndex() != 0:
             self.comboBox.setCurrentIndex(self.comboBox.currentIndex() - 1)
 
+    def in_archive(self):
+        return isinstance(self.model, ZipModel)
+
+    def index_of(self, path):
+        if self.in_archive():
+            if self.model.contains(path):
+                return self.model.path_index(path)
+            self.close_archive()
+        return self.model.index(path)
+
+    def open_archive(self, path):
+        try:
+            model = ZipModel(path)
+        except (OSError, zipfile.BadZipFile):
+            self.show_msg("Error", "Can't read archive!").show()
+            return
+        if not self.in_archive():
+            self.fs_model = self.model
+        self.model = model
+        self.attach_model(self.model)
+        self.lineEdit.setText(model.archive)
+        self.set_path(model.archive)
+
+    def close_archive(self):
+        self.model = self.fs_model
+        self.fs_model = None
+        self.attach_model(self.model)
+
+    def open_member(self, index):
+        if self.model.isDir(index):
+            file_path = self.model.filePath(index)
+            self.treeView.setRootIndex(index.siblingAtColumn(0))
+            self.lineEdit.setText(file_path)
+            self.set_path(file_path)
+            return
+        future = self.member_pool.submit(
+            self.extract_member, self.model.archive, self.model.member(index))
+        self.futures.then(future, self.member_extracted)
+
+    def extract_member(self, archive, member):
+        # Runs on member_pool. Loading the cache sizes every cached folder
+        # and get() decompresses the whole member, neither may block the
+        # window; the pool's single thread is the only user of the cache.
+        if self.member_cache is None:
+            self.member_cache = MemberCache()
+        return self.member_cache.get(archive, member)
+
+    def member_extracted(self, future):
+        try:
+            path = future.result()
+        except (OSError, zipfile.BadZipFile, RuntimeError):
+            self.show_msg("Error", "Can't extract file!").show()
+            return
+        open_path(path)
+
+    def extract_members(self):
+        index = self.treeView.selectedIndexes()
+        members = list(dict.fromkeys(self.model.member(i) for i in index))
+        self.extract(Path(self.model.archive), members)
+
     def home_dir(self):
+        self.fs_model = None
         self.lineEdit.clear()
         self.comboBox.clear()
         self.model = QtWidgets.QFileSystemModel()
         self.model.setRootPath((QtCore.QDir.rootPath()))
-        self.treeView.setModel(self.model)
+        self.attach_model(self.model)
 
     def change_name(self):
         index = self.treeView.selectedIndexes()
-        if len(index) > 4 or len(index) <= 0:
+        if len(index) > 4:
+            self.batch_rename(index)
+            return
+        if len(index) <= 0:
             self.show_msg("Error", "Choose one item").show()
             return
         self.treeView.edit(index[0])
 
+    def batch_rename(self, indexes):
+        # Rows in view order, which is what {n} counts in. Drives have no
+        # name to change.
+        rows = sorted((i for i in indexes if i.column() == 0),
+                      key=lambda i: (i.parent().row(), i.row()))
+        paths = [self.model.filePath(i) for i in rows
+                 if Path(self.model.filePath(i)).name != ""]
+        if not paths:
+            return
+        dialog = BatchRenameDialog(paths, self)
+        if dialog.exec_() == QtWidgets.QDialog.Accepted:
+            self.transfers.submit(RenameJob(dialog.plan))
+            self.transfer_win.show()
+
     def new_dir(self):
         index = self.treeView.rootIndex()
         path = Path(self.model.filePath(index))
@@ -334,18 +1913,27 @@ class MyWidget(QMainWindow, main.Ui_MainWindow):
                 (path / Path(i)).touch(exist_ok=True)
 
     def delete_selected(self):
+        self.remove_selected(trash=False)
+
+    def remove_selected(self, trash):
         index = self.treeView.selectedIndexes()
-        for i in index:
-            self.model.remove(i)
+        paths = [self.model.filePath(i) for i in index]
+        if not paths:
+            return
+        self.transfers.submit(DeleteJob(paths, trash=trash))
+        self.transfer_win.show()
 
     def show_hid(self):
+        # Archives list every member; inside one the setting applies to
+        # the folder view it returns to.
+        model = self.fs_model if self.in_archive() else self.model
         if not self.hidden:
-            self.model.setFilter(QDir.NoDot | QDir.NoDotDot |
-                                 QDir.Hidden | QDir.AllDirs | QDir.Files)
+            model.setFilter(QDir.NoDot | QDir.NoDotDot |
+                            QDir.Hidden | QDir.AllDirs | QDir.Files)
             self.hidden = True
         else:
-            self.model.setFilter(QDir.NoDot | QDir.NoDotDot |
-                                 QDir.AllDirs | QDir.Files)
+            model.setFilter(QDir.NoDot | QDir.NoDotDot |
+                            QDir.AllDirs | QDir.Files)
             self.hidden = False
 
     def copy(self):
@@ -359,39 +1947,97 @@ class MyWidget(QMainWindow, main.Ui_MainWindow):
         self.cut_flag = True
 
     def add_to_bin(self):
-        index = self.treeView.selectedIndexes()
-        files_to_delete = set(self.model.filePath(x) for x in index)
-        for i in files_to_delete:
-            send2trash(Path(i))
+        self.remove_selected(trash=True)
 
     def paste(self):
-        index = self.treeView.rootIndex()
-        try:
-            for i in self.copy_this:
-                file_to_copy = Path(i)
-                if not file_to_copy.exists():
-                    self.show_msg("Error", "File not exists!").show()
+        # All sources and target names are checked at once on the stat
+        # pool; the jobs are queued when the last answer is in. Targets
+        # skip the cache so a paste never lands on a fresh file.
+        root = self.model.filePath(self.treeView.rootIndex())
+        checks = []
+        for i in self.copy_this:
+            file_to_copy = Path(i)
+            checks.append((file_to_copy, stat_service.stat(file_to_copy),
+                           stat_service.exists(root + '/' + file_to_copy.name,
+                                               max_age=0)))
+        move = self.cut_flag
+        self.cut_flag = False
+        futures = [f for check in checks for f in check[1:]]
+        self.futures.then(when_all(futures), lambda _: self.paste_checked(
+            root, checks, move))
+
+    def paste_checked(self, root, checks, move):
+        for file_to_copy, st, taken in checks:
+            try:
+                is_dir = stat.S_ISDIR(st.result().st_mode)
+            except OSError:
+                self.show_msg("Error", "File not exists!").show()
+                continue
+            path = root
+            if is_dir:
+                path = path + f"/{file_to_copy.name}"
+                same = os.path.normpath(path) == \
+                    os.path.normpath(file_to_copy)
+                if same and move:
+                    continue
+                if taken.result():
+                    job = None if same else \
+                        self.ask_sync(file_to_copy, path, move)
+                    if job is not None:
+                        self.transfers.submit(job)
+                        continue
+                    path += " - copy at " + str(round(time.time() * 1000))
+                if inside(path, file_to_copy):
+                    self.show_msg("Error", "Can't paste a folder into "
+                                           "itself!").show()
                     continue
-                path = self.model.filePath(index)
-                if file_to_copy.is_dir():
-                    path = path + f"/{file_to_copy.name}"
-                    if Path(path).exists():
-                        path += " - copy at " + str(round(time.time() * 1000))
-                    shutil.copytree(file_to_copy, path)
-                else:
-                    if Path(path + '/' + file_to_copy.name).exists():
-                        path = path \
-                               + '/' + file_to_copy.stem + " - copy" \
-                               + file_to_copy.suffix
-                    shutil.copy2(file_to_copy, path)
-                if self.cut_flag:
-                    if file_to_copy.is_dir():
-                        shutil.rmtree(file_to_copy)
-                    else:
-                        file_to_copy.unlink()
-            self.cut_flag = False
-        except PermissionError:
-            self.show_msg("Warning", "Run as admin to do that").show()
+            elif taken.result():
+                self.paste_copy(root, file_to_copy, move)
+                continue
+            else:
+                path = path + '/' + file_to_copy.name
+            self.transfers.submit(
+                TransferJob(file_to_copy, path, move=move))
+        self.transfer_win.show()
+
+    def paste_copy(self, root, src, move):
+        # A file pasted next to one of the same name gets the first free
+        # of "<stem> - copy<suffix>", "<stem> - copy 2<suffix>", ...,
+        # checked like the paste targets without the stat cache.
+        names = [f"{src.stem} - copy{src.suffix}"] + \
+            [f"{src.stem} - copy {n}{src.suffix}"
+             for n in range(2, PASTE_COPY_NAMES + 1)]
+        checks = [(name, stat_service.exists(root + '/' + name, max_age=0))
+                  for name in names]
+        self.futures.then(when_all(taken for _, taken in checks),
+                          lambda _: self.paste_copy_checked(root, src, move,
+                                                            checks))
+
+    def paste_copy_checked(self, root, src, move, checks):
+        free = [name for name, taken in checks if not taken.result()]
+        name = free[0] if free else f"{src.stem} - copy at " \
+            f"{round(time.time() * 1000)}{src.suffix}"
+        self.transfers.submit(TransferJob(src, root + '/' + name, move=move))
+        self.transfer_win.show()
+
+    def ask_sync(self, src, dst, move):
+        # None keeps the old behaviour of pasting next to the existing
+        # folder under a new name.
+        msg = self.show_msg("Info", f"{dst} already exists.")
+        msg.setInformativeText(
+            "Merge copies only new and changed files into it, mirror also "
+            "removes files that are not in the source.")
+        merge = msg.addButton("Merge", QMessageBox.AcceptRole)
+        mirror = msg.addButton("Mirror", QMessageBox.DestructiveRole)
+        msg.addButton("Keep both", QMessageBox.RejectRole)
+        checksum = QtWidgets.QCheckBox("Compare contents, not just size "
+                                       "and time")
+        msg.setCheckBox(checksum)
+        msg.exec_()
+        if msg.clickedButton() not in (merge, mirror):
+            return None
+        return SyncJob(src, dst, checksum=checksum.isChecked(),
+                       delete=msg.clickedButton() is mirror, move=move)
 
     def show_msg(self, title, text):
         msg = QMessageBox(self)
@@ -406,36 +2052,46 @@ class MyWidget(QMainWindow, main.Ui_MainWindow):
         return msg
 
     def show_atts(self):
-        if self.size_worker is not None:
-            self.size_worker.terminate()
+        self.stop_size_worker()
         index = self.treeView.selectedIndexes()
         self.file = Path(self.model.filePath(index[0]))
         self.size_worker = SizeWorker(self.file)
-        self.size_worker.finished.connect(self.report)
+        if self.model.isDir(index[0]):
+            # Keeps the cached size of this tree in step with changes
+            # made outside the app.
+            self.watcher.watch(self.file)
+        self.atts_win = AttributeWindow(self.file)
+        self.size_worker.progress.connect(self.atts_win.update_progress)
+        self.size_worker.finished.connect(self.atts_win.set_size)
+        self.atts_win.cancelled.connect(self.size_worker.cancel)
+        self.futures.then(stat_service.stat(self.file), self.atts_win.set_stat)
         self.size_worker.start()
-        self.atts_win = self.show_msg("Info", "Calculating size...")
         self.atts_win.show()
 
-    def report(self, n):
-        self.atts_win.close()
-        self.atts_win = AttributeWindow(self.file, n)
-        self.atts_win.show()
+    def disk_usage(self):
+        index = self.treeView.selectedIndexes()
+        self.usage_win = DiskUsageWindow(self.model.filePath(index[0]))
+        self.usage_win.clicked.connect(self.reveal)
+        self.usage_win.show()
+
+    def find_duplicates(self):
+        index = self.treeView.selectedIndexes()
+        paths = list(dict.fromkeys(self.model.filePath(i) for i in index))
+        self.duplicates_win = DuplicatesWindow(paths)
+        self.duplicates_win.clicked.connect(self.reveal)
+        self.duplicates_win.show()
+
+    def stop_size_worker(self):
+        if self.size_worker is not None:
+            self.size_worker.cancel()
+            self.size_worker.wait()
 
     def archive(self):
         index = self.treeView.selectedIndexes()
-        file = Path(self.model.filePath(index[0]))
-        if len(index) > 4:
-            self.model.mkdir(self.treeView.rootIndex(), "zip")
-            files_set = set()
+        files = list(dict.fromkeys(self.model.filePath(i) for i in index))
+        file = Path(files[0])
+        if len(files) > 1:
             file = file.parent / Path("zip")
-            for i in index:
-                files_set.add(self.model.filePath(i))
-            for i in files_set:
-                if Path(i).is_dir():
-                    shutil.copytree(i, file / Path(i).name)
-                else:
-                    shutil.copy2(i, file)
-        os.chdir(file.parent)
         i, filled = QInputDialog. \
             getText(self, "Input name", "Input", text=file.stem)
         if filled:
@@ -445,14 +2101,28 @@ class MyWidget(QMainWindow, main.Ui_MainWindow):
             elif (file.parent / Path(i + ".zip")).exists():
                 self.show_msg("Error", "Already exists!").show()
             else:
-                shutil.make_archive(i, "zip", file.parent, file.name)
-        if len(index) > 4:
-            shutil.rmtree(file)
+                level, chosen = QInputDialog.getItem(
+                    self, "Compression", "Level", list(ARCHIVE_LEVELS),
+                    0, False)
+                if chosen:
+                    self.transfers.submit(ArchiveJob(
+                        files, file.parent / Path(i + ".zip"),
+                        ARCHIVE_LEVELS[level]))
+                    self.transfer_win.show()
 
     def unpack(self):
         index = self.treeView.selectedIndexes()
         file = Path(self.model.filePath(index[0]))
-        os.chdir(file.parent)
+        try:
+            self.archive_browser = ArchiveBrowser(file)
+        except (OSError, zipfile.BadZipFile):
+            self.show_msg("Error", "Can't read archive!").show()
+            return
+        self.archive_browser.extract.connect(
+            lambda members: self.extract(file, members))
+        self.archive_browser.show()
+
+    def extract(self, file, members):
         i, filled = QInputDialog. \
             getText(self, "Input name", "Input", text=file.stem)
         if filled:
@@ -462,7 +2132,21 @@ class MyWidget(QMainWindow, main.Ui_MainWindow):
             elif (file.parent / Path(i)).exists():
                 self.show_msg("Error", "Already exists!").show()
             else:
-                shutil.unpack_archive(file, i)
+                self.transfers.submit(
+                    ExtractJob(file, file.parent / Path(i), members))
+                self.transfer_win.show()
+
+    def closeEvent(self, a0: QtGui.QCloseEvent) -> None:
+        self.watcher.stop()
+        self.previews.shutdown()
+        stat_service.shutdown()
+        self.member_pool.shutdown(wait=False, cancel_futures=True)
+        self.stop_size_worker()
+        for worker in self.searchers:
+            worker.cancel()
+        self.transfers.shutdown()
+        self.transfer_win.close()
+        self.activity_win.close()
 
     def eventFilter(self, obj, event):
         if (
@@ -475,6 +2159,13 @@ class MyWidget(QMainWindow, main.Ui_MainWindow):
         return super(MyWidget, self).eventFilter(obj, event)
 
     def keyPressEvent(self, event):
+        if self.in_archive():
+            if event.modifiers() & Qt.ControlModifier:
+                if event.key() == Qt.Key_H:
+                    self.home_dir()
+                if event.key() == Qt.Key_Left:
+                    self.go_back()
+            return
         if event.modifiers() & Qt.ControlModifier:
             if event.key() == Qt.Key_H:
                 self.home_dir()
@@ -486,6 +2177,8 @@ class MyWidget(QMainWindow, main.Ui_MainWindow):
                 self.change_name()
             if event.key() == Qt.Key_S:
                 self.file_search()
+            if event.key() == Qt.Key_F:
+                self.content_search()
             if event.key() == Qt.Key_Left:
                 self.go_back()
         if event.key() == Qt.Key_Delete:
@@ -497,6 +2190,8 @@ class MyWidget(QMainWindow, main.Ui_MainWindow):
             event.acceptProposedAction()
 
     def dropEvent(self, event):
+        if self.in_archive():
+            return
         for url in event.mimeData().urls():
             self.copy_this.add(url.toLocalFile())
             self.paste()